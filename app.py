@@ -1,46 +1,103 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file
+import json
+import sqlite3
+import uuid
+import secrets
+import time
+import logging
+import threading
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file, Response, stream_with_context, g, has_request_context
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import timedelta
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import click
 import utils # Nosso arquivo de utilidades
+import batch as batch_files
+from llm_cache import llm_cache
+from jurisprudence import jurisprudence_store, iter_import_file
+from upload_storage import upload_store, UploadRequest, UPLOAD_FOLDER
+import metrics
+import structured_logging
+from structured_logging import request_id_var, in_current_context
+from failover import hedged_generation, GenerationCancelled, is_generation_error
+from server_sessions import ServerSideSessionInterface, SQLAlchemySessionStore, RedisSessionStore
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
 from dotenv import load_dotenv
 load_dotenv()
 # Configuração da Aplicação
 app = Flask(__name__)
-# --- Configuração de Logging para Produção ---
-if not app.debug: # Só ativa o logging em arquivo quando não está em modo debug
-    import logging
-    from logging.handlers import RotatingFileHandler
-    
-    # Cria um handler que salva logs em um arquivo, com rotação (10MB por arquivo, até 5 arquivos)
-    file_handler = RotatingFileHandler('error.log', maxBytes=1024 * 1024 * 10, backupCount=5)
-    
-    # Define o formato do log para incluir data, hora, nível, mensagem e a origem do erro
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-    ))
-    
-    # Define o nível do log (ex: WARNING, ERROR, INFO)
-    file_handler.setLevel(logging.WARNING)
-    
-    # Adiciona o handler à sua aplicação Flask
-    app.logger.addHandler(file_handler)
-    
-    # Log para confirmar que o logging foi configurado
-    app.logger.info('Logging da Exordial AI iniciado')
-
-app.secret_key = os.urandom(24) # Mantenha isso seguro e constante em produção
+app.request_class = UploadRequest # Uploads gravados em disco durante a leitura, com o SHA-256 (ver upload_storage.py)
+# --- Configuração de Logging ---
+# JSON com o ID da requisição, escrito por uma thread em segundo plano (ver structured_logging.py).
+# O arquivo com rotação (WARNING em diante, por padrão) só é usado fora do modo debug.
+structured_logging.configure_logging(log_to_file=not app.debug, sampled_loggers=["utils"])
+for logger_with_level in (app.logger, logging.getLogger("utils")):
+    logger_with_level.setLevel(structured_logging.LOG_LEVEL)
+app.logger.info('Logging da Exordial AI iniciado')
+
+def load_secret_key():
+    """
+    SECRET_KEY do ambiente (obrigatória com várias máquinas). Sem ela, uma chave gerada uma única
+    vez fica guardada na pasta instance/, para que todos os workers desta máquina assinem igual.
+    """
+    secret_key = os.getenv("SECRET_KEY")
+    if secret_key: return secret_key
+    print("ATENÇÃO: SECRET_KEY não definida no ambiente. Usando a chave guardada em instance/secret_key.")
+    os.makedirs(app.instance_path, exist_ok=True)
+    key_path = os.path.join(app.instance_path, "secret_key")
+    if not os.path.exists(key_path):
+        temp_path = f"{key_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as key_file:
+            key_file.write(secrets.token_hex(32))
+        os.chmod(temp_path, 0o600)
+        try:
+            os.link(temp_path, key_path) # Atômico: se outro worker criou antes, fica a chave dele
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+    with open(key_path) as key_file:
+        return key_file.read().strip()
+
+app.secret_key = load_secret_key() # Mantenha isso seguro e constante em produção
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
-app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 25 * 1024 * 1024
 
 # Configuração do Banco de Dados
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///juridica_app_v2.db' # Novo nome para evitar conflitos
+# DATABASE_URL permite usar um banco de servidor (ex.: PostgreSQL) em produção; sem ele, SQLite local.
+DATABASE_URL = os.getenv("DATABASE_URL", 'sqlite:///juridica_app_v2.db') # Novo nome para evitar conflitos
+if DATABASE_URL.startswith("postgres://"): # Formato antigo usado por alguns provedores
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if DATABASE_URL.startswith("sqlite"):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {"connect_args": {"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}}
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800")),
+        "pool_pre_ping": True, # Descarta conexões derrubadas pelo servidor
+    }
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, 'connect')
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    # WAL deixa leituras concorrerem com a escrita; busy_timeout espera o lock em vez de
+    # falhar com "database is locked"; synchronous=NORMAL é seguro com WAL e evita um fsync por commit.
+    if not isinstance(dbapi_connection, sqlite3.Connection): return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
 # --- Chaves de API (ATENÇÃO: NÃO USE EM PRODUÇÃO DIRETAMENTE NO CÓDIGO) ---
 GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
 CHATVOLT_API_KEY = os.getenv("CHATVOLT_API_KEY", "")
@@ -68,9 +125,174 @@ class User(db.Model):
     def __repr__(self):
         return f'<User {self.email}>'
 
-# Verificar se a pasta de uploads existe
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
+# Job de geração de petição executado em segundo plano
+class GenerationJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    agent = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), default='queued') # 'queued', 'running', 'done', 'error'
+    progress = db.Column(db.Text, default='{}') # JSON com a etapa atual (fluxo Gemini)
+    input_data = db.Column(db.Text, nullable=False) # JSON com os dados do caso (user_input_data)
+    result_text = db.Column(db.Text)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "agent": self.agent,
+            "status": self.status,
+            "progress": json.loads(self.progress or '{}'),
+            "error": self.error,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
+        }
+
+    def __repr__(self):
+        return f'<GenerationJob {self.id} {self.status}>'
+
+# Lote de petições geradas a partir de um arquivo CSV/JSON (ver batch.py)
+class GenerationBatch(db.Model):
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    agent = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), default='queued') # 'queued', 'running', 'done', 'error'
+    filename = db.Column(db.String(255))
+    input_data = db.Column(db.Text, nullable=False) # JSON com a lista de user_input_data
+    items = db.Column(db.Text, nullable=False) # JSON: situação de cada item ({"status", "petition_id", "error"})
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        items = json.loads(self.items)
+        counts = {status: sum(1 for item in items if item["status"] == status) for status in ('queued', 'done', 'error')}
+        return {
+            "batch_id": self.id,
+            "agent": self.agent,
+            "status": self.status,
+            "filename": self.filename,
+            "total": len(items),
+            "done": counts['done'],
+            "failed": counts['error'],
+            "pending": counts['queued'],
+            "items": items,
+            "error": self.error,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
+        }
+
+    def __repr__(self):
+        return f'<GenerationBatch {self.id} {self.status}>'
+
+# Petição gerada, guardada no servidor (a sessão guarda só o ID da última)
+class Petition(db.Model):
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    agent = db.Column(db.String(50), nullable=False)
+    input_data = db.Column(db.Text, nullable=False) # JSON com os dados do caso (user_input_data)
+    sections = db.Column(db.Text, nullable=False) # JSON com as seções do texto, na ordem do documento (ver utils.petition_sections)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    @property
+    def section_list(self):
+        # Petições antigas guardavam só os pedaços de texto, sem o tipo de cada seção
+        return [section if isinstance(section, dict) else {"kind": "texto", "title": None, "text": section}
+                for section in json.loads(self.sections)]
+
+    @property
+    def text(self):
+        return "".join(section["text"] for section in self.section_list)
+
+    def to_dict(self, include_text=False):
+        input_data = json.loads(self.input_data)
+        petition = {
+            "petition_id": self.id,
+            "agent": self.agent,
+            "tipo_peticao": input_data.get("tipo_peticao"),
+            "assunto_principal": input_data.get("assunto_principal"),
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+        }
+        if include_text:
+            petition["input_data"] = input_data
+            petition["generated_petition"] = self.text
+            petition["sections"] = [{"index": index, **section} for index, section in enumerate(self.section_list)]
+        return petition
+
+    def __repr__(self):
+        return f'<Petition {self.id}>'
+
+# Etapa concluída do fluxo Gemini numa execução (run_id = ID do job ou da petição); ver utils.GeminiFlowCheckpoint
+class FlowCheckpoint(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.String(32), nullable=False, index=True)
+    step = db.Column(db.String(255), nullable=False) # 'planejamento', 'enderecamento_fatos', 'topico:<título>', 'pedidos_encerramento'
+    text = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    __table_args__ = (db.UniqueConstraint('run_id', 'step', name='uq_flow_checkpoint_run_step'),)
+
+# Arquivo enviado por um usuário: referência ao blob (pelo SHA-256) no armazenamento de uploads.
+# Blobs sem nenhuma referência são removidos por `flask gc-uploads`.
+class StoredUpload(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False) # Último nome com que o arquivo foi enviado
+    size = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False) # 'documento' ou 'audio'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    __table_args__ = (db.UniqueConstraint('user_id', 'sha256', name='uq_stored_upload_user_sha256'),)
+
+# Livro de tokens: cada geração reserva 1 token antes de chamar o agente; a reserva é
+# confirmada no sucesso ou estornada no erro
+class TokenLedger(db.Model):
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    amount = db.Column(db.Integer, nullable=False, default=1)
+    status = db.Column(db.String(20), nullable=False, default='reserved', index=True) # 'reserved', 'committed', 'refunded'
+    reference = db.Column(db.String(32), index=True) # ID da petição ou do job
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    settled_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<TokenLedger {self.id} {self.status}>'
+
+# Sessão guardada no servidor (SESSION_BACKEND=database)
+class ServerSession(db.Model):
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+# --- Sessões ---
+# "cookie" (padrão): cookie assinado do Flask. "database": tabela server_session do banco da aplicação.
+# "redis": REDIS_URL (requer o pacote redis). Nos dois últimos o cookie leva só o ID da sessão.
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "cookie")
+session_store = None
+if SESSION_BACKEND == "database":
+    session_store = SQLAlchemySessionStore(db, ServerSession.__table__)
+elif SESSION_BACKEND == "redis":
+    import redis
+    session_store = RedisSessionStore(redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0")))
+if session_store:
+    app.session_interface = ServerSideSessionInterface(session_store)
+
+def reset_session():
+    """
+    Esvazia a sessão e, nas sessões no servidor, troca o ID (contra fixação de sessão). Usada no login,
+    no logout e em qualquer mudança de privilégio. No cookie assinado os dados já vão no próprio cookie.
+    """
+    session.clear()
+    if session_store: app.session_interface.regenerate(session)
+
+@app.cli.command("cleanup-sessions")
+def cleanup_sessions_command():
+    """Remove as sessões expiradas do store do servidor."""
+    if not session_store:
+        print("SESSION_BACKEND=cookie: não há sessões guardadas no servidor.")
+        return
+    print(f"{session_store.cleanup_expired()} sessão(ões) expirada(s) removida(s).")
 
 # Função para criar o banco de dados e um usuário padrão
 def create_initial_data():
@@ -98,6 +320,80 @@ def init_db_command():
     create_initial_data()
     print("Banco de dados inicializado.")
 
+@app.cli.command("generate-batch")
+@click.argument("batch_file", type=click.Path(exists=True, dir_okay=False))
+@click.option("--email", required=True, help="Usuário dono das petições (os tokens são debitados dele).")
+@click.option("--agent", default=None, type=click.Choice(['simulated', 'groq_general', 'chatvolt_single', 'gemini_flow']),
+              help="Agente a usar (padrão: o selecionado pelo usuário).")
+@click.option("--output", default="peticoes_lote.zip", show_default=True, help="Arquivo ZIP com os DOCX gerados.")
+def generate_batch_command(batch_file, email, agent, output):
+    """Gera as petições de um arquivo CSV/JSON de casos (ver batch.py) e grava um ZIP com os DOCX."""
+    user = User.query.filter_by(email=email).first()
+    if not user:
+        raise click.ClickException(f"Usuário {email} não encontrado.")
+    with open(batch_file, "rb") as source:
+        records = batch_files.parse_batch_file(os.path.basename(batch_file), source.read())
+    if isinstance(records, str):
+        raise click.ClickException(records)
+    generation_batch = create_generation_batch(user, agent or user.selected_agent, os.path.basename(batch_file), records)
+    print(f"Lote {generation_batch.id}: {len(records)} caso(s), agente {generation_batch.agent}.")
+    run_generation_batch(generation_batch.id, progress_callback=lambda completed, total: print(f"  {completed}/{total} item(ns) concluído(s)"))
+    db.session.expire_all()
+    generation_batch = db.session.get(GenerationBatch, generation_batch.id)
+    summary = generation_batch.to_dict()
+    with open(output, "wb") as zip_file:
+        zip_file.write(build_generation_batch_zip(generation_batch).getvalue())
+    print(f"{summary['done']} petição(ões) gerada(s), {summary['failed']} com erro. ZIP gravado em {output}.")
+
+@app.cli.command("import-jurisprudencia")
+@click.argument("dump_file", type=click.Path(exists=True, dir_okay=False))
+def import_jurisprudencia_command(dump_file):
+    """
+    Importa ementas e metadados de julgados (.jsonl, .json ou .csv com as colunas ementa, tribunal,
+    processo, classe, relator, orgao_julgador, data_julgamento, data_publicacao e id) para a base local.
+    """
+    started_at = time.perf_counter()
+    try:
+        imported, skipped = jurisprudence_store.import_records(
+            iter_import_file(dump_file),
+            progress_callback=lambda imported, skipped: print(f"  {imported} importado(s), {skipped} ignorado(s)...")
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(f"{imported} julgado(s) importado(s) e {skipped} ignorado(s) (repetidos ou sem ementa) em {time.perf_counter() - started_at:.1f}s. "
+          f"Total na base: {jurisprudence_store.count()}.")
+
+@app.cli.command("gc-uploads")
+@click.option("--days", default=int(os.getenv("UPLOAD_RETENTION_DAYS", "90")), show_default=True,
+              help="Remove as referências de uploads sem uso há mais dias que isso (0 mantém todas).")
+def gc_uploads_command(days):
+    """Remove os arquivos enviados que não têm mais nenhuma referência de usuário."""
+    expired = 0
+    if days:
+        expired = StoredUpload.query.filter(StoredUpload.last_used_at < datetime.utcnow() - timedelta(days=days)).delete()
+        db.session.commit()
+    referenced = {sha256 for (sha256,) in db.session.execute(db.select(StoredUpload.sha256).distinct())}
+    removed, freed = upload_store.collect_garbage(referenced)
+    print(f"{expired} referência(s) expirada(s); {removed} arquivo(s) sem referência removido(s) ({freed / (1024 * 1024):.1f} MB).")
+
+@app.cli.command("cleanup-flow-checkpoints")
+@click.option("--days", default=7, show_default=True, help="Idade mínima dos checkpoints a remover.")
+def cleanup_flow_checkpoints_command(days):
+    """Remove os checkpoints do fluxo Gemini de execuções que não foram retomadas."""
+    removed = FlowCheckpoint.query.filter(FlowCheckpoint.created_at < datetime.utcnow() - timedelta(days=days)).delete()
+    db.session.commit()
+    print(f"{removed} checkpoint(s) removido(s).")
+
+@app.cli.command("refund-stale-tokens")
+@click.option("--hours", default=2, show_default=True, help="Idade mínima das reservas pendentes a estornar.")
+def refund_stale_tokens_command(hours):
+    """Estorna reservas de tokens que ficaram pendentes (ex.: worker reiniciado no meio da geração)."""
+    cutoff = datetime.utcnow() - timedelta(hours=hours)
+    stale_ids = [row.id for row in TokenLedger.query.filter(TokenLedger.status == 'reserved', TokenLedger.created_at < cutoff)]
+    for reservation_id in stale_ids:
+        settle_token_reservation(reservation_id, success=False)
+    print(f"{len(stale_ids)} reserva(s) pendente(s) estornada(s).")
+
 @app.route('/')
 def home():
     if 'user_id' in session:
@@ -155,6 +451,7 @@ def login():
         user = User.query.filter_by(email=email).first()
 
         if user and user.is_active and check_password_hash(user.password_hash, password):
+            reset_session() # Não reaproveita o ID da sessão de antes do login
             session.permanent = True
             session['user_id'] = user.id
             session['user_email'] = user.email
@@ -173,10 +470,114 @@ def login():
 
 @app.route('/logout')
 def logout():
-    session.clear() # Limpa toda a sessão
+    reset_session() # Limpa toda a sessão
     flash('Você foi desconectado.', 'info')
     return redirect(url_for('login'))
 
+# --- Usuário da Requisição ---
+# A linha do usuário é carregada no máximo uma vez por requisição (flask.g). Os campos usados
+# só para autorização (is_active/plan/selected_agent) ficam num cache do processo com TTL curto,
+# invalidado a cada escrita na tabela de usuários. A invalidação só vale para este processo: nos
+# outros workers o cache pode ficar desatualizado por até USER_CACHE_TTL_SECONDS, então o que o
+# usuário acabou de alterar (ex.: o agente selecionado) é lido do banco (current_user).
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", "30"))
+_user_identity_cache = {} # user_id -> (expira_em, {"is_active", "plan", "selected_agent"})
+_user_identity_cache_lock = threading.Lock()
+
+def remember_user_identity(user):
+    identity = {"is_active": user.is_active, "plan": user.plan, "selected_agent": user.selected_agent}
+    with _user_identity_cache_lock:
+        _user_identity_cache[user.id] = (time.time() + USER_CACHE_TTL_SECONDS, identity)
+    return identity
+
+def forget_user_identity(user_id):
+    with _user_identity_cache_lock:
+        _user_identity_cache.pop(user_id, None)
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_user_identity(mapper, connection, target):
+    forget_user_identity(target.id)
+
+def current_user():
+    """Usuário logado, carregado do banco no máximo uma vez por requisição."""
+    if 'current_user' not in g:
+        g.current_user = User.query.get(session['user_id'])
+        if g.current_user: remember_user_identity(g.current_user)
+    return g.current_user
+
+def get_user_identity(user_id):
+    if USER_CACHE_TTL_SECONDS > 0:
+        with _user_identity_cache_lock:
+            entry = _user_identity_cache.get(user_id)
+            if entry and entry[0] > time.time():
+                return entry[1]
+    user = current_user()
+    return {"is_active": user.is_active, "plan": user.plan, "selected_agent": user.selected_agent} if user else None
+
+# Contador de consultas SQL por requisição (cabeçalho X-DB-Queries) e duração de cada consulta
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_request_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+    if has_request_context():
+        g.db_query_count = g.get('db_query_count', 0) + 1
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def observe_query_duration(conn, cursor, statement, parameters, context, executemany):
+    started_at = conn.info['query_started_at'].pop()
+    metrics.db_query_seconds.observe(time.perf_counter() - started_at, statement=statement.split(None, 1)[0].upper())
+
+@app.after_request
+def add_db_query_count_header(response):
+    response.headers['X-DB-Queries'] = str(g.get('db_query_count', 0))
+    return response
+
+# --- ID da Requisição ---
+# Vai em todos os logs da requisição (inclusive das threads da geração) e volta no cabeçalho X-Request-ID.
+# Não é limpo no teardown: com stream_with_context a geração ainda loga depois dele.
+@app.before_request
+def bind_request_id():
+    request_id_var.set(request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex)
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers['X-Request-ID'] = request_id_var.get() or ''
+    return response
+
+# --- Métricas HTTP ---
+@app.before_request
+def start_request_metrics():
+    g.metrics_endpoint = request.endpoint or "desconhecido"
+    g.request_started_at = time.perf_counter()
+    metrics.http_requests_in_flight.inc(endpoint=g.metrics_endpoint)
+
+@app.after_request
+def observe_request_metrics(response):
+    # Em respostas em streaming mede até o envio dos cabeçalhos; a geração tem a sua própria métrica
+    if 'request_started_at' in g:
+        metrics.http_request_seconds.observe(time.perf_counter() - g.request_started_at, endpoint=g.metrics_endpoint,
+                                             method=request.method, status=response.status_code)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exception=None):
+    # pop: com stream_with_context o teardown pode rodar de novo ao fim do streaming
+    endpoint = g.pop('metrics_endpoint', None)
+    if endpoint:
+        metrics.http_requests_in_flight.dec(endpoint=endpoint)
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Métricas deste processo no formato de texto do Prometheus. Sem login; exige METRICS_TOKEN (Bearer), se definido."""
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return Response("Não autorizado.\n", status=401, mimetype="text/plain")
+    for stat, value in llm_cache.stats().items():
+        metrics.llm_cache_stats.set(value, stat=stat)
+    metrics.log_records_dropped.set(structured_logging.DroppingQueueHandler.dropped)
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
 from functools import wraps
 def login_required(f):
     @wraps(f)
@@ -184,9 +585,9 @@ def login_required(f):
         if 'user_id' not in session:
             flash('Você precisa estar logado para acessar esta página.', 'warning')
             return redirect(url_for('login'))
-        user = User.query.get(session['user_id'])
-        if not user or not user.is_active: # Verifica se o usuário existe e está ativo
-            session.clear()
+        identity = get_user_identity(session['user_id'])
+        if not identity or not identity["is_active"]: # Verifica se o usuário existe e está ativo
+            reset_session()
             flash('Sua sessão é inválida ou sua conta foi desativada. Por favor, faça login novamente.', 'danger')
             return redirect(url_for('login'))
         return f(*args, **kwargs)
@@ -197,7 +598,7 @@ def login_required(f):
 @app.route('/gerar-peticao')
 @login_required
 def gerar_peticao():
-    user = User.query.get(session['user_id'])
+    user = current_user()
     session['user_tokens'] = user.tokens # Sincroniza tokens na sessão
     session['user_plan'] = user.plan     # Sincroniza plano na sessão
     return render_template('index.html', user_tokens=user.tokens, current_user_plan=user.plan, current_agent=user.selected_agent)
@@ -205,15 +606,31 @@ def gerar_peticao():
 @app.route('/jurisprudencias')
 @login_required
 def jurisprudencias():
-    return render_template('jurisprudencias.html')
+    return render_template('jurisprudencias.html', total_rulings=jurisprudence_store.count())
+
+@app.route('/api/jurisprudencias')
+@login_required
+def api_jurisprudencias():
+    """Busca na base local de jurisprudência (BM25 sobre as ementas): q, tribunal, limit e offset."""
+    query = request.args.get('q', '').strip()
+    tribunal = request.args.get('tribunal', '').strip() or None
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    offset = request.args.get('offset', 0, type=int)
+    started_at = time.perf_counter()
+    try:
+        results = jurisprudence_store.search(query, limit=limit, offset=offset, tribunal=tribunal) if query else []
+    except sqlite3.Error as e:
+        app.logger.error(f"Erro na busca de jurisprudência: {e}")
+        return jsonify({"error": "A busca de jurisprudência está indisponível no momento."}), 503
+    return jsonify({"query": query, "results": results, "elapsed_ms": round((time.perf_counter() - started_at) * 1000, 2)})
 
 @app.route('/selecionar-agentes', methods=['GET', 'POST'])
 @login_required
 def selecionar_agentes():
-    user = User.query.get(session['user_id'])
     if request.method == 'POST':
         selected_agent_form = request.form.get('agent')
         if selected_agent_form in ['simulated', 'groq_general', 'chatvolt_single', 'gemini_flow']: # Adicionado gemini_flow
+            user = current_user()
             user.selected_agent = selected_agent_form
             db.session.commit()
             session['selected_agent'] = user.selected_agent
@@ -221,121 +638,776 @@ def selecionar_agentes():
         else:
             flash('Seleção de agente inválida.', 'danger')
         return redirect(url_for('selecionar_agentes'))
-    return render_template('select_agents.html', current_agent=user.selected_agent)
+    return render_template('select_agents.html', current_agent=current_user().selected_agent) # Do banco: o POST pode ter sido em outro worker
 
 # --- API para Geração de Petição ---
-@app.route('/api/generate_petition', methods=['POST'])
-@login_required
-def api_generate_petition():
-    user = User.query.get(session['user_id'])
-    if user.tokens <= 0 and user.plan == 'free': # Placeholder para lógica de plano
+def insufficient_tokens_response(user):
+    if user.plan == 'free': # Placeholder para lógica de plano
         return jsonify({"error": "Seus tokens para o plano gratuito acabaram. Considere um upgrade."}), 403
-    if user.tokens <=0: # Logica geral de tokens
-         return jsonify({"error": "Tokens insuficientes para gerar a petição."}), 403
+    return jsonify({"error": "Tokens insuficientes para gerar a petição."}), 403 # Logica geral de tokens
 
+def reserve_generation_token(user, reference):
+    """
+    Reserva 1 token com um único UPDATE condicional (tokens = tokens - 1 WHERE tokens > 0), atômico
+    mesmo com vários workers gerando para a mesma conta. Devolve (id da reserva, None) ou (None, resposta 403).
+    """
+    result = db.session.execute(
+        db.update(User).where(User.id == user.id, User.tokens > 0).values(tokens=User.tokens - 1)
+    )
+    if result.rowcount != 1:
+        db.session.rollback()
+        return None, insufficient_tokens_response(user)
+    reservation = TokenLedger(user_id=user.id, reference=reference)
+    db.session.add(reservation)
+    db.session.commit()
+    return reservation.id, None
 
-    try:
-        form_data = request.form # Sempre usar request.form para dados do formulário, request.files para arquivos
-        
-        tipo_peticao = form_data.get('tipo-peticao', '')
-        assunto_principal = form_data.get('assunto-principal', '')
-        partes_str = form_data.get('partes', '')
-        fatos_str = form_data.get('fatos', '')
-        outras_info_str = form_data.get('outras-info', '')
-
-        # Coleta dados para a IA
-        user_input_data = {
-            "tipo_peticao": tipo_peticao,
-            "assunto_principal": assunto_principal,
-            "partes_str": partes_str,
-            "fatos_str": fatos_str,
-            "outras_info_str": outras_info_str,
-            "documentos_texto": [], # Será preenchido se houver upload e processamento
-            "transcricao_audio": "" # Será preenchido se houver upload e processamento
-        }
-        
-        # Simulação de processamento de arquivos (a lógica real de extração pode ser adicionada em utils.py)
-        if 'doc-input' in request.files:
-            for file in request.files.getlist('doc-input'):
-                if file and file.filename and utils.allowed_file(file.filename, utils.ALLOWED_TEXT_EXTENSIONS):
-                    # Em uma implementação real:
-                    # content = utils.extract_text_from_file(file) # Supondo que extract_text_from_file receba o objeto do arquivo
-                    # user_input_data["documentos_texto"].append({"filename": file.filename, "content": content})
-                    user_input_data["documentos_texto"].append({"filename": file.filename, "content": f"[Conteúdo simulado do arquivo {file.filename}]"})
+def settle_token_reservation(reservation_id, success):
+    """Confirma (sucesso) ou estorna (erro) uma reserva pendente e faz o commit. Reservas já resolvidas não mudam."""
+    reservation = db.session.get(TokenLedger, reservation_id)
+    result = db.session.execute(
+        db.update(TokenLedger)
+        .where(TokenLedger.id == reservation_id, TokenLedger.status == 'reserved')
+        .values(status='committed' if success else 'refunded', settled_at=datetime.utcnow())
+    )
+    if result.rowcount == 1 and not success:
+        db.session.execute(
+            db.update(User).where(User.id == reservation.user_id).values(tokens=User.tokens + reservation.amount)
+        )
+    db.session.commit()
+
+def current_token_balance(user_id):
+    return db.session.scalar(db.select(User.tokens).where(User.id == user_id))
+
+def generate_petition_text(agent, user_input_data, progress_callback=None, plan=None, run_id=None):
+    """
+    Executa o agente selecionado e devolve o texto da petição (ou a mensagem de erro/falha).
+    Usada tanto pelo endpoint síncrono quanto pelos jobs em segundo plano; progress_callback
+    só é usado pelo fluxo Gemini, que tem várias etapas. plan (plano do usuário) limita os
+    tópicos de direito do fluxo Gemini; com run_id, as etapas do fluxo ficam em checkpoint
+    (ver flow_checkpoint_for) e uma nova tentativa com o mesmo run_id refaz só as que faltam.
+    """
+    generated_text = ""
+    if agent == 'simulated':
+        generated_text = utils.simulated_petition_generation(
+            user_input_data["tipo_peticao"], user_input_data["assunto_principal"], user_input_data["partes_str"],
+            user_input_data["fatos_str"], user_input_data["outras_info_str"]
+        )
+    elif agent == 'groq_general':
+        prompt_groq = utils.build_groq_prompt(user_input_data)
+        messages = [{"role": "user", "content": prompt_groq}]
+        api_response = utils.query_groq_api(GROQ_API_KEY, "llama3-8b-8192", messages, max_tokens=3500)
+        if not api_response.startswith("Erro"): generated_text = api_response
+        else: generated_text = f"Falha Groq: {api_response}"
+
+    elif agent == 'chatvolt_single':
+        input_text_for_chatvolt = utils.build_chatvolt_input(user_input_data)
+
+        # O prompt_chatvolt_completo é o template que você passou.
+        # A API Chatvolt pode receber o prompt_template e os dados variáveis separadamente,
+        # ou você pode formatar o prompt aqui. Para este exemplo, passamos os dados e o template.
+        # A função em utils.py fará a formatação final se necessário.
+        api_response = utils.query_chatvolt_agent_with_template(
+            api_key=CHATVOLT_API_KEY,
+            agent_id=CHATVOLT_AGENT_ID,
+            user_query_data=input_text_for_chatvolt, # Dados que preenchem o prompt
+            prompt_template=utils.CHATVOLT_FULL_PROMPT_TEMPLATE # O template de prompt extenso
+        )
+        if isinstance(api_response, dict) and api_response.get("response"):
+            generated_text = api_response["response"]
+        else:
+            generated_text = f"Falha Chatvolt: {api_response}"
+
+    elif agent == 'gemini_flow':
+        generated_text = utils.generate_petition_gemini_flow(GEMINI_API_KEY, user_input_data, progress_callback=progress_callback,
+                                                             max_topics=utils.max_law_topics_for_plan(plan),
+                                                             checkpoint=flow_checkpoint_for(run_id))
+    return generated_text
+
+# --- Checkpoints do Fluxo Gemini ---
+# Cada etapa concluída é gravada no banco (FlowCheckpoint) pelo run_id da execução. Uma execução que
+# falhou no meio vira um job com status 'error' (ver register_resumable_run), que pode ser retomado
+# por POST /api/jobs/<id>/resume pagando só as etapas que faltam.
+def flow_checkpoint_for(run_id):
+    if not run_id: return None
+    completed = {checkpoint.step: checkpoint.text for checkpoint in FlowCheckpoint.query.filter_by(run_id=run_id)}
+    if completed: app.logger.info(f"Execução {run_id}: reaproveitando {len(completed)} etapa(s) do fluxo Gemini")
+
+    def save(step, text):
+        # Chamado também pelas threads do fluxo: contexto (e sessão) próprio
+        with app.app_context():
+            try:
+                db.session.add(FlowCheckpoint(run_id=run_id, step=step[:255], text=text))
+                db.session.commit()
+            except IntegrityError: # Já gravada por outra tentativa da mesma execução
+                db.session.rollback()
+
+    return utils.GeminiFlowCheckpoint(completed, save)
+
+def discard_flow_checkpoints(run_id):
+    FlowCheckpoint.query.filter_by(run_id=run_id).delete()
+    db.session.commit()
+
+def register_resumable_run(run_id, user_id, agent, user_input_data, error):
+    """Guarda a execução que falhou com etapas em checkpoint como um job com erro, para ser retomada. Devolve o ID do job ou None."""
+    if agent != 'gemini_flow' or not FlowCheckpoint.query.filter_by(run_id=run_id).first(): return None
+    if db.session.get(GenerationJob, run_id) is None:
+        db.session.add(GenerationJob(id=run_id, user_id=user_id, agent=agent, status='error', error=error,
+                                     input_data=json.dumps(user_input_data, ensure_ascii=False)))
+        db.session.commit()
+    return run_id
+
+# --- Failover entre Agentes (ver failover.py) ---
+GENERATION_FAILOVER_ENABLED = os.getenv("GENERATION_FAILOVER_ENABLED", "0") == "1"
+GENERATION_FAILOVER_AGENTS = [agent.strip() for agent in os.getenv("GENERATION_FAILOVER_AGENTS", "groq_general,gemini_flow,chatvolt_single").split(",") if agent.strip()]
+GENERATION_LATENCY_BUDGET_SECONDS = float(os.getenv("GENERATION_LATENCY_BUDGET_SECONDS", "240"))
+GENERATION_HEDGE_DELAY_SECONDS = float(os.getenv("GENERATION_HEDGE_DELAY_SECONDS", "60")) # Até haver amostras para o p95
+GENERATION_HEDGE_MIN_SAMPLES = 20
+GENERATION_FAILOVER_ERROR_TYPES = set(os.getenv("GENERATION_FAILOVER_ERROR_TYPES", "quota,http,timeout").split(","))
+failover_executor = ThreadPoolExecutor(max_workers=int(os.getenv("GENERATION_FAILOVER_WORKERS", "8")), thread_name_prefix="generation-failover")
+
+def agent_is_configured(agent):
+    return {
+        'groq_general': bool(GROQ_API_KEY),
+        'chatvolt_single': bool(CHATVOLT_API_KEY and CHATVOLT_AGENT_ID),
+        'gemini_flow': bool(GEMINI_API_KEY),
+    }.get(agent, False)
+
+def hedge_delay_for(agent):
+    # p95 das gerações bem-sucedidas do agente neste processo; sem amostras suficientes, o atraso fixo
+    p95, samples = metrics.generation_seconds.quantile(0.95, agent=agent, mode="sync", outcome="ok")
+    if p95 is None or samples < GENERATION_HEDGE_MIN_SAMPLES:
+        return GENERATION_HEDGE_DELAY_SECONDS
+    return p95
+
+def generate_petition_text_with_failover(agent, user_input_data, plan=None, run_id=None):
+    """
+    Como generate_petition_text, com hedge/failover para os agentes de GENERATION_FAILOVER_AGENTS
+    que estiverem configurados. Devolve (agente que gerou o texto, texto).
+    """
+    alternates = [alternate for alternate in GENERATION_FAILOVER_AGENTS if alternate != agent and agent_is_configured(alternate)]
+    if not GENERATION_FAILOVER_ENABLED or agent == 'simulated' or not alternates:
+        return agent, generate_petition_text(agent, user_input_data, plan=plan, run_id=run_id)
+
+    def run_agent(attempt_agent, cancel_event):
+        def stop_if_cancelled(*progress):
+            if cancel_event.is_set(): raise GenerationCancelled()
+        started_at = time.perf_counter()
+        with app.app_context(): # Thread do failover_executor: contexto (e sessão do banco) próprio, para os checkpoints
+            text = generate_petition_text(attempt_agent, user_input_data, progress_callback=stop_if_cancelled, plan=plan, run_id=run_id)
+        if attempt_agent != agent: # A primária é medida pelo endpoint; as alternativas alimentam o p95 delas aqui
+            metrics.generation_seconds.observe(time.perf_counter() - started_at, agent=attempt_agent, mode="sync",
+                                               outcome="error" if text.startswith(("Erro", "Falha")) else "ok")
+        return text
+
+    used_agent, generated_text = hedged_generation(
+        [agent] + alternates, in_current_context(run_agent), failover_executor, hedge_delay_for,
+        GENERATION_LATENCY_BUDGET_SECONDS, GENERATION_FAILOVER_ERROR_TYPES
+    )
+    if used_agent != agent:
+        app.logger.warning(f"Petição gerada pelo agente alternativo {used_agent} (primário: {agent})")
+    return used_agent, generated_text
+
+def store_user_uploads(user_id, files, kind):
+    """Guarda os uploads no armazenamento endereçado pelo conteúdo e registra a referência do usuário a cada um. Devolve os StoredFile."""
+    stored_files = [upload_store.save(file) for file in files]
+    now = datetime.utcnow()
+    for stored_file in stored_files:
+        reference = StoredUpload.query.filter_by(user_id=user_id, sha256=stored_file.sha256).first()
+        if reference:
+            reference.filename, reference.last_used_at = stored_file.filename[:255], now
+            continue
+        try:
+            with db.session.begin_nested(): # Outra requisição do mesmo usuário pode ter registrado o mesmo arquivo
+                db.session.add(StoredUpload(user_id=user_id, sha256=stored_file.sha256, filename=stored_file.filename[:255],
+                                            size=stored_file.size, kind=kind, created_at=now, last_used_at=now))
+        except IntegrityError:
+            pass
+    db.session.commit()
+    return stored_files
+
+def collect_user_input_data(user_id):
+    """Monta o dicionário de dados do caso a partir do formulário e dos arquivos da requisição atual (guardados em nome de user_id)."""
+    form_data = request.form # Sempre usar request.form para dados do formulário, request.files para arquivos
+
+    # Coleta dados para a IA
+    user_input_data = {
+        "tipo_peticao": form_data.get('tipo-peticao', ''),
+        "assunto_principal": form_data.get('assunto-principal', ''),
+        "partes_str": form_data.get('partes', ''),
+        "fatos_str": form_data.get('fatos', ''),
+        "outras_info_str": form_data.get('outras-info', ''),
+        "documentos_texto": [], # Será preenchido se houver upload e processamento
+        "transcricao_audio": "" # Será preenchido se houver upload e processamento
+    }
+
+    # Extração do texto dos documentos anexados (txt, pdf, docx)
+    if 'doc-input' in request.files:
+        doc_files = [
+            file for file in request.files.getlist('doc-input')
+            if file and file.filename and utils.allowed_file(file.filename, utils.ALLOWED_TEXT_EXTENSIONS)
+        ]
+        if doc_files:
+            user_input_data["documentos_texto"] = utils.extract_texts_from_uploads(store_user_uploads(user_id, doc_files, 'documento'))
 
+    # Transcrição do áudio (dividido em trechos transcritos em paralelo)
+    audio_file = request.files.get('audio-input')
+    if audio_file and audio_file.filename and utils.allowed_file(audio_file.filename, utils.ALLOWED_AUDIO_EXTENSIONS):
+        transcript = utils.transcribe_audio_upload(store_user_uploads(user_id, [audio_file], 'audio')[0], GROQ_API_KEY)
+        if transcript.startswith("Erro"):
+            app.logger.warning(f"Falha na transcrição do áudio {audio_file.filename}: {transcript}")
+        else:
+            user_input_data["transcricao_audio"] = transcript
+    return user_input_data
+
+@app.route('/api/generate_petition', methods=['POST'])
+@login_required
+def api_generate_petition():
+    user = current_user()
+    petition_id = uuid.uuid4().hex
+    reservation_id, tokens_error = reserve_generation_token(user, reference=petition_id)
+    if tokens_error: return tokens_error
 
+    try:
+        user_input_data = collect_user_input_data(user.id)
         selected_agent_for_generation = user.selected_agent
-        generated_text = ""
         app.logger.info(f"Gerando petição com agente: {selected_agent_for_generation}")
 
-        if selected_agent_for_generation == 'simulated':
-            generated_text = utils.simulated_petition_generation(
-                tipo_peticao, assunto_principal, partes_str, fatos_str, outras_info_str
-            )
-        elif selected_agent_for_generation == 'groq_general':
-            prompt_groq = utils.build_groq_prompt(user_input_data)
-            messages = [{"role": "user", "content": prompt_groq}]
-            api_response = utils.query_groq_api(GROQ_API_KEY, "llama3-8b-8192", messages, max_tokens=3500)
-            if not api_response.startswith("Erro"): generated_text = api_response
-            else: generated_text = f"Falha Groq: {api_response}"
-        
-        elif selected_agent_for_generation == 'chatvolt_single':
-            # O prompt do Chatvolt é o que você forneceu, ele espera os dados brutos.
-            # Construa o input_text para o Chatvolt concatenando os dados do usuário.
-            input_text_for_chatvolt = f"Tipo de Peça: {tipo_peticao}\nAssunto Principal: {assunto_principal}\nPartes: {partes_str}\nFatos: {fatos_str}\nOutras Informações: {outras_info_str}"
-            if user_input_data["documentos_texto"]:
-                input_text_for_chatvolt += "\n\nDocumentos Anexos (Conteúdo Simulado):\n"
-                for doc in user_input_data["documentos_texto"]:
-                    input_text_for_chatvolt += f"- {doc['filename']}: {doc['content']}\n"
-            
-            # O prompt_chatvolt_completo é o template que você passou.
-            # A API Chatvolt pode receber o prompt_template e os dados variáveis separadamente,
-            # ou você pode formatar o prompt aqui. Para este exemplo, passamos os dados e o template.
-            # A função em utils.py fará a formatação final se necessário.
-            api_response = utils.query_chatvolt_agent_with_template(
-                api_key=CHATVOLT_API_KEY,
-                agent_id=CHATVOLT_AGENT_ID,
-                user_query_data=input_text_for_chatvolt, # Dados que preenchem o prompt
-                prompt_template=utils.CHATVOLT_FULL_PROMPT_TEMPLATE # O template de prompt extenso
-            )
-            if isinstance(api_response, dict) and api_response.get("response"):
-                generated_text = api_response["response"]
-            else:
-                generated_text = f"Falha Chatvolt: {api_response}"
-
-        elif selected_agent_for_generation == 'gemini_flow':
-            generated_text = utils.generate_petition_gemini_flow(GEMINI_API_KEY, user_input_data)
+        generation_started_at = time.perf_counter()
+        used_agent, generated_text = generate_petition_text_with_failover(selected_agent_for_generation, user_input_data, user.plan, run_id=petition_id)
+        outcome = "error" if generated_text.startswith(("Erro", "Falha")) else "ok" if used_agent == selected_agent_for_generation else "failover"
+        metrics.generation_seconds.observe(time.perf_counter() - generation_started_at, agent=selected_agent_for_generation,
+                                           mode="sync", outcome=outcome)
+        if used_agent == 'gemini_flow':
             if generated_text.startswith("Erro"):
                  flash(f"Ocorreu um erro durante a geração com Gemini: {generated_text}", "danger")
             else:
                  flash("Petição parcialmente ou totalmente gerada com Gemini.", "success")
 
+        petition = save_petition(user.id, used_agent, user_input_data, [generated_text], petition_id)
+        session['last_petition_id'] = petition.id if petition else None
 
-        session['last_petition_text'] = generated_text
-
-        if not generated_text.startswith("Erro"): # Só desconta token se não deu erro grave na API
-            user.tokens -= 1
-            db.session.commit()
-            session['user_tokens'] = user.tokens
+        # Só desconta token se não deu erro grave na API; senão a reserva é estornada
+        settle_token_reservation(reservation_id, success=not generated_text.startswith("Erro"))
+        if petition:
+            discard_flow_checkpoints(petition_id)
+            resumable_job_id = None
+        else: # As etapas já concluídas do fluxo Gemini ficam para a retomada
+            resumable_job_id = register_resumable_run(petition_id, user.id, used_agent, user_input_data, generated_text)
+        user_tokens = current_token_balance(user.id)
+        session['user_tokens'] = user_tokens
         
-        return jsonify({"generated_petition": generated_text, "user_tokens": user.tokens})
+        return jsonify({"generated_petition": generated_text, "user_tokens": user_tokens,
+                        "petition_id": petition.id if petition else None, "agent": used_agent,
+                        "resumable_job_id": resumable_job_id})
 
     except Exception as e:
+        db.session.rollback()
+        settle_token_reservation(reservation_id, success=False)
         app.logger.error(f"Erro crítico em /api/generate_petition: {e}")
         import traceback
         app.logger.error(traceback.format_exc())
         return jsonify({"error": "Ocorreu um erro interno ao gerar a petição.", "details": str(e)}), 500
 
+def save_petition(user_id, agent, user_input_data, pieces, petition_id=None):
+    """Grava a petição gerada (sem commit), em seções quando o agente as informa. Resultados de erro não são guardados: devolve None."""
+    if "".join(pieces).startswith("Erro"): return None
+    petition = Petition(id=petition_id or uuid.uuid4().hex, user_id=user_id, agent=agent,
+                        input_data=json.dumps(user_input_data, ensure_ascii=False),
+                        sections=json.dumps(utils.petition_sections(pieces), ensure_ascii=False))
+    db.session.add(petition)
+    return petition
+
+def iter_petition_chunks(agent, user_input_data, plan=None, run_id=None):
+    """Gera o texto da petição em pedaços, conforme o agente selecionado (usado pelo endpoint de streaming)."""
+    if agent == 'simulated':
+        yield utils.simulated_petition_generation(
+            user_input_data["tipo_peticao"], user_input_data["assunto_principal"], user_input_data["partes_str"],
+            user_input_data["fatos_str"], user_input_data["outras_info_str"]
+        )
+    elif agent == 'groq_general':
+        messages = [{"role": "user", "content": utils.build_groq_prompt(user_input_data)}]
+        for chunk in utils.stream_groq_api(GROQ_API_KEY, "llama3-8b-8192", messages, max_tokens=3500):
+            yield f"Falha Groq: {chunk}" if chunk.startswith("Erro") else chunk
+    elif agent == 'chatvolt_single':
+        for chunk in utils.stream_chatvolt_agent_with_template(
+            api_key=CHATVOLT_API_KEY,
+            agent_id=CHATVOLT_AGENT_ID,
+            user_query_data=utils.build_chatvolt_input(user_input_data),
+            prompt_template=utils.CHATVOLT_FULL_PROMPT_TEMPLATE
+        ):
+            yield f"Falha Chatvolt: {chunk}" if chunk.startswith("Erro") else chunk
+    elif agent == 'gemini_flow':
+        # Cada seção é enviada assim que termina (e as anteriores já foram enviadas)
+        yield from utils.iter_petition_gemini_flow(GEMINI_API_KEY, user_input_data, max_topics=utils.max_law_topics_for_plan(plan),
+                                                   checkpoint=flow_checkpoint_for(run_id))
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.route('/api/generate_petition/stream', methods=['POST'])
+@login_required
+def api_generate_petition_stream():
+    """
+    Variante em streaming de /api/generate_petition (server-sent events).
+    Eventos: "chunk" ({"text": ...}) para cada pedaço gerado, "done" ({"user_tokens", "error"}) no final
+    e "error" ({"error", "details"}) em caso de falha interna.
+    """
+    user = current_user()
+    # O ID é definido antes do envio dos cabeçalhos, para que o cookie de sessão já o leve;
+    # a petição só é gravada com esse ID se a geração terminar sem erro.
+    petition_id = uuid.uuid4().hex
+    reservation_id, tokens_error = reserve_generation_token(user, reference=petition_id)
+    if tokens_error: return tokens_error
+
+    # Os arquivos precisam ser lidos antes de a resposta começar a ser enviada
+    try:
+        user_input_data = collect_user_input_data(user.id)
+    except Exception:
+        settle_token_reservation(reservation_id, success=False)
+        raise
+    selected_agent_for_generation = user.selected_agent
+    user_id = user.id
+    user_plan = user.plan
+    session['last_petition_id'] = petition_id
+    app.logger.info(f"Gerando petição (streaming) com agente: {selected_agent_for_generation}")
+
+    def generate():
+        generated_pieces = []
+        failed = False
+        settled = False
+        generation_started_at = time.perf_counter()
+        yield ": inicio\n\n" # Comentário SSE para liberar o primeiro byte imediatamente
+        try:
+            try:
+                for piece in iter_petition_chunks(selected_agent_for_generation, user_input_data, user_plan, run_id=petition_id):
+                    if piece.startswith("Erro"): failed = True
+                    generated_pieces.append(piece)
+                    yield sse_event("chunk", {"text": piece})
+            except Exception as e:
+                app.logger.error(f"Erro crítico em /api/generate_petition/stream: {e}")
+                import traceback
+                app.logger.error(traceback.format_exc())
+                yield sse_event("error", {"error": "Ocorreu um erro interno ao gerar a petição.", "details": str(e)})
+                return
+
+            generated_text = "".join(generated_pieces)
+            # Obs.: o cookie de sessão já foi enviado junto com os cabeçalhos, então a sessão
+            # (user_tokens) não pode ser atualizada a partir daqui.
+            success = not failed and not generated_text.startswith("Erro") # Só desconta token se não deu erro grave na API
+            petition = save_petition(user_id, selected_agent_for_generation, user_input_data, generated_pieces, petition_id) if success else None
+            settle_token_reservation(reservation_id, success)
+            settled = True
+            if success:
+                discard_flow_checkpoints(petition_id)
+                resumable_job_id = None
+            else:
+                resumable_job_id = register_resumable_run(petition_id, user_id, selected_agent_for_generation, user_input_data,
+                                                          generated_pieces[-1] if generated_pieces else generated_text)
+            metrics.generation_seconds.observe(time.perf_counter() - generation_started_at, agent=selected_agent_for_generation,
+                                               mode="stream", outcome="ok" if success else "error")
+            yield sse_event("done", {"user_tokens": current_token_balance(user_id), "error": failed, "petition_id": petition.id if petition else None,
+                                     "resumable_job_id": resumable_job_id})
+        finally:
+            if not settled: # Erro interno ou cliente desconectado no meio da geração
+                db.session.rollback()
+                settle_token_reservation(reservation_id, success=False)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"} # Evita buffer em proxies (nginx, Render)
+    )
+
+# --- Jobs de Geração em Segundo Plano ---
+# Pool local de cada processo: o worker web só registra o job e responde na hora,
+# a chamada ao agente (que pode levar minutos) roda aqui.
+GENERATION_JOB_WORKERS = int(os.getenv("GENERATION_JOB_WORKERS", "4"))
+generation_job_executor = ThreadPoolExecutor(max_workers=GENERATION_JOB_WORKERS, thread_name_prefix="generation-job")
+
+def run_generation_job(job_id):
+    with app.app_context():
+        job = GenerationJob.query.get(job_id)
+        job.status = 'running'
+        db.session.commit()
+
+        # Um job retomado tem também as reservas (já estornadas) das tentativas anteriores
+        reservation = TokenLedger.query.filter_by(reference=job.id, status='reserved').first()
+
+        def update_progress(stage, completed_steps, total_steps):
+            job.progress = json.dumps({"etapa": stage, "etapas_concluidas": completed_steps, "total_etapas": total_steps}, ensure_ascii=False)
+            db.session.commit()
+
+        try:
+            generation_started_at = time.perf_counter()
+            user_plan = db.session.scalar(db.select(User.plan).where(User.id == job.user_id))
+            generated_text = generate_petition_text(job.agent, json.loads(job.input_data), progress_callback=update_progress, plan=user_plan, run_id=job.id)
+            metrics.generation_seconds.observe(time.perf_counter() - generation_started_at, agent=job.agent,
+                                               mode="job", outcome="error" if generated_text.startswith("Erro") else "ok")
+            job.result_text = generated_text
+            if generated_text.startswith("Erro"):
+                job.status = 'error'
+                job.error = generated_text
+            else: # Só desconta token se não deu erro grave na API
+                job.status = 'done'
+                # A petição usa o mesmo ID do job
+                save_petition(job.user_id, job.agent, json.loads(job.input_data), [generated_text], petition_id=job.id)
+                FlowCheckpoint.query.filter_by(run_id=job.id).delete()
+            db.session.commit()
+            if reservation: settle_token_reservation(reservation.id, success=job.status == 'done')
+        except Exception as e:
+            db.session.rollback()
+            if reservation: settle_token_reservation(reservation.id, success=False)
+            app.logger.error(f"Erro crítico no job de geração {job_id}: {e}")
+            import traceback
+            app.logger.error(traceback.format_exc())
+            job.status = 'error'
+            job.error = f"Ocorreu um erro interno ao gerar a petição: {e}"
+            db.session.commit()
+
+@app.route('/api/jobs', methods=['POST'])
+@login_required
+def api_submit_generation_job():
+    """Registra a geração como job e devolve o ID imediatamente (202)."""
+    user = current_user()
+    job_id = uuid.uuid4().hex
+    reservation_id, tokens_error = reserve_generation_token(user, reference=job_id)
+    if tokens_error: return tokens_error
+
+    try:
+        user_input_data = collect_user_input_data(user.id)
+    except Exception:
+        settle_token_reservation(reservation_id, success=False)
+        raise
+    job = GenerationJob(
+        id=job_id,
+        user_id=user.id,
+        agent=user.selected_agent,
+        input_data=json.dumps(user_input_data, ensure_ascii=False)
+    )
+    db.session.add(job)
+    db.session.commit()
+    generation_job_executor.submit(in_current_context(run_generation_job), job.id)
+    app.logger.info(f"Job de geração {job.id} enfileirado com agente: {job.agent}")
+    return jsonify(job.to_dict()), 202
+
+def get_user_job_or_404(job_id):
+    job = GenerationJob.query.filter_by(id=job_id, user_id=session['user_id']).first()
+    if not job:
+        return None, (jsonify({"error": "Job não encontrado."}), 404)
+    return job, None
+
+@app.route('/api/jobs/<job_id>')
+@login_required
+def api_generation_job_status(job_id):
+    job, error_response = get_user_job_or_404(job_id)
+    if error_response: return error_response
+    return jsonify(job.to_dict())
+
+@app.route('/api/jobs/<job_id>/resume', methods=['POST'])
+@login_required
+def api_resume_generation_job(job_id):
+    """
+    Retoma um job que terminou com erro (inclusive uma geração síncrona/streaming que falhou, ver
+    resumable_job_id): as etapas do fluxo Gemini já concluídas são reaproveitadas e só as que faltam são chamadas.
+    """
+    job, error_response = get_user_job_or_404(job_id)
+    if error_response: return error_response
+    if job.status != 'error':
+        return jsonify({**job.to_dict(), "error": "Só jobs que terminaram com erro podem ser retomados."}), 409
+    user = current_user()
+    reservation_id, tokens_error = reserve_generation_token(user, reference=job.id)
+    if tokens_error: return tokens_error
+    # Só um pedido de retomada passa: os demais encontram o job já fora do status 'error'
+    result = db.session.execute(
+        db.update(GenerationJob).where(GenerationJob.id == job.id, GenerationJob.status == 'error')
+        .values(status='queued', error=None, result_text=None, progress='{}')
+    )
+    db.session.commit()
+    if result.rowcount != 1:
+        settle_token_reservation(reservation_id, success=False)
+        return jsonify({"error": "O job já está sendo retomado."}), 409
+    completed_steps = FlowCheckpoint.query.filter_by(run_id=job.id).count()
+    generation_job_executor.submit(in_current_context(run_generation_job), job.id)
+    app.logger.info(f"Job de geração {job.id} retomado com {completed_steps} etapa(s) já concluída(s)")
+    db.session.refresh(job)
+    return jsonify({**job.to_dict(), "etapas_reaproveitadas": completed_steps}), 202
+
+@app.route('/api/jobs/<job_id>/result')
+@login_required
+def api_generation_job_result(job_id):
+    job, error_response = get_user_job_or_404(job_id)
+    if error_response: return error_response
+    if job.status in ('queued', 'running'):
+        return jsonify({**job.to_dict(), "error": "O job ainda não terminou."}), 409
+    user = current_user()
+    response = {**job.to_dict(), "generated_petition": job.result_text, "user_tokens": user.tokens, "petition_id": None}
+    if job.status == 'done':
+        session['last_petition_id'] = job.id
+        session['user_tokens'] = user.tokens
+        response["petition_id"] = job.id
+    return jsonify(response)
+
+# --- Geração em Lote ---
+# Cada caso único do lote é gerado uma vez (casos idênticos reaproveitam o texto) num pool próprio,
+# limitado por BATCH_MAX_PARALLEL; as chamadas aos provedores ainda passam pelo rate_limiter.
+# Cada item reserva 1 token e só o item gerado com sucesso é debitado.
+BATCH_MAX_PARALLEL = int(os.getenv("BATCH_MAX_PARALLEL", "4"))
+batch_item_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_PARALLEL, thread_name_prefix="generation-batch")
+
+def create_generation_batch(user, agent, filename, records):
+    generation_batch = GenerationBatch(
+        user_id=user.id, agent=agent, filename=filename,
+        input_data=json.dumps(records, ensure_ascii=False),
+        items=json.dumps([{"item": index + 1, "assunto_principal": record["assunto_principal"], "status": "queued",
+                           "petition_id": None, "error": None} for index, record in enumerate(records)], ensure_ascii=False)
+    )
+    db.session.add(generation_batch)
+    db.session.commit()
+    return generation_batch
+
+def run_generation_batch(batch_id, progress_callback=None):
+    """
+    Gera os itens do lote. progress_callback(itens_concluidos, total), se informado, é chamado
+    a cada caso único concluído (o progresso também fica em GenerationBatch.items).
+    """
+    with app.app_context():
+        generation_batch = db.session.get(GenerationBatch, batch_id)
+        generation_batch.status = 'running'
+        db.session.commit()
+        records = json.loads(generation_batch.input_data)
+        items = json.loads(generation_batch.items)
+        user = db.session.get(User, generation_batch.user_id)
+        reservations = {}
+        try:
+            groups = {} # Casos idênticos: chave -> índices dos itens
+            for index, record in enumerate(records):
+                groups.setdefault(batch_files.record_key(record), []).append(index)
+
+            futures = {}
+            for key, indexes in groups.items():
+                for index in indexes:
+                    reservation_id, tokens_error = reserve_generation_token(user, reference=generation_batch.id)
+                    if tokens_error:
+                        items[index].update(status='error', error="Tokens insuficientes para este item.")
+                    else:
+                        reservations[index] = reservation_id
+                if any(index in reservations for index in indexes):
+                    futures[batch_item_executor.submit(in_current_context(generate_batch_item), generation_batch.agent, records[indexes[0]], user.plan)] = key
+            generation_batch.items = json.dumps(items, ensure_ascii=False)
+            db.session.commit()
+
+            completed = sum(1 for item in items if item["status"] != 'queued')
+            for future in as_completed(futures):
+                try:
+                    generated_text = future.result()
+                except Exception as e:
+                    generated_text = f"Erro: {e}"
+                success = not is_generation_error(generated_text)
+                for index in groups[futures[future]]:
+                    if index not in reservations: continue
+                    if success:
+                        petition = save_petition(user.id, generation_batch.agent, records[index], [generated_text])
+                        items[index].update(status='done', petition_id=petition.id)
+                    else:
+                        items[index].update(status='error', error=generated_text[:1000])
+                    generation_batch.items = json.dumps(items, ensure_ascii=False)
+                    db.session.commit()
+                    settle_token_reservation(reservations.pop(index), success)
+                    completed += 1
+                if progress_callback: progress_callback(completed, len(items))
+            generation_batch.status = 'done'
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            for reservation_id in reservations.values(): # Itens que não chegaram ao fim
+                settle_token_reservation(reservation_id, success=False)
+            app.logger.error(f"Erro crítico no lote de geração {batch_id}: {e}")
+            import traceback
+            app.logger.error(traceback.format_exc())
+            generation_batch.status = 'error'
+            generation_batch.error = f"Ocorreu um erro interno ao gerar o lote: {e}"
+            db.session.commit()
+
+def generate_batch_item(agent, user_input_data, plan=None):
+    generation_started_at = time.perf_counter()
+    generated_text = generate_petition_text(agent, user_input_data, plan=plan)
+    metrics.generation_seconds.observe(time.perf_counter() - generation_started_at, agent=agent, mode="batch",
+                                       outcome="error" if is_generation_error(generated_text) else "ok")
+    return generated_text
+
+def build_generation_batch_zip(generation_batch):
+    """ZIP com o DOCX de cada item gerado e o resumo.csv de todos os itens."""
+    records = json.loads(generation_batch.input_data)
+    items = json.loads(generation_batch.items)
+    petition_ids = [item["petition_id"] for item in items if item["petition_id"]]
+    petitions = {petition.id: petition for petition in Petition.query.filter(Petition.id.in_(petition_ids))}
+    documents, summary_rows = [], []
+    for index, item in enumerate(items):
+        petition = petitions.get(item["petition_id"])
+        filename = batch_files.docx_filename(index, records[index]) if petition else ""
+        if petition: documents.append((filename, petition.text))
+        summary_rows.append({"item": item["item"], "assunto_principal": item["assunto_principal"], "status": item["status"],
+                             "arquivo": filename, "petition_id": item["petition_id"] or "", "erro": item["error"] or ""})
+    return batch_files.build_batch_zip(documents, summary_rows,
+                                       lambda text: utils.create_docx_from_text(text, title="Petição Gerada IA Jurídica"))
+
+@app.route('/api/batches', methods=['POST'])
+@login_required
+def api_submit_generation_batch():
+    """Recebe o arquivo do lote ("batch-file", .csv ou .json), registra o lote e devolve o ID imediatamente (202)."""
+    batch_file = request.files.get('batch-file')
+    if not batch_file or not batch_file.filename or not utils.allowed_file(batch_file.filename, batch_files.ALLOWED_BATCH_EXTENSIONS):
+        return jsonify({"error": "Envie um arquivo .csv ou .json com os casos do lote."}), 400
+    records = batch_files.parse_batch_file(batch_file.filename, batch_file.read())
+    if isinstance(records, str):
+        return jsonify({"error": records}), 400
+    user = current_user()
+    if current_token_balance(user.id) <= 0: return insufficient_tokens_response(user)
+    generation_batch = create_generation_batch(user, user.selected_agent, secure_filename(batch_file.filename), records)
+    generation_job_executor.submit(in_current_context(run_generation_batch), generation_batch.id)
+    app.logger.info(f"Lote de geração {generation_batch.id} enfileirado com {len(records)} caso(s), agente: {generation_batch.agent}")
+    return jsonify(generation_batch.to_dict()), 202
+
+def get_user_batch_or_404(batch_id):
+    generation_batch = GenerationBatch.query.filter_by(id=batch_id, user_id=session['user_id']).first()
+    if not generation_batch:
+        return None, (jsonify({"error": "Lote não encontrado."}), 404)
+    return generation_batch, None
+
+@app.route('/api/batches/<batch_id>')
+@login_required
+def api_generation_batch_status(batch_id):
+    generation_batch, error_response = get_user_batch_or_404(batch_id)
+    if error_response: return error_response
+    return jsonify(generation_batch.to_dict())
+
+@app.route('/api/batches/<batch_id>/download')
+@login_required
+def api_generation_batch_download(batch_id):
+    generation_batch, error_response = get_user_batch_or_404(batch_id)
+    if error_response: return error_response
+    if generation_batch.status in ('queued', 'running'):
+        return jsonify({**generation_batch.to_dict(), "error": "O lote ainda não terminou."}), 409
+    return send_file(build_generation_batch_zip(generation_batch), as_attachment=True,
+                     download_name=f"peticoes_lote_{generation_batch.id[:8]}.zip", mimetype='application/zip')
+
+@app.route('/api/cache/stats')
+@login_required
+def api_cache_stats():
+    """Contadores de acertos/faltas do cache de respostas dos modelos (neste processo)."""
+    return jsonify(llm_cache.stats())
+
+@app.route('/api/petitions')
+@login_required
+def api_petitions():
+    """Histórico das petições do usuário, da mais recente para a mais antiga (sem o texto)."""
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    offset = request.args.get('offset', 0, type=int)
+    petitions = (Petition.query.filter_by(user_id=session['user_id'])
+                 .order_by(Petition.created_at.desc()).offset(offset).limit(limit).all())
+    return jsonify({"petitions": [petition.to_dict() for petition in petitions]})
+
+def get_user_petition(petition_id):
+    if not petition_id: return None
+    return Petition.query.filter_by(id=petition_id, user_id=session['user_id']).first()
+
+@app.route('/api/petitions/<petition_id>')
+@login_required
+def api_petition(petition_id):
+    petition = get_user_petition(petition_id)
+    if not petition:
+        return jsonify({"error": "Petição não encontrada."}), 404
+    return jsonify(petition.to_dict(include_text=True))
+
+# --- Regeneração de Seções ---
+# Refaz uma seção (endereçamento/fatos, um tópico 2.x ou pedidos/encerramento) ou acrescenta um
+# tópico com uma chamada ao Gemini sobre o contexto do caso, e encaixa o resultado no documento.
+def regenerate_petition_section(petition_id, index=None, new_topic_title=None):
+    user = current_user()
+    petition = get_user_petition(petition_id)
+    if not petition:
+        return jsonify({"error": "Petição não encontrada."}), 404
+    form_data = request.get_json(silent=True) or request.form
+    instructions = (form_data.get('instrucoes') or '').strip()
+    stored_sections = petition.sections
+    sections = petition.section_list
+
+    if new_topic_title is None: # Refazer uma seção existente
+        if index is None or not 0 <= index < len(sections):
+            return jsonify({"error": "Seção não encontrada."}), 404
+        section = sections[index]
+        if section["kind"] not in ("enderecamento_fatos", "topico", "pedidos_encerramento"):
+            return jsonify({"error": "Esta parte da petição não pode ser gerada novamente (só as seções do fluxo Gemini: endereçamento/fatos, tópicos e pedidos)."}), 400
+        kind, title, current_text = section["kind"], section["title"], section["text"]
+    else: # Novo tópico, logo depois do último tópico existente
+        topic_indexes = [position for position, section in enumerate(sections) if section["kind"] == "topico"]
+        if not topic_indexes:
+            return jsonify({"error": "Esta petição não tem a seção de tópicos de direito para receber um novo tópico."}), 400
+        kind, title, current_text = "topico", utils.numbered_law_topic_title(sections, new_topic_title), None
+        index = topic_indexes[-1] + 1
+
+    reservation_id, tokens_error = reserve_generation_token(user, reference=petition.id)
+    if tokens_error: return tokens_error
+    try:
+        new_section = utils.generate_petition_section(GEMINI_API_KEY, json.loads(petition.input_data), sections, kind,
+                                                      title, current_text, instructions)
+        if new_section.startswith("Erro"):
+            settle_token_reservation(reservation_id, success=False)
+            return jsonify({"error": new_section, "user_tokens": current_token_balance(user.id)}), 502
+
+        new_section = utils.petition_sections([new_section])[0]
+        if current_text is None: sections.insert(index, new_section)
+        else: sections[index] = new_section
+        # Só grava se ninguém alterou a petição durante a geração (outra seção refeita ao mesmo tempo)
+        result = db.session.execute(
+            db.update(Petition)
+            .where(Petition.id == petition.id, Petition.sections == stored_sections)
+            .values(sections=json.dumps(sections, ensure_ascii=False))
+        )
+        db.session.commit()
+        if result.rowcount == 0:
+            settle_token_reservation(reservation_id, success=False)
+            return jsonify({"error": "A petição foi alterada durante a geração. Tente novamente."}), 409
+        settle_token_reservation(reservation_id, success=True)
+    except Exception as e:
+        db.session.rollback()
+        settle_token_reservation(reservation_id, success=False)
+        app.logger.error(f"Erro crítico ao regenerar seção da petição {petition_id}: {e}")
+        import traceback
+        app.logger.error(traceback.format_exc())
+        return jsonify({"error": "Ocorreu um erro interno ao gerar a seção.", "details": str(e)}), 500
+
+    user_tokens = current_token_balance(user.id)
+    session['user_tokens'] = user_tokens
+    return jsonify({"petition_id": petition.id, "section": {"index": index, **new_section},
+                    "generated_petition": "".join(section["text"] for section in sections), "user_tokens": user_tokens})
+
+@app.route('/api/petitions/<petition_id>/sections/<int:index>/regenerate', methods=['POST'])
+@login_required
+def api_regenerate_petition_section(petition_id, index):
+    """Refaz a seção de índice index (ver "sections" em /api/petitions/<id>); "instrucoes" orienta a nova versão."""
+    return regenerate_petition_section(petition_id, index=index)
+
+@app.route('/api/petitions/<petition_id>/sections', methods=['POST'])
+@login_required
+def api_add_petition_section(petition_id):
+    """Acrescenta um tópico de direito ("titulo", e "instrucoes" opcionais) depois do último tópico."""
+    form_data = request.get_json(silent=True) or request.form
+    title = (form_data.get('titulo') or '').strip()
+    if not title:
+        return jsonify({"error": "Informe o título do novo tópico."}), 400
+    return regenerate_petition_section(petition_id, new_topic_title=title)
+
 @app.route('/download_docx')
+@app.route('/download_docx/<petition_id>')
 @login_required
-def download_docx():
-    if 'last_petition_text' not in session or not session['last_petition_text']:
+def download_docx(petition_id=None):
+    petition = get_user_petition(petition_id or session.get('last_petition_id'))
+    if not petition:
         flash("Nenhuma petição gerada recentemente para download ou o conteúdo está vazio.", "warning")
         return redirect(url_for('gerar_peticao'))
-    petition_text = session['last_petition_text']
-    if petition_text.startswith("Erro"): # Não permite baixar se for mensagem de erro
-        flash("Não é possível baixar um resultado de erro como DOCX.", "danger")
-        return redirect(url_for('gerar_peticao'))
+    petition_text = petition.text
     try:
         docx_bytes_io = utils.create_docx_from_text(petition_text, title="Petição Gerada IA Jurídica")
         return send_file(
@@ -0,0 +1,101 @@
+import io
+import os
+import re
+import csv
+import json
+import hashlib
+import zipfile
+import unicodedata
+
+# --- Geração em Lote ---
+# Um arquivo CSV ou JSON com vários casos (uma linha/objeto por caso, com os mesmos campos do
+# formulário) vira uma lista de user_input_data. Casos idênticos são gerados uma vez só, e o
+# resultado é um ZIP com um DOCX por petição e um resumo.csv com a situação de cada item.
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "200"))
+ALLOWED_BATCH_EXTENSIONS = ["csv", "json"]
+
+# Campo de user_input_data -> nomes aceitos no arquivo (os do formulário e os internos)
+BATCH_FIELDS = {
+    "tipo_peticao": ("tipo-peticao", "tipo_peticao", "tipo"),
+    "assunto_principal": ("assunto-principal", "assunto_principal", "assunto"),
+    "partes_str": ("partes", "partes_str"),
+    "fatos_str": ("fatos", "fatos_str"),
+    "outras_info_str": ("outras-info", "outras_info", "outras_info_str"),
+}
+
+
+def record_to_input_data(record):
+    fields = {str(name).strip().lower(): value for name, value in record.items() if name is not None}
+    input_data = {}
+    for field, accepted_names in BATCH_FIELDS.items():
+        value = next((fields[name] for name in accepted_names if fields.get(name) not in (None, "")), "")
+        input_data[field] = str(value).strip()
+    input_data["documentos_texto"] = []
+    input_data["transcricao_audio"] = ""
+    return input_data
+
+
+def parse_batch_file(filename, content):
+    """
+    Lê os casos de um arquivo .csv (separador detectado: vírgula, ponto e vírgula ou tab) ou .json
+    (lista de objetos, ou {"casos": [...]}). Devolve a lista de user_input_data ou uma mensagem "Erro...".
+    """
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        text = content.decode("latin-1") # Planilhas exportadas pelo Excel em português
+    try:
+        if extension == "json":
+            data = json.loads(text)
+            raw_records = data.get("casos", []) if isinstance(data, dict) else data
+            if not isinstance(raw_records, list) or not all(isinstance(record, dict) for record in raw_records):
+                return "Erro: O JSON deve ser uma lista de objetos (um por caso)."
+        elif extension == "csv":
+            try:
+                dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+            except csv.Error: # Uma coluna só, por exemplo
+                dialect = csv.excel
+            raw_records = list(csv.DictReader(io.StringIO(text), dialect=dialect))
+        else:
+            return "Erro: Formato de arquivo não suportado. Use .csv ou .json."
+    except (ValueError, csv.Error) as e:
+        return f"Erro ao ler o arquivo {filename}: {e}"
+
+    records = [record_to_input_data(record) for record in raw_records]
+    records = [record for record in records if record["fatos_str"] or record["assunto_principal"]] # Linhas em branco
+    if not records:
+        return "Erro: Nenhum caso encontrado no arquivo (são necessárias as colunas 'assunto-principal' ou 'fatos')."
+    if len(records) > BATCH_MAX_ITEMS:
+        return f"Erro: O lote tem {len(records)} casos; o máximo é {BATCH_MAX_ITEMS}."
+    return records
+
+
+def record_key(input_data):
+    # Casos com os mesmos dados (ignorando espaços extras e maiúsculas) geram a mesma petição
+    normalized = {field: " ".join(str(value).split()).lower() for field, value in input_data.items() if isinstance(value, str)}
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def docx_filename(index, input_data):
+    subject = unicodedata.normalize("NFKD", input_data.get("assunto_principal") or "peticao").encode("ascii", "ignore").decode()
+    slug = re.sub(r"[^a-z0-9]+", "_", subject.lower()).strip("_")[:50] or "peticao"
+    return f"{index + 1:03d}_{slug}.docx"
+
+
+def build_batch_zip(documents, summary_rows, create_docx):
+    """
+    documents: [(nome do arquivo, texto)]; summary_rows: dicts do resumo.csv (um por item do lote);
+    create_docx(texto) -> BytesIO. Devolve o ZIP num BytesIO.
+    """
+    zip_bytes = io.BytesIO()
+    with zipfile.ZipFile(zip_bytes, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for filename, text in documents:
+            zip_file.writestr(filename, create_docx(text).getvalue())
+        summary = io.StringIO()
+        writer = csv.DictWriter(summary, fieldnames=["item", "assunto_principal", "status", "arquivo", "petition_id", "erro"], delimiter=";")
+        writer.writeheader()
+        writer.writerows(summary_rows)
+        zip_file.writestr("resumo.csv", "\ufeff" + summary.getvalue()) # BOM: o Excel abre com os acentos certos
+    zip_bytes.seek(0)
+    return zip_bytes
@@ -0,0 +1,131 @@
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Servidores Falsos dos Provedores ---
+# Imitam o endpoint de chat completions da Groq (com e sem streaming) e o /agents/{id}/query
+# do Chatvolt, com latência, taxa de erro e tamanho da resposta configuráveis. Servem para
+# medir o caminho da requisição no app sem depender (nem pagar) das APIs reais.
+
+LOREM_WORDS = (
+    "o autor requer a condenação do réu ao pagamento de indenização por danos morais e materiais "
+    "nos termos do artigo 186 do código civil considerando a conduta ilícita e o nexo causal demonstrado"
+).split()
+
+
+class FakeProviderConfig:
+    def __init__(self, latency_ms=500, jitter_ms=100, error_rate=0.0, output_words=400, chunk_words=20):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.output_words = output_words
+        self.chunk_words = chunk_words
+
+    def sleep(self):
+        delay_ms = max(0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms))
+        time.sleep(delay_ms / 1000)
+
+    def should_fail(self):
+        return random.random() < self.error_rate
+
+    def text(self):
+        return " ".join(LOREM_WORDS[i % len(LOREM_WORDS)] for i in range(self.output_words))
+
+    def text_chunks(self):
+        words = self.text().split()
+        for start in range(0, len(words), self.chunk_words):
+            yield " ".join(words[start:start + self.chunk_words]) + " "
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = FakeProviderConfig()
+    requests_served = 0
+    _counter_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass # Sem log por requisição: atrapalharia a medição
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_sse(self, events):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for event, data in events:
+            frame = (f"event: {event}\n" if event else "") + f"data: {data}\n\n"
+            self.wfile.write(frame.encode("utf-8"))
+            self.wfile.flush()
+        self.close_connection = True
+
+    def do_POST(self):
+        with FakeProviderHandler._counter_lock:
+            FakeProviderHandler.requests_served += 1
+        payload = self._read_json()
+        config = self.config
+        config.sleep()
+        if config.should_fail():
+            self._send_json(503, {"error": {"message": "Serviço sobrecarregado (falso)"}})
+            return
+
+        if self.path.endswith("/chat/completions"):
+            if payload.get("stream"):
+                events = [(None, json.dumps({"choices": [{"delta": {"content": chunk}}]})) for chunk in config.text_chunks()]
+                self._send_sse(events + [(None, "[DONE]")])
+            else:
+                self._send_json(200, {"choices": [{"message": {"role": "assistant", "content": config.text()}}]})
+        elif self.path.startswith("/agents/") and self.path.endswith("/query"):
+            if payload.get("streaming"):
+                events = [("answer", chunk) for chunk in config.text_chunks()]
+                events.append(("endpoint_response", json.dumps({"response": config.text()})))
+                self._send_sse(events + [(None, "[DONE]")])
+            else:
+                self._send_json(200, {"response": config.text(), "conversationId": "falso"})
+        else:
+            self._send_json(404, {"error": {"message": f"Rota desconhecida: {self.path}"}})
+
+
+def start_fake_server(port=0, config=None, host="127.0.0.1"):
+    """Sobe o servidor falso numa thread e devolve (servidor, url base). port=0 escolhe uma porta livre."""
+    handler = type("ConfiguredFakeProviderHandler", (FakeProviderHandler,), {"config": config or FakeProviderConfig()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="fake-llm-server").start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor falso das APIs Groq e Chatvolt para benchmarks.")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-ms", type=float, default=500)
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--output-words", type=int, default=400)
+    args = parser.parse_args()
+    config = FakeProviderConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.output_words)
+    server, base_url = start_fake_server(args.port, config)
+    print(f"Servidor falso em {base_url}")
+    print(f"  GROQ_API_BASE_URL={base_url}/openai/v1")
+    print(f"  CHATVOLT_API_BASE_URL={base_url}/agents")
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+from fake_llm_servers import FakeProviderConfig, start_fake_server
+
+# --- Teste de Carga ---
+# Sobe o app (gunicorn, ou o servidor do Flask) apontando para os servidores falsos da Groq e do
+# Chatvolt e para o substituto local do google.generativeai, cadastra e loga vários usuários e
+# dispara requisições concorrentes de geração, agente por agente. Relata requisições por segundo,
+# latências p50/p95/p99 e taxa de erro de cada agente.
+#
+#   python benchmarks/load_test.py --users 20 --requests 200 --concurrency 32 --workers 4
+#   python benchmarks/load_test.py --base-url http://localhost:8000   (app já em execução)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stubs")
+AGENTS = ["simulated", "groq_general", "chatvolt_single", "gemini_flow"]
+USER_PASSWORD = "benchmark123"
+TOKENS_PER_NEW_USER = 100 # Saldo inicial do cadastro (User.tokens)
+
+_thread_local = threading.local()
+
+
+def http_session():
+    # Uma sessão HTTP (com pool de conexões) por thread; os cookies de cada usuário vão por requisição
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        http = requests.Session()
+        _thread_local.http = http
+    return http
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values: return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def start_app_server(args, work_dir, provider_base_url):
+    """Inicializa o banco e sobe o app num diretório de trabalho temporário. Devolve (processo, url base)."""
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": os.pathsep.join([STUBS_DIR, REPO_DIR, env.get("PYTHONPATH", "")]),
+        "DATABASE_URL": f"sqlite:///{os.path.join(work_dir, 'benchmark.db')}",
+        "LLM_CACHE_PATH": os.path.join(work_dir, "llm_cache.db"),
+        "LLM_CACHE_ENABLED": "1" if args.with_cache else "0",
+        "RATE_LIMIT_PATH": os.path.join(work_dir, "rate_limits.db"),
+        "SECRET_KEY": "benchmark-secret-key",
+        "GROQ_API_BASE_URL": f"{provider_base_url}/openai/v1",
+        "CHATVOLT_API_BASE_URL": f"{provider_base_url}/agents",
+        "GROQ_API_KEY": "chave-falsa",
+        "CHATVOLT_API_KEY": "chave-falsa",
+        "CHATVOLT_AGENT_ID": "agente-benchmark",
+        "GEMINI_API_KEY": "chave-falsa",
+        "FAKE_GEMINI_LATENCY_MS": str(args.gemini_latency_ms),
+        "FAKE_GEMINI_JITTER_MS": str(args.gemini_latency_ms / 5),
+        "FAKE_GEMINI_ERROR_RATE": str(args.error_rate),
+    })
+    subprocess.run([sys.executable, "-m", "flask", "--app", "app", "init-db"], cwd=work_dir, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    if args.server == "gunicorn":
+        command = [sys.executable, "-m", "gunicorn", "app:app", "--workers", str(args.workers), "--threads", str(args.threads),
+                   "--bind", f"127.0.0.1:{port}", "--timeout", "300", "--log-level", "warning"]
+    else:
+        command = [sys.executable, "-m", "flask", "--app", "app", "run", "--port", str(port), "--with-threads"]
+    process = subprocess.Popen(command, cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"O servidor ({args.server}) terminou na inicialização (código {process.returncode}).")
+        try:
+            requests.get(f"{base_url}/login", timeout=1)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("O servidor não respondeu em 60s.")
+
+
+def create_users(base_url, count):
+    """Cadastra e loga os usuários do teste; devolve a lista de cookies de sessão."""
+    run_id = uuid.uuid4().hex[:8]
+    user_cookies = []
+    for index in range(count):
+        http = requests.Session()
+        email = f"bench-{run_id}-{index}@exemplo.com"
+        http.post(f"{base_url}/register", data={"name": f"Usuário {index}", "email": email,
+                                                "password": USER_PASSWORD, "confirm_password": USER_PASSWORD})
+        response = http.post(f"{base_url}/login", data={"email": email, "password": USER_PASSWORD}, allow_redirects=False)
+        if response.status_code != 302 or "session" not in http.cookies:
+            raise SystemExit(f"Falha ao logar o usuário {email} (status {response.status_code}).")
+        user_cookies.append(http.cookies.get_dict())
+    return user_cookies
+
+
+def select_agent(base_url, user_cookies, agent):
+    for cookies in user_cookies:
+        http_session().post(f"{base_url}/selecionar-agentes", data={"agent": agent}, cookies=cookies, allow_redirects=False)
+
+
+def petition_form(request_index):
+    # Fatos únicos por requisição, para que o cache de respostas não mascare o custo real
+    return {
+        "tipo-peticao": "Petição Inicial",
+        "assunto-principal": "Indenização por danos morais",
+        "partes": "Autor: João da Silva. Réu: Empresa X Ltda.",
+        "fatos": f"Cobrança indevida e negativação do nome do autor (caso {request_index}-{uuid.uuid4().hex[:6]}).",
+        "outras-info": "",
+    }
+
+
+def fire_request(base_url, endpoint, cookies, request_index):
+    """Envia uma geração e devolve (latência em segundos, sucesso, descrição do erro)."""
+    path = "/api/generate_petition/stream" if endpoint == "stream" else "/api/generate_petition"
+    started_at = time.perf_counter()
+    try:
+        response = http_session().post(f"{base_url}{path}", data=petition_form(request_index), cookies=cookies, timeout=600)
+        body = response.text
+        latency = time.perf_counter() - started_at
+        if response.status_code != 200:
+            return latency, False, f"HTTP {response.status_code}"
+        if endpoint == "stream":
+            if "event: done" not in body: return latency, False, "stream sem evento done"
+            if '"error": true' in body: return latency, False, "erro do provedor"
+            return latency, True, None
+        text = response.json().get("generated_petition") or ""
+        if text.startswith(("Erro", "Falha")): return latency, False, "erro do provedor"
+        return latency, True, None
+    except requests.RequestException as e:
+        return time.perf_counter() - started_at, False, type(e).__name__
+
+
+def run_agent(base_url, agent, user_cookies, args):
+    select_agent(base_url, user_cookies, agent)
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(
+            lambda index: fire_request(base_url, args.endpoint, user_cookies[index % len(user_cookies)], index),
+            range(args.requests)
+        ))
+    elapsed = time.perf_counter() - started_at
+    latencies = sorted(latency * 1000 for latency, ok, _ in results if ok)
+    errors = {}
+    for _, ok, error in results:
+        if not ok: errors[error] = errors.get(error, 0) + 1
+    return {
+        "agent": agent,
+        "requests": len(results),
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(results) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50), 1),
+        "p95_ms": round(percentile(latencies, 0.95), 1),
+        "p99_ms": round(percentile(latencies, 0.99), 1),
+        "error_rate": round(sum(errors.values()) / len(results), 4) if results else 0.0,
+        "errors": errors,
+    }
+
+
+def print_report(report):
+    print(f"\n{'agente':<16}{'reqs':>6}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'erros':>8}")
+    for row in report:
+        print(f"{row['agent']:<16}{row['requests']:>6}{row['rps']:>9.2f}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+              f"{row['p99_ms']:>10.1f}{row['error_rate']:>8.1%}")
+        for error, count in sorted(row["errors"].items()):
+            print(f"{'':<16}  {count}x {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga do /api/generate_petition com provedores falsos.")
+    parser.add_argument("--base-url", help="Usa um app já em execução (configurado com os servidores falsos) em vez de subir um.")
+    parser.add_argument("--server", choices=["gunicorn", "flask"], default="gunicorn")
+    parser.add_argument("--workers", type=int, default=4, help="Workers do gunicorn.")
+    parser.add_argument("--threads", type=int, default=8, help="Threads por worker do gunicorn.")
+    parser.add_argument("--agents", default=",".join(AGENTS), help="Agentes a testar, separados por vírgula.")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=100, help="Requisições por agente.")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--endpoint", choices=["sync", "stream"], default="sync")
+    parser.add_argument("--provider-latency-ms", type=float, default=500, help="Latência dos servidores falsos Groq/Chatvolt.")
+    parser.add_argument("--gemini-latency-ms", type=float, default=800, help="Latência de cada chamada do substituto do Gemini.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fração de chamadas aos provedores que falham.")
+    parser.add_argument("--output-words", type=int, default=400)
+    parser.add_argument("--with-cache", action="store_true", help="Mantém o cache de respostas dos modelos ligado.")
+    parser.add_argument("--json", help="Grava o relatório em JSON neste arquivo.")
+    args = parser.parse_args()
+
+    agents = [agent.strip() for agent in args.agents.split(",") if agent.strip()]
+    if args.users * TOKENS_PER_NEW_USER < args.requests * len(agents):
+        print(f"ATENÇÃO: {args.users} usuários com {TOKENS_PER_NEW_USER} tokens não cobrem {args.requests * len(agents)} gerações; espere erros 403.")
+
+    provider_config = FakeProviderConfig(args.provider_latency_ms, args.provider_latency_ms / 5, args.error_rate, args.output_words)
+    fake_server, provider_base_url = start_fake_server(config=provider_config)
+    process, work_dir = None, None
+    try:
+        if args.base_url:
+            base_url = args.base_url.rstrip("/")
+        else:
+            work_dir = tempfile.mkdtemp(prefix="benchmark_")
+            process, base_url = start_app_server(args, work_dir, provider_base_url)
+        print(f"App em {base_url}; provedores falsos em {provider_base_url}")
+        user_cookies = create_users(base_url, args.users)
+        report = [run_agent(base_url, agent, user_cookies, args) for agent in agents]
+        print_report(report)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as report_file:
+                json.dump({"config": vars(args), "results": report}, report_file, ensure_ascii=False, indent=2)
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=30)
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        fake_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
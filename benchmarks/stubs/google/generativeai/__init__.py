@@ -0,0 +1,70 @@
+"""
+Substituto local de google.generativeai para benchmarks: mesma interface usada pelo app
+(configure, GenerativeModel, types.GenerationConfig, caching), sem rede. Ativado colocando
+benchmarks/stubs no início do PYTHONPATH. Latência, taxa de erro e tamanho da resposta vêm de
+FAKE_GEMINI_LATENCY_MS, FAKE_GEMINI_ERROR_RATE e FAKE_GEMINI_OUTPUT_WORDS.
+"""
+import os
+import json
+import time
+import random
+from types import SimpleNamespace
+
+FAKE_GEMINI_LATENCY_MS = float(os.getenv("FAKE_GEMINI_LATENCY_MS", "800"))
+FAKE_GEMINI_JITTER_MS = float(os.getenv("FAKE_GEMINI_JITTER_MS", "200"))
+FAKE_GEMINI_ERROR_RATE = float(os.getenv("FAKE_GEMINI_ERROR_RATE", "0"))
+FAKE_GEMINI_OUTPUT_WORDS = int(os.getenv("FAKE_GEMINI_OUTPUT_WORDS", "300"))
+
+_WORDS = "a parte autora demonstra o direito invocado conforme a legislação e a jurisprudência aplicáveis ao caso".split()
+
+
+class GenerationConfig:
+    def __init__(self, max_output_tokens=None, temperature=None, response_mime_type=None, response_schema=None, **kwargs):
+        self.max_output_tokens = max_output_tokens
+        self.temperature = temperature
+        self.response_mime_type = response_mime_type
+        self.response_schema = response_schema
+
+
+types = SimpleNamespace(GenerationConfig=GenerationConfig)
+
+
+def configure(api_key=None, **kwargs):
+    pass
+
+
+_PLAN_TOPICS = ["2.1 DA RESPONSABILIDADE CIVIL", "2.2 DOS DANOS MORAIS", "2.3 DA TUTELA DE URGÊNCIA"]
+
+
+def _fake_text(prompt_text, json_output=False):
+    if "Crie um plano" in prompt_text: # Etapa de planejamento do fluxo: lista de tópicos (JSON, se pedido)
+        return json.dumps({"topicos": _PLAN_TOPICS}, ensure_ascii=False) if json_output else "\n".join(_PLAN_TOPICS)
+    return " ".join(_WORDS[i % len(_WORDS)] for i in range(FAKE_GEMINI_OUTPUT_WORDS))
+
+
+class GenerativeModel:
+    def __init__(self, model_name="gemini-2.0-flash", generation_config=None, safety_settings=None, system_instruction=None, **kwargs):
+        self.model_name = model_name
+        self.system_instruction = system_instruction or ""
+
+    @classmethod
+    def from_cached_content(cls, cached_content, **kwargs):
+        return cls(cached_content.model, system_instruction=cached_content.system_instruction)
+
+    def generate_content(self, contents, generation_config=None, **kwargs):
+        delay_ms = max(0, FAKE_GEMINI_LATENCY_MS + random.uniform(-FAKE_GEMINI_JITTER_MS, FAKE_GEMINI_JITTER_MS))
+        time.sleep(delay_ms / 1000)
+        if random.random() < FAKE_GEMINI_ERROR_RATE:
+            raise RuntimeError("429 Resource exhausted (falso)")
+        prompt_text = contents if isinstance(contents, str) else str(contents)
+        text = _fake_text(prompt_text, getattr(generation_config, "response_mime_type", None) == "application/json")
+        return SimpleNamespace(
+            text=text,
+            parts=[SimpleNamespace(text=text)],
+            prompt_feedback=None,
+            usage_metadata=SimpleNamespace(
+                prompt_token_count=(len(self.system_instruction) + len(prompt_text)) // 4,
+                cached_content_token_count=0,
+                candidates_token_count=len(text) // 4,
+            ),
+        )
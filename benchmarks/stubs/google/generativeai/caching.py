@@ -0,0 +1,17 @@
+import uuid
+
+
+class CachedContent:
+    """Cache de contexto falso: só guarda o modelo e a system instruction."""
+
+    def __init__(self, model, system_instruction):
+        self.name = f"cachedContents/{uuid.uuid4().hex}"
+        self.model = model.removeprefix("models/")
+        self.system_instruction = system_instruction
+
+    @classmethod
+    def create(cls, model, system_instruction=None, ttl=None, **kwargs):
+        return cls(model, system_instruction or "")
+
+    def delete(self):
+        pass
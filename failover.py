@@ -0,0 +1,71 @@
+import time
+import threading
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import metrics
+
+# --- Hedge e Failover entre Provedores ---
+# A geração começa no agente escolhido pelo usuário. Se ele não responder dentro do atraso de
+# hedge (p95 observado do agente), um agente alternativo é acionado em paralelo; se falhar com um
+# erro de cota/HTTP/timeout, o alternativo é acionado na hora. Vence a primeira resposta sem erro
+# dentro do orçamento total de latência; as perdedoras recebem o sinal de cancelamento.
+
+
+class GenerationCancelled(Exception):
+    """Levantada dentro de uma tentativa cujo resultado não é mais necessário."""
+
+
+def is_generation_error(text):
+    return not text or text.startswith(("Erro", "Falha"))
+
+
+def hedged_generation(agents, run_agent, executor, hedge_delay_for, latency_budget, failover_error_types):
+    """
+    agents: [agente primário, alternativos...]; run_agent(agente, cancel_event) -> texto.
+    hedge_delay_for(agente) -> segundos até acionar o próximo agente se este ainda não respondeu.
+    Devolve (agente, texto): a primeira resposta sem erro, ou o primeiro erro se todos falharem.
+
+    O cancelamento é cooperativo: a tentativa perdedora para na próxima etapa que verificar o
+    cancel_event (fluxo Gemini); uma chamada HTTP única já enviada roda até o fim e é descartada.
+    """
+    primary = agents[0]
+    remaining = list(agents)
+    attempts = {} # future -> (agente, cancel_event)
+    first_error = None
+    deadline = time.monotonic() + latency_budget
+
+    def launch(reason=None):
+        agent = remaining.pop(0)
+        cancel_event = threading.Event()
+        attempts[executor.submit(run_agent, agent, cancel_event)] = (agent, cancel_event)
+        if reason: metrics.generation_hedges.inc(primary=primary, alternate=agent, reason=reason)
+        return time.monotonic() + hedge_delay_for(agent)
+
+    next_hedge_at = launch()
+    try:
+        while attempts:
+            now = time.monotonic()
+            if now >= deadline: break
+            wake_at = min(deadline, next_hedge_at) if remaining else deadline
+            done, _ = wait(attempts, timeout=max(0, wake_at - now), return_when=FIRST_COMPLETED)
+            for future in done:
+                agent, _ = attempts.pop(future)
+                try:
+                    text = future.result()
+                except GenerationCancelled:
+                    continue
+                except Exception as e:
+                    text = f"Erro: {e}"
+                if not is_generation_error(text):
+                    metrics.generation_winners.inc(primary=primary, winner=agent)
+                    return agent, text
+                first_error = first_error or (agent, text)
+                if remaining and metrics.classify_error(text) in failover_error_types:
+                    next_hedge_at = launch("erro")
+            if remaining and time.monotonic() >= next_hedge_at:
+                next_hedge_at = launch("lentidao")
+        if first_error: return first_error
+        return primary, f"Erro: A geração não terminou dentro do limite de {latency_budget:.0f}s."
+    finally:
+        for _, cancel_event in attempts.values(): # Perdedoras (ou tudo, se o orçamento estourou)
+            cancel_event.set()
@@ -0,0 +1,297 @@
+import os
+import re
+import csv
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+import unicodedata
+
+from prompt_budget import STOPWORDS
+
+logger = logging.getLogger(__name__)
+
+# --- Base Local de Jurisprudência ---
+# Ementas e metadados dos julgados num SQLite próprio, com índice de texto completo FTS5
+# (ranking BM25, sem acentos) sobre a ementa. O mesmo arquivo serve a busca da página
+# /jurisprudencias e a recuperação das ementas reais que vão nos prompts dos tópicos de direito.
+#
+# Um OR de termos comuns ("dano", "moral") casa com boa parte da base e o BM25 teria de pontuar
+# todos esses julgados. Por isso a busca tenta primeiro todos os termos juntos (AND, que o FTS5
+# resolve saltando pelas listas) e só completa com um OR dos termos mais seletivos, até um
+# orçamento de ocorrências (JURISPRUDENCE_CANDIDATE_BUDGET), usando a frequência de cada termo
+# calculada na importação. Cada termo casa também com o seu singular/plural ("danos morais" acha
+# "dano moral"), entre as formas que existem no índice.
+JURISPRUDENCE_DB_PATH = os.getenv("JURISPRUDENCE_DB_PATH", "jurisprudencia.db")
+JURISPRUDENCE_TOP_K = int(os.getenv("JURISPRUDENCE_TOP_K", "3")) # Ementas por tópico de direito
+JURISPRUDENCE_MAX_EMENTA_CHARS = int(os.getenv("JURISPRUDENCE_MAX_EMENTA_CHARS", "1500")) # Corte de cada ementa no prompt
+JURISPRUDENCE_CANDIDATE_BUDGET = int(os.getenv("JURISPRUDENCE_CANDIDATE_BUDGET", "60000"))
+IMPORT_BATCH_SIZE = 5000
+SNIPPET_WORDS = 48
+HIGHLIGHT_START, HIGHLIGHT_END = "\x02", "\x03" # Marcadores dos termos encontrados no trecho
+
+# Campo da tabela -> nomes aceitos nos arquivos de importação
+IMPORT_FIELDS = {
+    "ementa": ("ementa", "texto_ementa", "ementa_texto"),
+    "tribunal": ("tribunal", "sigla_tribunal", "orgao"),
+    "processo": ("processo", "numero", "numero_processo", "num_processo"),
+    "classe": ("classe", "classe_processual", "sigla_classe"),
+    "relator": ("relator", "ministro_relator", "nome_relator"),
+    "orgao_julgador": ("orgao_julgador", "turma", "orgao_julgador_nome"),
+    "data_julgamento": ("data_julgamento", "julgamento", "dt_julgamento"),
+    "data_publicacao": ("data_publicacao", "publicacao", "dt_publicacao", "dje"),
+    "fonte_id": ("id", "fonte_id", "identificador"),
+}
+
+# Terminação do plural -> terminações do singular (já sem acentos, da mais longa para a mais curta)
+PLURAL_ENDINGS = (
+    ("oes", ("ao",)), ("aes", ("ao",)), ("aos", ("ao",)),
+    ("ais", ("al",)), ("eis", ("el", "il")), ("ois", ("ol",)), ("uis", ("ul",)), ("is", ("il",)),
+    ("res", ("r",)), ("zes", ("z",)), ("ses", ("s",)), ("ns", ("m",)), ("s", ("",)),
+)
+
+
+def normalize_term(word):
+    # Mesma normalização do tokenizador (unicode61 remove_diacritics 2): minúsculas e sem acentos
+    return "".join(char for char in unicodedata.normalize("NFKD", word.lower()) if not unicodedata.combining(char))
+
+
+def query_terms(text):
+    """Termos relevantes da consulta em texto livre, normalizados e sem repetição (no máximo 32)."""
+    terms = [normalize_term(term) for term in re.findall(r"\w+", text) if len(term) > 2 and term.lower() not in STOPWORDS and not term.isdigit()]
+    return list(dict.fromkeys(terms))[:32]
+
+
+def term_variants(term):
+    """O termo normalizado e as suas formas de singular e plural pelas regras do português, começando pelo próprio termo."""
+    singulars = []
+    for plural_ending, singular_endings in PLURAL_ENDINGS:
+        if term.endswith(plural_ending) and len(term) - len(plural_ending) >= 2:
+            singulars = [term[:-len(plural_ending)] + ending for ending in singular_endings]
+            break
+    variants = [term] + singulars
+    for singular in singulars or [term]: # Plurais do singular (o termo já no plural não é pluralizado de novo)
+        for plural_ending, singular_endings in PLURAL_ENDINGS:
+            for ending in singular_endings:
+                if ending and singular.endswith(ending):
+                    variants.append(singular[:-len(ending)] + plural_ending)
+        if singular[-1] in "aeiou": variants.append(singular + "s")
+    return list(dict.fromkeys(variants))
+
+
+def fts5_any(terms):
+    # Um termo entre aspas ou o OR das suas formas entre parênteses
+    if len(terms) == 1: return fts5_string(terms[0])
+    return "(" + " OR ".join(map(fts5_string, terms)) + ")"
+
+
+def fts5_string(text):
+    # Literal entre aspas na sintaxe do MATCH do FTS5: aspas internas são dobradas
+    return '"' + text.replace('"', '""') + '"'
+
+
+def highlight_snippet(ementa, terms, size=SNIPPET_WORDS):
+    """Trecho de até size palavras da ementa com mais termos da consulta, com os termos entre HIGHLIGHT_START/END."""
+    words = ementa.split()
+    hits = [normalize_term(re.sub(r"\W", "", word)) in terms for word in words]
+    best_start = max(range(max(1, len(words) - size + 1)), key=lambda start: sum(hits[start:start + size]))
+    snippet = " ".join(f"{HIGHLIGHT_START}{word}{HIGHLIGHT_END}" if hit else word
+                       for word, hit in zip(words[best_start:best_start + size], hits[best_start:best_start + size]))
+    return ("… " if best_start else "") + snippet + (" …" if best_start + size < len(words) else "")
+
+
+def format_citation(ruling):
+    # (REsp n. 1.733.136/RO, relator Ministro Paulo de Tarso Sanseverino, Terceira Turma, julgado em 21/9/2021, DJe de 24/9/2021.)
+    parts = [" ".join(part for part in (ruling.get("classe"), ruling.get("processo")) if part) or ruling.get("tribunal") or "Julgado"]
+    if ruling.get("relator"): parts.append(f"relator {ruling['relator']}")
+    if ruling.get("orgao_julgador"): parts.append(ruling["orgao_julgador"])
+    if ruling.get("data_julgamento"): parts.append(f"julgado em {ruling['data_julgamento']}")
+    if ruling.get("data_publicacao"): parts.append(f"DJe de {ruling['data_publicacao']}")
+    citation = ", ".join(parts)
+    if ruling.get("tribunal") and ruling["tribunal"] not in citation: citation = f"{ruling['tribunal']}, {citation}"
+    return f"({citation}.)"
+
+
+class JurisprudenceStore:
+    def __init__(self, db_path, candidate_budget=JURISPRUDENCE_CANDIDATE_BUDGET):
+        self.db_path = db_path
+        self.candidate_budget = candidate_budget
+        self._local = threading.local() # Uma conexão SQLite por thread
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS jurisprudencia (
+                id INTEGER PRIMARY KEY, fonte_id TEXT UNIQUE NOT NULL, tribunal TEXT, processo TEXT, classe TEXT,
+                relator TEXT, orgao_julgador TEXT, data_julgamento TEXT, data_publicacao TEXT, ementa TEXT NOT NULL)""")
+            # Índice com conteúdo externo (o texto fica só na tabela jurisprudencia); tribunal entra só para o filtro
+            conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS jurisprudencia_fts USING fts5(
+                ementa, tribunal, content='jurisprudencia', content_rowid='id', tokenize='unicode61 remove_diacritics 2')""")
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS jurisprudencia_vocab USING fts5vocab(jurisprudencia_fts, 'row')")
+            # Em quantos julgados aparece cada termo (recalculado ao fim de cada importação)
+            conn.execute("CREATE TABLE IF NOT EXISTS jurisprudencia_termos (term TEXT PRIMARY KEY, docs INTEGER NOT NULL) WITHOUT ROWID")
+            self._local.conn = conn
+        return conn
+
+    def count(self):
+        try:
+            return self._connection().execute("SELECT COUNT(*) FROM jurisprudencia").fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+    def _ranked_ids(self, match, tribunal, limit):
+        if tribunal: match = f"({match}) AND tribunal : {fts5_string(normalize_term(tribunal))}"
+        return self._connection().execute(
+            "SELECT rowid, bm25(jurisprudencia_fts, 1.0, 0.0) AS score FROM jurisprudencia_fts "
+            "WHERE jurisprudencia_fts MATCH ? ORDER BY score LIMIT ?", (match, limit)
+        ).fetchall()
+
+    def _term_frequencies(self, terms):
+        return {row["term"]: row["docs"] for row in self._connection().execute(
+            f"SELECT term, docs FROM jurisprudencia_termos WHERE term IN ({','.join('?' * len(terms))})", terms)}
+
+    def _term_groups(self, terms):
+        # Cada termo da consulta com as formas (singular/plural) que existem no índice: [(formas, julgados)]
+        variants = {term: term_variants(term) for term in terms}
+        frequencies = self._term_frequencies(list({form for forms in variants.values() for form in forms}))
+        groups = {}
+        for term in terms:
+            forms = tuple(form for form in variants[term] if form in frequencies) or (term,)
+            groups.setdefault(forms, sum(frequencies.get(form, 0) for form in forms)) # "dano" e "danos" viram o mesmo grupo
+        return list(groups.items())
+
+    def _selective_groups(self, groups):
+        # Do grupo mais raro ao mais comum, enquanto a soma das ocorrências couber no orçamento
+        selected, postings = [], 0
+        for forms, docs in sorted((group for group in groups if group[1]), key=lambda group: group[1]):
+            if selected and postings + docs > self.candidate_budget: break
+            selected.append(forms)
+            postings += docs
+        return selected
+
+    def search(self, query, limit=10, offset=0, tribunal=None):
+        """Julgados mais relevantes (BM25) para o texto livre query: lista de dicts com a ementa, a citação e um trecho destacado."""
+        terms = query_terms(query)
+        if not terms: return []
+        groups = self._term_groups(terms)
+        wanted = limit + offset
+        ranked = self._ranked_ids("ementa : (" + " AND ".join(fts5_any(forms) for forms, docs in groups) + ")", tribunal, wanted)
+        if len(ranked) < wanted and len(groups) > 1:
+            selective = self._selective_groups(groups)
+            if selective:
+                seen = {row["rowid"] for row in ranked}
+                ranked += [row for row in self._ranked_ids("ementa : (" + " OR ".join(map(fts5_any, selective)) + ")", tribunal, wanted)
+                           if row["rowid"] not in seen]
+        ranked = ranked[offset:wanted]
+        if not ranked: return []
+        rows = {row["id"]: dict(row) for row in self._connection().execute(
+            f"SELECT * FROM jurisprudencia WHERE id IN ({','.join('?' * len(ranked))})", [row["rowid"] for row in ranked])}
+        rulings = []
+        for row in ranked:
+            ruling = rows[row["rowid"]]
+            ruling["score"] = row["score"]
+            ruling["citacao"] = format_citation(ruling)
+            ruling["trecho"] = highlight_snippet(ruling["ementa"], {form for forms, docs in groups for form in forms})
+            rulings.append(ruling)
+        return rulings
+
+    def import_records(self, records, progress_callback=None):
+        """Importa dicts de julgados (ver IMPORT_FIELDS); julgados já importados (mesmo fonte_id) são ignorados. Devolve (importados, ignorados)."""
+        conn = self._connection()
+        imported, skipped, batch = 0, 0, []
+
+        def flush():
+            nonlocal imported, skipped
+            with conn: # Uma transação por lote
+                for ruling in batch:
+                    cursor = conn.execute(
+                        "INSERT OR IGNORE INTO jurisprudencia (fonte_id, tribunal, processo, classe, relator, orgao_julgador, "
+                        "data_julgamento, data_publicacao, ementa) VALUES (:fonte_id, :tribunal, :processo, :classe, :relator, "
+                        ":orgao_julgador, :data_julgamento, :data_publicacao, :ementa)", ruling)
+                    if cursor.rowcount:
+                        conn.execute("INSERT INTO jurisprudencia_fts (rowid, ementa, tribunal) VALUES (?, ?, ?)",
+                                     (cursor.lastrowid, ruling["ementa"], ruling["tribunal"]))
+                        imported += 1
+                    else:
+                        skipped += 1
+            batch.clear()
+            if progress_callback: progress_callback(imported, skipped)
+
+        for record in records:
+            ruling = normalize_record(record)
+            if ruling is None:
+                skipped += 1
+                continue
+            batch.append(ruling)
+            if len(batch) >= IMPORT_BATCH_SIZE: flush()
+        flush()
+        with conn:
+            conn.execute("INSERT INTO jurisprudencia_fts (jurisprudencia_fts) VALUES ('optimize')") # Junta os segmentos do índice
+            conn.execute("DELETE FROM jurisprudencia_termos")
+            conn.execute("INSERT INTO jurisprudencia_termos (term, docs) SELECT term, doc FROM jurisprudencia_vocab")
+        return imported, skipped
+
+
+def normalize_record(record):
+    fields = {str(name).strip().lower(): value for name, value in record.items() if name is not None}
+    ruling = {}
+    for field, accepted_names in IMPORT_FIELDS.items():
+        value = next((fields[name] for name in accepted_names if fields.get(name) not in (None, "")), None)
+        ruling[field] = " ".join(str(value).split()) if value is not None else None
+    if not ruling["ementa"]: return None
+    if ruling["tribunal"]: ruling["tribunal"] = ruling["tribunal"].upper()
+    if not ruling["fonte_id"]: # Sem identificador na fonte: tribunal + processo + ementa
+        ruling["fonte_id"] = hashlib.sha1("|".join([ruling["tribunal"] or "", ruling["processo"] or "", ruling["ementa"]]).encode("utf-8")).hexdigest()
+    return ruling
+
+
+def iter_import_file(path):
+    """Julgados de um arquivo .jsonl (um objeto por linha), .json (lista de objetos) ou .csv (separador detectado)."""
+    extension = path.rsplit('.', 1)[-1].lower()
+    if extension in ("jsonl", "ndjson"):
+        with open(path, encoding="utf-8-sig") as source:
+            for line in source:
+                if line.strip(): yield json.loads(line)
+    elif extension == "json":
+        with open(path, encoding="utf-8-sig") as source:
+            data = json.load(source)
+        yield from (data.get("julgados", []) if isinstance(data, dict) else data)
+    elif extension == "csv":
+        csv.field_size_limit(10 * 1024 * 1024) # Ementas longas
+        with open(path, encoding="utf-8-sig", newline="") as source:
+            sample = source.read(65536)
+            source.seek(0)
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+            except csv.Error:
+                dialect = csv.excel
+            yield from csv.DictReader(source, dialect=dialect)
+    else:
+        raise ValueError(f"Formato não suportado: .{extension} (use .jsonl, .json ou .csv)")
+
+
+jurisprudence_store = JurisprudenceStore(JURISPRUDENCE_DB_PATH)
+
+
+def jurisprudence_for_topic(topic_title, case_terms="", top_k=JURISPRUDENCE_TOP_K):
+    """
+    Bloco de prompt com as top_k ementas reais mais relevantes para o tópico (título + termos do caso),
+    ou "" se a base estiver vazia/indisponível ou nada for encontrado.
+    """
+    try:
+        rulings = jurisprudence_store.search(f"{topic_title} {case_terms}", limit=top_k)
+    except sqlite3.Error as e:
+        logger.warning(f"Busca de jurisprudência indisponível: {e}")
+        return ""
+    if not rulings: return ""
+    lines = ["Jurisprudência disponível na base local (use SOMENTE estes julgados; cite literalmente a ementa escolhida, "
+             "em CAIXA ALTA, seguida da referência exatamente como está; não cite julgados que não estejam nesta lista):"]
+    for number, ruling in enumerate(rulings, start=1):
+        ementa = ruling["ementa"]
+        if len(ementa) > JURISPRUDENCE_MAX_EMENTA_CHARS: ementa = ementa[:JURISPRUDENCE_MAX_EMENTA_CHARS].rsplit(" ", 1)[0] + "..."
+        lines.append(f"[{number}] {ementa}\n{ruling['citacao']}")
+    return "\n\n".join(lines)
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+# --- Cache de Respostas (endereçado por conteúdo) ---
+# Duas camadas: LRU em memória (por processo, com TTL) e SQLite em disco, compartilhado
+# entre os workers do gunicorn. A chave é o SHA-256 dos parâmetros da chamada.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.db")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "256"))
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+
+
+def make_cache_key(*parts):
+    """SHA-256 de uma representação JSON estável das partes (modelo, prompt, parâmetros...)."""
+    serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, db_path, max_entries=256, ttl_seconds=86400, enabled=True):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self._memory = OrderedDict() # chave -> (expira_em, valor)
+        self._lock = threading.Lock()
+        self._local = threading.local() # Uma conexão SQLite por thread
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "sets": 0, "evictions": 0, "disk_errors": 0}
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _remember(self, key, expires_at, value):
+        with self._lock:
+            self._memory[key] = (expires_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def get(self, key):
+        """Devolve o valor em cache ou None."""
+        if not self.enabled: return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                    return entry[1]
+                del self._memory[key]
+
+        try:
+            row = self._connection().execute("SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            self._count("disk_errors") # O cache nunca pode derrubar a geração
+            row = None
+        if row and row[1] > now:
+            value = json.loads(row[0])
+            self._remember(key, row[1], value)
+            self._count("disk_hits")
+            return value
+        self._count("misses")
+        return None
+
+    def set(self, key, value):
+        if not self.enabled: return
+        expires_at = time.time() + self.ttl_seconds
+        self._remember(key, expires_at, value)
+        self._count("sets")
+        try:
+            conn = self._connection()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                             (key, json.dumps(value, ensure_ascii=False), expires_at))
+                # Limpeza das entradas expiradas de tempos em tempos
+                if self._counters["sets"] % 100 == 0:
+                    conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+        except sqlite3.Error:
+            self._count("disk_errors")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+llm_cache = ResponseCache(LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS, LLM_CACHE_ENABLED)
+
+
+def is_cacheable_response(response):
+    # Mensagens de erro ("Erro...") nunca vão para o cache
+    if isinstance(response, str):
+        return bool(response) and not response.startswith("Erro")
+    if isinstance(response, dict):
+        return bool(response.get("response"))
+    return False
+
+
+def cached_call(key_parts, call, cache=None):
+    """Executa call() só se não houver resposta em cache para key_parts."""
+    cache = cache or llm_cache
+    key = make_cache_key(*key_parts)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    response = call()
+    if is_cacheable_response(response):
+        cache.set(key, response)
+    return response
+
+
+def cached_stream(key_parts, stream_call, cache=None):
+    """
+    Versão para geradores de texto: num acerto gera o texto inteiro de uma vez;
+    numa falta repassa os pedaços e guarda o texto completo se nenhum pedaço for erro.
+    """
+    cache = cache or llm_cache
+    key = make_cache_key(*key_parts)
+    cached = cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+    pieces = []
+    failed = False
+    for piece in stream_call():
+        if piece.startswith("Erro"): failed = True
+        pieces.append(piece)
+        yield piece
+    full_text = "".join(pieces)
+    if not failed and is_cacheable_response(full_text):
+        cache.set(key, full_text)
@@ -0,0 +1,232 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# --- Métricas (formato de texto do Prometheus) ---
+# Contadores, gauges e histogramas com rótulos, em memória e por processo (cada worker do
+# gunicorn expõe os seus; o Prometheus agrega pelo rótulo de instância). Cada observação custa
+# um lock e uma atualização de dicionário no caminho da requisição.
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+SIZE_BUCKETS = (100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000)
+
+_registry = []
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs: return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"): return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    type_name = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labelvalues, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0] # contagens por faixa, soma, total
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def quantile(self, fraction, **labels):
+        """
+        Estimativa do quantil pelas faixas (limite superior da faixa que o contém) e o total de
+        observações: (valor, total). Valor None sem observações ou acima da última faixa.
+        """
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            if state is None: return None, 0
+            bucket_counts, count = list(state[0]), state[2]
+        cumulative = 0
+        for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            if cumulative >= fraction * count:
+                return upper_bound, count
+        return None, count
+
+    @contextmanager
+    def time(self, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            items = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self._values.items())
+        for labelvalues, (bucket_counts, total_sum, count) in items:
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts + [count - sum(bucket_counts)]):
+                cumulative += bucket_count
+                le = _format_labels(self.labelnames, labelvalues, [("le", _format_value(float(upper_bound)))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total_sum)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render_prometheus():
+    """Todas as métricas registradas no formato de exposição de texto do Prometheus."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Métricas da aplicação ---
+http_requests_in_flight = Gauge("exordial_http_requests_in_flight", "Requisições HTTP em andamento.", ["endpoint"])
+http_request_seconds = Histogram("exordial_http_request_seconds", "Duração das requisições HTTP.", ["endpoint", "method", "status"])
+generation_seconds = Histogram("exordial_generation_seconds", "Duração da geração completa de uma petição.", ["agent", "mode", "outcome"])
+
+provider_calls_in_flight = Gauge("exordial_provider_calls_in_flight", "Chamadas aos provedores de IA em andamento.", ["provider"])
+provider_call_seconds = Histogram("exordial_provider_call_seconds", "Duração das chamadas aos provedores de IA.", ["provider", "model", "stage", "outcome"])
+provider_prompt_chars = Counter("exordial_provider_prompt_chars_total", "Caracteres enviados nos prompts.", ["provider", "model", "stage"])
+provider_prompt_tokens = Counter("exordial_provider_prompt_tokens_total", "Tokens de entrada (informados pelo provedor ou estimados).", ["provider", "model", "stage"])
+provider_output_chars = Counter("exordial_provider_output_chars_total", "Caracteres recebidos nas respostas.", ["provider", "model", "stage"])
+provider_output_tokens = Counter("exordial_provider_output_tokens_total", "Tokens de saída (informados pelo provedor ou estimados).", ["provider", "model", "stage"])
+provider_output_size = Histogram("exordial_provider_output_chars", "Tamanho das respostas em caracteres.", ["provider", "stage"], buckets=SIZE_BUCKETS)
+provider_errors = Counter("exordial_provider_errors_total", "Erros das chamadas aos provedores, por tipo.", ["provider", "model", "stage", "error_type"])
+provider_retries = Counter("exordial_provider_retries_total", "Novas tentativas HTTP feitas pelo adaptador de retry.", ["provider", "reason"])
+rate_limit_wait_seconds = Histogram("exordial_rate_limit_wait_seconds", "Espera na fila dos limites de uso antes de chamar o provedor.", ["provider", "outcome"])
+rate_limit_throttles = Counter("exordial_rate_limit_throttles_total", "Pedidos de espera (429/Retry-After) recebidos dos provedores.", ["provider"])
+
+generation_hedges = Counter("exordial_generation_hedges_total", "Pedidos em paralelo a um provedor alternativo (hedge), por motivo.", ["primary", "alternate", "reason"])
+generation_winners = Counter("exordial_generation_winners_total", "Agente que entregou a petição quando o failover está ativo.", ["primary", "winner"])
+
+llm_cache_stats = Gauge("exordial_llm_cache", "Contadores do cache de respostas dos modelos (ver ResponseCache.stats).", ["stat"])
+log_records_dropped = Gauge("exordial_log_records_dropped", "Registros de log descartados com a fila de logging cheia.", [])
+
+db_query_seconds = Histogram("exordial_db_query_seconds", "Duração das consultas SQL.", ["statement"],
+                             buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+
+
+def classify_error(message):
+    """Tipo do erro a partir das mensagens "Erro..." das funções de consulta."""
+    lowered = message.lower()
+    if "quota" in lowered or "cota" in lowered or "resource_exhausted" in lowered or "esgotados" in lowered or "429" in lowered or "limite de uso" in lowered:
+        return "quota"
+    if "bloqueado" in lowered or "blocked" in lowered:
+        return "blocked"
+    if "timeout" in lowered or "timed out" in lowered:
+        return "timeout"
+    if "erro http" in lowered:
+        return "http"
+    if "chave" in lowered or "api key" in lowered:
+        return "config"
+    return "other"
+
+
+class ProviderCall:
+    """Resultado de uma chamada em andamento; finish() registra tamanhos e o erro, se houver."""
+
+    def __init__(self, provider, model, stage):
+        self.provider = provider
+        self.model = model
+        self.stage = stage
+        self.outcome = "ok"
+
+    def finish(self, prompt_text, output_text, prompt_tokens=None, output_tokens=None):
+        labels = {"provider": self.provider, "model": self.model, "stage": self.stage}
+        prompt_chars = len(prompt_text or "")
+        provider_prompt_chars.inc(prompt_chars, **labels)
+        provider_prompt_tokens.inc(prompt_tokens if prompt_tokens is not None else prompt_chars // 4, **labels)
+        if isinstance(output_text, str) and output_text.startswith("Erro"):
+            self.outcome = "error"
+            provider_errors.inc(error_type=classify_error(output_text), **labels)
+            return
+        output_chars = len(output_text or "")
+        provider_output_chars.inc(output_chars, **labels)
+        provider_output_tokens.inc(output_tokens if output_tokens is not None else output_chars // 4, **labels)
+        provider_output_size.observe(output_chars, provider=self.provider, stage=self.stage)
+
+
+@contextmanager
+def provider_call(provider, model, stage="completa"):
+    """Mede uma chamada a um provedor (latência, em andamento, tamanhos e erros via ProviderCall.finish)."""
+    call = ProviderCall(provider, model, stage)
+    provider_calls_in_flight.inc(provider=provider)
+    started_at = time.perf_counter()
+    try:
+        yield call
+    except Exception:
+        call.outcome = "exception"
+        raise
+    finally:
+        provider_calls_in_flight.dec(provider=provider)
+        provider_call_seconds.observe(time.perf_counter() - started_at, provider=provider, model=model, stage=stage, outcome=call.outcome)
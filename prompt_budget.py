@@ -0,0 +1,195 @@
+import os
+import re
+import math
+
+# --- Orçamento de Tokens dos Prompts ---
+# Estima os tokens de cada seção do prompt e encaixa o texto dos documentos anexos no que
+# sobra da janela de contexto do modelo (descontando a saída reservada em max_tokens).
+# Quando os documentos não cabem, ficam os trechos mais relevantes para os fatos e o assunto.
+
+MODEL_CONTEXT_WINDOWS = {
+    "llama3-8b-8192": 8192,
+    "llama3-70b-8192": 8192,
+    "gemini-2.0-flash": 1048576,
+    "gemini-1.5-flash": 1048576,
+    "gemini-1.5-pro": 2097152,
+    "chatvolt": int(os.getenv("CHATVOLT_CONTEXT_WINDOW", "16000")), # Depende do modelo configurado no agente
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+PROMPT_SAFETY_MARGIN_TOKENS = 256
+# Teto para o texto dos documentos mesmo em modelos com janela enorme (custo e latência previsíveis)
+MAX_DOCUMENT_TOKENS = int(os.getenv("MAX_DOCUMENT_TOKENS", "6000"))
+DOCUMENT_CHUNK_CHARS = 1200
+
+# Caracteres por token aproximados para texto em português
+CHARS_PER_TOKEN = {"llama": 3.2, "gemini": 4.0}
+DEFAULT_CHARS_PER_TOKEN = 3.5
+
+STOPWORDS = {
+    "que", "com", "para", "por", "uma", "não", "dos", "das", "nos", "nas", "como", "mais", "foi", "são",
+    "seu", "sua", "seus", "suas", "pelo", "pela", "este", "esta", "isso", "ele", "ela", "eles", "entre",
+    "sobre", "após", "até", "quando", "também", "ser", "ter", "sem", "mas", "muito", "num", "numa", "pelos",
+}
+
+
+def context_window_for(model_name):
+    return MODEL_CONTEXT_WINDOWS.get(model_name, DEFAULT_CONTEXT_WINDOW)
+
+
+def estimate_tokens(text, model_name=None):
+    """Estimativa rápida (sem tokenizador) do número de tokens de um texto para o modelo."""
+    if not text: return 0
+    ratio = DEFAULT_CHARS_PER_TOKEN
+    for family, family_ratio in CHARS_PER_TOKEN.items():
+        if model_name and model_name.startswith(family):
+            ratio = family_ratio
+    return math.ceil(len(text) / ratio)
+
+
+def _terms(text):
+    return [term for term in re.findall(r"\w+", text.lower()) if len(term) > 2 and term not in STOPWORDS and not term.isdigit()]
+
+
+def split_into_chunks(text, max_chars=DOCUMENT_CHUNK_CHARS):
+    """Divide o texto em trechos de até max_chars, respeitando parágrafos sempre que possível."""
+    chunks, current = [], ""
+    for paragraph in re.split(r"\n\s*\n|\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph: continue
+        while len(paragraph) > max_chars: # Parágrafo gigante: corta no limite
+            if current: chunks.append(current); current = ""
+            chunks.append(paragraph[:max_chars])
+            paragraph = paragraph[max_chars:]
+        if current and len(current) + len(paragraph) + 1 > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{paragraph}" if current else paragraph
+    if current: chunks.append(current)
+    return chunks
+
+
+def rank_chunks(chunks, query_text):
+    """Pontua cada trecho pela relevância aos termos da consulta (tf-idf simples). Devolve a lista de notas."""
+    query_terms = set(_terms(query_text))
+    if not query_terms: return [0.0] * len(chunks)
+    chunk_terms = [_terms(chunk) for chunk in chunks]
+    document_frequency = {term: sum(1 for terms in chunk_terms if term in terms) for term in query_terms}
+    scores = []
+    for terms in chunk_terms:
+        score = 0.0
+        for term in query_terms:
+            term_frequency = terms.count(term)
+            if term_frequency:
+                score += (1 + math.log(term_frequency)) * math.log(1 + len(chunks) / document_frequency[term])
+        scores.append(score / math.sqrt(len(terms) or 1))
+    return scores
+
+
+def fit_documents(documents, max_tokens, query_text, model_name=None):
+    """
+    Encaixa os documentos [{"filename", "content"}] em max_tokens. Se tudo couber, devolve os
+    documentos intactos; senão mantém os trechos mais relevantes para query_text, na ordem original.
+    Devolve (documentos, info) com os totais de trechos e tokens.
+    """
+    total_tokens = sum(estimate_tokens(doc["content"], model_name) for doc in documents)
+    if total_tokens <= max_tokens:
+        return documents, {"tokens": total_tokens, "original_tokens": total_tokens, "truncated": False}
+
+    candidates = [] # (índice do documento, índice do trecho, texto)
+    for doc_index, doc in enumerate(documents):
+        for chunk_index, chunk in enumerate(split_into_chunks(doc["content"])):
+            candidates.append((doc_index, chunk_index, chunk))
+    scores = rank_chunks([chunk for _, _, chunk in candidates], query_text)
+
+    selected, used_tokens = [], 0
+    for score, candidate in sorted(zip(scores, candidates), key=lambda item: (-item[0], item[1][0], item[1][1])):
+        chunk_tokens = estimate_tokens(candidate[2], model_name)
+        if used_tokens + chunk_tokens > max_tokens: continue
+        selected.append(candidate)
+        used_tokens += chunk_tokens
+
+    fitted = []
+    for doc_index, doc in enumerate(documents):
+        doc_chunks = sorted((chunk_index, chunk) for index, chunk_index, chunk in selected if index == doc_index)
+        if not doc_chunks:
+            content = "[Documento omitido: sem trechos relevantes dentro do limite de tamanho do prompt]"
+        else:
+            parts, previous_index = [], None
+            for chunk_index, chunk in doc_chunks:
+                if previous_index is not None and chunk_index != previous_index + 1: parts.append("[...]")
+                parts.append(chunk)
+                previous_index = chunk_index
+            content = "[Trechos selecionados]\n" + "\n".join(parts)
+        fitted.append({"filename": doc["filename"], "content": content})
+    info = {"tokens": used_tokens, "original_tokens": total_tokens, "truncated": True,
+            "chunks_included": len(selected), "chunks_total": len(candidates)}
+    return fitted, info
+
+
+class BudgetedPrompt:
+    """
+    Monta um prompt a partir de seções nomeadas. A seção de documentos recebe o que sobra da
+    janela de contexto (limitado a MAX_DOCUMENT_TOKENS) depois das seções fixas e da saída reservada.
+    """
+
+    def __init__(self, model_name, max_output_tokens):
+        self.model_name = model_name
+        self.max_output_tokens = max_output_tokens
+        self.sections = [] # (nome, texto); texto None marca o lugar da seção de documentos
+        self.reserved = [] # (nome, texto) contados no orçamento mas fora do prompt
+        self.documents_section = None # (nome, documentos, consulta, cabeçalho, formato da linha)
+        self._rendered = None
+
+    def add(self, name, text):
+        self.sections.append((name, text))
+        self._rendered = None
+        return self
+
+    def reserve(self, name, text):
+        """Conta o texto no orçamento e no relatório sem incluí-lo no prompt (ex.: prompt de sistema já configurado no agente)."""
+        self.reserved.append((name, text))
+        self._rendered = None
+        return self
+
+    def add_documents(self, name, documents, query_text, header, line_format="- {filename}: {content}\n"):
+        self.documents_section = (name, documents, query_text, header, line_format)
+        self.sections.append((name, None)) # Lugar da seção de documentos no prompt
+        self._rendered = None
+        return self
+
+    def document_budget(self):
+        fixed_tokens = sum(estimate_tokens(text, self.model_name) for _, text in self.sections + self.reserved if text)
+        available = context_window_for(self.model_name) - self.max_output_tokens - PROMPT_SAFETY_MARGIN_TOKENS - fixed_tokens
+        return max(0, min(MAX_DOCUMENT_TOKENS, available))
+
+    def _render(self):
+        if self._rendered is not None: return self._rendered
+        documents_text, documents_info = "", None
+        if self.documents_section and self.documents_section[1]:
+            _, documents, query_text, header, line_format = self.documents_section
+            fitted, documents_info = fit_documents(documents, self.document_budget(), query_text, self.model_name)
+            documents_text = header + "".join(line_format.format(**doc) for doc in fitted)
+
+        parts, section_tokens = [], {name: estimate_tokens(text, self.model_name) for name, text in self.reserved}
+        for name, text in self.sections:
+            if text is None: text = documents_text
+            parts.append(text)
+            section_tokens[name] = section_tokens.get(name, 0) + estimate_tokens(text, self.model_name)
+        prompt_text = "".join(parts)
+        report = {
+            "model": self.model_name,
+            "context_window": context_window_for(self.model_name),
+            "max_output_tokens": self.max_output_tokens,
+            "input_tokens": sum(section_tokens.values()),
+            "sections": section_tokens,
+        }
+        if documents_info: report["documents"] = documents_info
+        self._rendered = (prompt_text, report)
+        return self._rendered
+
+    def render(self):
+        return self._render()[0]
+
+    def report(self):
+        """Tokens estimados por seção, total de entrada e, se houver, o que foi cortado dos documentos."""
+        return self._render()[1]
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import logging
+import uuid
+import sqlite3
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Limites de Uso dos Provedores ---
+# Token buckets de requisições e de tokens por minuto e um limite de chamadas simultâneas, por
+# provedor ou por provedor:modelo. O estado fica num SQLite local, compartilhado pelas threads e
+# pelos workers do gunicorn da mesma máquina; cada aquisição é uma transação BEGIN IMMEDIATE.
+# Sem vaga, a chamada espera na fila até RATE_LIMIT_MAX_WAIT_SECONDS em vez de falhar na hora.
+# Um 429/Retry-After do provedor pausa todas as chamadas a ele pelo tempo pedido.
+#
+#   RATE_LIMITS='{"groq": {"rpm": 30, "tpm": 30000, "concurrency": 4}, "gemini:gemini-2.0-flash": {"rpm": 15}}'
+RATE_LIMITS = json.loads(os.getenv("RATE_LIMITS", "{}"))
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", "rate_limits.db")
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("RATE_LIMIT_MAX_WAIT_SECONDS", "30"))
+RATE_LIMIT_DEFAULT_COOLDOWN_SECONDS = float(os.getenv("RATE_LIMIT_DEFAULT_COOLDOWN_SECONDS", "20")) # 429 sem Retry-After
+LEASE_TTL_SECONDS = 600 # A vaga de um worker que morreu no meio da chamada expira sozinha
+CONCURRENCY_POLL_SECONDS = 0.25
+
+
+class Lease:
+    """Vaga obtida em RateLimiter.acquire; release() libera a concorrência e acerta o balde de tokens pelo uso real."""
+
+    def __init__(self, limiter=None, key=None, lease_id=None, reserved_tokens=0):
+        self.limiter = limiter
+        self.key = key
+        self.lease_id = lease_id
+        self.reserved_tokens = reserved_tokens
+
+    def release(self, actual_tokens=None):
+        if self.lease_id is None: return
+        self.limiter._release(self, actual_tokens)
+        self.lease_id = None
+
+
+NO_LIMIT = Lease() # Provedor sem limites configurados: nada a liberar
+
+
+class RateLimiter:
+    def __init__(self, db_path, limits, max_wait_seconds=RATE_LIMIT_MAX_WAIT_SECONDS):
+        self.db_path = db_path
+        self.limits = limits
+        self.max_wait_seconds = max_wait_seconds
+        self._local = threading.local() # Uma conexão SQLite por thread
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None) # Transações explícitas
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS rate_limit_buckets (key TEXT PRIMARY KEY, requests REAL NOT NULL, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS rate_limit_leases (id TEXT PRIMARY KEY, key TEXT NOT NULL, expires_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS rate_limit_pauses (provider TEXT PRIMARY KEY, until REAL NOT NULL)")
+            self._local.conn = conn
+        return conn
+
+    def limit_key(self, provider, model=None):
+        """Chave dos limites que valem para a chamada: provedor:modelo, senão provedor; None se não houver."""
+        if model and f"{provider}:{model}" in self.limits: return f"{provider}:{model}"
+        if provider in self.limits: return provider
+        return None
+
+    def acquire(self, provider, model=None, tokens=0, max_wait=None):
+        """
+        Espera na fila (até max_wait segundos) por uma vaga para uma chamada de ~tokens tokens
+        (entrada + saída máxima). Devolve um Lease, ou None se a espera passaria do limite.
+        """
+        key = self.limit_key(provider, model)
+        limit = self.limits.get(key, {})
+        if limit.get("tpm"): tokens = min(tokens, limit["tpm"]) # Uma chamada maior que o balde inteiro travaria a fila
+        deadline = time.time() + (self.max_wait_seconds if max_wait is None else max_wait)
+        while True:
+            now = time.time()
+            result = self._try_acquire(provider, key, limit, tokens, now)
+            if isinstance(result, Lease): return result
+            if now + result > deadline: return None
+            time.sleep(result)
+
+    def _try_acquire(self, provider, key, limit, tokens, now):
+        """Uma tentativa: devolve o Lease ou quantos segundos esperar antes da próxima."""
+        conn = self._connection()
+        if key is None: # Sem limites configurados: só respeita a pausa pedida pelo provedor (leitura, sem lock)
+            row = conn.execute("SELECT until FROM rate_limit_pauses WHERE provider = ?", (provider,)).fetchone()
+            return row[0] - now if row and row[0] > now else NO_LIMIT
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT until FROM rate_limit_pauses WHERE provider = ?", (provider,)).fetchone()
+            waits = [row[0] - now if row else 0]
+            bucket = conn.execute("SELECT requests, tokens, updated_at FROM rate_limit_buckets WHERE key = ?", (key,)).fetchone()
+            rpm, tpm = limit.get("rpm") or 0, limit.get("tpm") or 0
+            if bucket is None:
+                available_requests, available_tokens = rpm, tpm
+            else: # Reabastece proporcionalmente ao tempo desde a última atualização
+                elapsed = max(0.0, now - bucket[2])
+                available_requests = min(rpm, bucket[0] + elapsed * rpm / 60)
+                available_tokens = min(tpm, bucket[1] + elapsed * tpm / 60)
+            if rpm and available_requests < 1:
+                waits.append((1 - available_requests) * 60 / rpm)
+            if tpm and available_tokens < tokens:
+                waits.append((tokens - available_tokens) * 60 / tpm)
+            if limit.get("concurrency"):
+                in_flight = conn.execute("SELECT COUNT(*) FROM rate_limit_leases WHERE key = ? AND expires_at > ?", (key, now)).fetchone()[0]
+                if in_flight >= limit["concurrency"]: waits.append(CONCURRENCY_POLL_SECONDS)
+            if max(waits) > 0:
+                conn.execute("COMMIT")
+                return max(max(waits), 0.01)
+
+            conn.execute("INSERT OR REPLACE INTO rate_limit_buckets (key, requests, tokens, updated_at) VALUES (?, ?, ?, ?)",
+                         (key, available_requests - (1 if rpm else 0), available_tokens - (tokens if tpm else 0), now))
+            lease = Lease(self, key, uuid.uuid4().hex, tokens if tpm else 0)
+            if limit.get("concurrency"):
+                conn.execute("DELETE FROM rate_limit_leases WHERE key = ? AND expires_at <= ?", (key, now))
+                conn.execute("INSERT INTO rate_limit_leases (id, key, expires_at) VALUES (?, ?, ?)", (lease.lease_id, key, now + LEASE_TTL_SECONDS))
+            conn.execute("COMMIT")
+            return lease
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _release(self, lease, actual_tokens):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM rate_limit_leases WHERE id = ?", (lease.lease_id,))
+            tpm = self.limits.get(lease.key, {}).get("tpm")
+            if tpm and actual_tokens is not None: # Devolve a parte da reserva que não foi usada (ou cobra o excesso)
+                conn.execute("UPDATE rate_limit_buckets SET tokens = MIN(?, tokens + ?) WHERE key = ?",
+                             (tpm, lease.reserved_tokens - actual_tokens, lease.key))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def pause(self, provider, seconds=None):
+        """O provedor pediu para esperar (429/Retry-After): pausa as chamadas a ele em todos os workers."""
+        until = time.time() + (RATE_LIMIT_DEFAULT_COOLDOWN_SECONDS if seconds is None else seconds)
+        self._connection().execute(
+            "INSERT INTO rate_limit_pauses (provider, until) VALUES (?, ?) ON CONFLICT(provider) DO UPDATE SET until = MAX(until, excluded.until)",
+            (provider, until)
+        )
+
+
+rate_limiter = RateLimiter(RATE_LIMIT_PATH, RATE_LIMITS)
+
+
+def acquire_provider_slot(provider, model, tokens):
+    """rate_limiter.acquire com as métricas de espera; None se a fila estourou RATE_LIMIT_MAX_WAIT_SECONDS."""
+    started_at = time.perf_counter()
+    try:
+        lease = rate_limiter.acquire(provider, model, tokens)
+    except sqlite3.Error as e: # Estado dos limites indisponível: não bloqueia a geração por isso
+        logger.warning(f"Erro no controle de limites ({provider}): {e}")
+        return NO_LIMIT
+    metrics.rate_limit_wait_seconds.observe(time.perf_counter() - started_at, provider=provider, outcome="ok" if lease else "timeout")
+    return lease
+
+
+def release_provider_slot(provider, lease, actual_tokens=None):
+    """lease.release sem deixar um erro do estado dos limites substituir o resultado (ou o erro) da chamada ao provedor."""
+    try:
+        lease.release(actual_tokens)
+    except sqlite3.Error as e: # A vaga expira sozinha em LEASE_TTL_SECONDS
+        logger.warning(f"Erro ao liberar a vaga no controle de limites ({provider}): {e}")
+
+
+def report_provider_throttle(provider, retry_after=None):
+    """Registra um 429/Retry-After do provedor e pausa as próximas chamadas a ele."""
+    metrics.rate_limit_throttles.inc(provider=provider)
+    try:
+        rate_limiter.pause(provider, retry_after)
+    except sqlite3.Error as e:
+        logger.warning(f"Erro ao registrar a pausa pedida por {provider}: {e}")
+
+
+def rate_limit_error(provider):
+    return f"Erro: Limite de uso do provedor {provider} atingido (espera na fila acima de {rate_limiter.max_wait_seconds:.0f}s). Tente novamente em instantes."
@@ -0,0 +1,161 @@
+import time
+import secrets
+from datetime import datetime, timedelta
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+import sqlalchemy as sa
+
+# --- Sessões no Servidor ---
+# O cookie leva só um ID aleatório; os dados ficam num store compartilhado por todos os workers
+# e máquinas (tabela do banco ou Redis). Qualquer objeto com get/set/delete/cleanup_expired serve de store.
+SESSION_ID_BYTES = 32
+SESSION_CLEANUP_EVERY = 200 # Gravações entre limpezas das sessões expiradas
+
+
+class SessionStore:
+    """Interface dos stores: get devolve (dados, expira_em) ou None; expira_em é um timestamp Unix."""
+
+    def get(self, session_id):
+        raise NotImplementedError
+
+    def set(self, session_id, data, expires_at):
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    def cleanup_expired(self):
+        """Remove as sessões expiradas e devolve quantas foram removidas."""
+        return 0
+
+
+class SQLAlchemySessionStore(SessionStore):
+    """Sessões numa tabela (id, data, expires_at) do banco da aplicação, em conexões próprias (fora do db.session)."""
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self._writes = 0
+
+    def get(self, session_id):
+        with self.db.engine.connect() as conn:
+            row = conn.execute(
+                sa.select(self.table.c.data, self.table.c.expires_at).where(self.table.c.id == session_id)
+            ).first()
+        if not row or row.expires_at <= datetime.utcnow(): return None
+        return row.data, (row.expires_at - datetime(1970, 1, 1)).total_seconds()
+
+    def set(self, session_id, data, expires_at):
+        expires_at = datetime(1970, 1, 1) + timedelta(seconds=expires_at)
+        with self.db.engine.begin() as conn:
+            updated = conn.execute(
+                sa.update(self.table).where(self.table.c.id == session_id).values(data=data, expires_at=expires_at)
+            ).rowcount
+            if not updated:
+                conn.execute(sa.insert(self.table).values(id=session_id, data=data, expires_at=expires_at))
+        self._writes += 1
+        if self._writes % SESSION_CLEANUP_EVERY == 0:
+            self.cleanup_expired()
+
+    def delete(self, session_id):
+        with self.db.engine.begin() as conn:
+            conn.execute(sa.delete(self.table).where(self.table.c.id == session_id))
+
+    def cleanup_expired(self):
+        with self.db.engine.begin() as conn:
+            return conn.execute(sa.delete(self.table).where(self.table.c.expires_at <= datetime.utcnow())).rowcount
+
+
+class RedisSessionStore(SessionStore):
+    """Sessões num cliente compatível com redis-py (get/setex/delete); o próprio Redis expira as chaves."""
+
+    def __init__(self, client, prefix="sessao:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, session_id):
+        value = self.client.get(self.prefix + session_id)
+        if value is None: return None
+        if isinstance(value, bytes): value = value.decode("utf-8")
+        expires_at, data = value.split("\n", 1)
+        return data, float(expires_at)
+
+    def set(self, session_id, data, expires_at):
+        ttl = max(1, int(expires_at - time.time()))
+        self.client.setex(self.prefix + session_id, ttl, f"{expires_at}\n{data}")
+
+    def delete(self, session_id):
+        self.client.delete(self.prefix + session_id)
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, session_id=None, expires_at=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.session_id = session_id
+        self.expires_at = expires_at # Expiração gravada no store (None para sessão nova)
+        self.discarded_session_id = None # ID anterior, removido do store ao salvar (ver regenerate)
+        self.modified = False
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Troca o cookie assinado do Flask por um ID de sessão. Só grava no store quando a sessão muda
+    ou quando já passou metade da validade (renovação), e não a cada requisição.
+    """
+    serializer = TaggedJSONSerializer() # O mesmo do cookie do Flask (mantém tuplas, datas, bytes...)
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        session_id = request.cookies.get(self.get_cookie_name(app))
+        if session_id:
+            stored = self.store.get(session_id)
+            if stored:
+                data, expires_at = stored
+                return ServerSideSession(self.serializer.loads(data), session_id, expires_at)
+        return ServerSideSession(session_id=secrets.token_urlsafe(SESSION_ID_BYTES))
+
+    def regenerate(self, session):
+        """
+        Troca o ID da sessão (login, logout, mudança de privilégio), contra fixação de sessão: o registro
+        do ID antigo é removido do store ao salvar e o cookie passa a levar o ID novo.
+        """
+        if session.expires_at is not None: # O ID atual está gravado no store
+            session.discarded_session_id = session.session_id
+        session.session_id = secrets.token_urlsafe(SESSION_ID_BYTES)
+        session.expires_at = None
+        session.modified = True
+
+    def save_session(self, app, session, response):
+        cookie_name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.discarded_session_id:
+            self.store.delete(session.discarded_session_id)
+            session.discarded_session_id = None
+        if not session:
+            if session.modified or session.expires_at is not None: # Sessão esvaziada (ex.: logout)
+                self.store.delete(session.session_id)
+                response.delete_cookie(cookie_name, domain=domain, path=path)
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        needs_refresh = session.expires_at is None or session.expires_at - time.time() < lifetime / 2
+        if not session.modified and not needs_refresh: return
+
+        expires_at = time.time() + lifetime
+        self.store.set(session.session_id, self.serializer.dumps(dict(session)), expires_at)
+        response.set_cookie(
+            cookie_name,
+            session.session_id,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import hashlib
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# --- Logging Estruturado ---
+# Os registros são formatados em JSON (com o ID da requisição e a etapa da geração) na thread que
+# loga e entram numa fila; a escrita no console e no arquivo (com rotação) é feita por uma thread
+# em segundo plano (QueueListener). Com a fila cheia o registro é descartado, em vez de a requisição
+# esperar pelo disco. Logs INFO da geração podem ser amostrados por requisição (LOG_GENERATION_INFO_SAMPLE_RATE).
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "error.log")
+LOG_FILE_LEVEL = os.getenv("LOG_FILE_LEVEL", "WARNING").upper()
+LOG_QUEUE_MAX_RECORDS = int(os.getenv("LOG_QUEUE_MAX_RECORDS", "10000"))
+LOG_GENERATION_INFO_SAMPLE_RATE = float(os.getenv("LOG_GENERATION_INFO_SAMPLE_RATE", "1.0")) # 0.1 = 10% das requisições
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+stage_var = contextvars.ContextVar("stage", default=None)
+
+# Atributos padrão de um LogRecord; o resto veio de extra={...} e vai para o JSON
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id", "stage"}
+
+
+def in_current_context(function):
+    """
+    function para rodar em outra thread (pools) com o contexto de log de quem a criou (request_id, stage).
+    Só essas duas variáveis vão junto: o contexto do Flask (app/request e a sessão do banco) não é
+    copiado, e a thread que precisar do banco abre o seu com app.app_context().
+    """
+    request_id, stage = request_id_var.get(), stage_var.get()
+
+    def run(*args, **kwargs):
+        def with_log_context():
+            request_id_var.set(request_id)
+            stage_var.set(stage)
+            return function(*args, **kwargs)
+        return contextvars.Context().run(with_log_context)
+    return run
+
+
+class ContextFilter(logging.Filter):
+    """Preenche request_id e stage do contexto atual (se o registro ainda não os tiver, via extra)."""
+
+    def filter(self, record):
+        if getattr(record, "request_id", None) is None: record.request_id = request_id_var.get()
+        if getattr(record, "stage", None) is None: record.stage = stage_var.get()
+        return True
+
+
+class InfoSampler(logging.Filter):
+    """Mantém só a fração rate dos registros INFO/DEBUG; a decisão é por requisição, para não picotar o log de uma mesma geração."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or self.rate >= 1: return True
+        request_id = request_id_var.get()
+        if request_id is None: return random.random() < self.rate
+        return int(hashlib.sha1(request_id.encode()).hexdigest()[:8], 16) / 0xFFFFFFFF < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "stage": getattr(record, "stage", None),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info: entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler que nunca bloqueia: com a fila cheia, descarta o registro e conta o descarte."""
+    dropped = 0
+
+    def prepare(self, record):
+        # O JSON já vai pronto para a fila (com o contexto desta thread); o listener só escreve
+        return logging.makeLogRecord({**vars(record), "msg": self.format(record), "args": None, "exc_info": None, "exc_text": None})
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+_listener = None
+
+
+def configure_logging(log_to_file=True, sampled_loggers=()):
+    """
+    Liga o logging em fila no logger raiz (uma vez por processo): console sempre e, com log_to_file,
+    LOG_FILE a partir de LOG_FILE_LEVEL. sampled_loggers são os nomes cujos INFO passam pela amostragem.
+    """
+    global _listener
+    if _listener is not None: return
+    handlers = [logging.StreamHandler(sys.stdout)]
+    handlers[0].setLevel(LOG_LEVEL)
+    if log_to_file:
+        file_handler = RotatingFileHandler(LOG_FILE, maxBytes=1024 * 1024 * 10, backupCount=5) # 10MB por arquivo, até 5 arquivos
+        file_handler.setLevel(LOG_FILE_LEVEL)
+        handlers.append(file_handler)
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter("%(message)s")) # A mensagem já é o JSON
+
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_MAX_RECORDS))
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.setFormatter(JsonFormatter())
+    logging.getLogger().addHandler(queue_handler)
+    for name in sampled_loggers:
+        logging.getLogger(name).addFilter(InfoSampler(LOG_GENERATION_INFO_SAMPLE_RATE))
+
+    _listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop) # Escreve o que ainda estiver na fila
@@ -0,0 +1,36 @@
+import os
+import sys
+import shutil
+import tempfile
+
+import pytest
+
+# O app lê a configuração do ambiente quando é importado: o banco e os arquivos de runtime dos
+# testes ficam num diretório temporário, nunca no banco configurado para o servidor.
+TEST_RUNTIME_DIR = tempfile.mkdtemp(prefix="exordial-tests-")
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{os.path.join(TEST_RUNTIME_DIR, 'app.db')}",
+    "SECRET_KEY": "chave-dos-testes",
+    "JURISPRUDENCE_DB_PATH": os.path.join(TEST_RUNTIME_DIR, "jurisprudencia.db"),
+    "LLM_CACHE_PATH": os.path.join(TEST_RUNTIME_DIR, "llm_cache.db"),
+    "RATE_LIMIT_PATH": os.path.join(TEST_RUNTIME_DIR, "rate_limits.db"),
+    "UPLOAD_FOLDER": os.path.join(TEST_RUNTIME_DIR, "uploads"),
+    "LOG_FILE": os.path.join(TEST_RUNTIME_DIR, "error.log"),
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def app_module():
+    """O módulo app, com as tabelas criadas no banco temporário."""
+    import app as app_module
+    app_module.app.config["TESTING"] = True
+    with app_module.app.app_context():
+        app_module.db.create_all()
+    yield app_module
+    with app_module.app.app_context():
+        app_module.db.engine.dispose()
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(TEST_RUNTIME_DIR, ignore_errors=True)
@@ -0,0 +1,90 @@
+import json
+import uuid
+
+import pytest
+
+import utils
+import batch as batch_files
+from benchmarks.fake_llm_servers import FakeProviderConfig, FakeProviderHandler, start_fake_server
+
+
+@pytest.fixture
+def groq_server(app_module, monkeypatch):
+    """Servidor falso da Groq; groq_server(error_rate=...) sobe e aponta o app para ele."""
+    servers = []
+
+    def start(error_rate=0.0):
+        server, base_url = start_fake_server(config=FakeProviderConfig(latency_ms=20, jitter_ms=0, error_rate=error_rate, output_words=30))
+        servers.append(server)
+        monkeypatch.setattr(utils, "GROQ_API_BASE_URL", base_url + "/openai/v1")
+        monkeypatch.setattr(FakeProviderHandler, "requests_served", 0)
+
+    monkeypatch.setattr(utils, "HTTP_MAX_RETRIES", 0) # O 503 do servidor falso chega direto, sem as esperas do backoff
+    monkeypatch.setattr(utils, "_provider_sessions", {})
+    monkeypatch.setattr(app_module, "GROQ_API_KEY", "chave-falsa")
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def case(subject, facts):
+    return batch_files.record_to_input_data({"tipo-peticao": "Petição Inicial", "assunto-principal": subject, "partes": "Autor x Réu", "fatos": facts})
+
+
+def duplicated_cases():
+    # O primeiro e o terceiro casos só diferem em espaços e maiúsculas: geram a mesma petição
+    facts = f"Voo atrasado em 10 horas (lote {uuid.uuid4().hex})."
+    return [case("Atraso de voo", facts), case("Extravio de bagagem", facts), case("ATRASO  DE VOO", "  " + facts.upper())]
+
+
+def run_batch(app_module, request, records, tokens):
+    app, db, User = app_module.app, app_module.db, app_module.User
+    with app.app_context():
+        user = User(name="Lote", email=f"lote-{request.node.name}@exemplo.com", password_hash="-", tokens=tokens)
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        batch_id = app_module.create_generation_batch(user, "groq_general", "casos.csv", records).id
+    app_module.run_generation_batch(batch_id)
+    with app.app_context():
+        generation_batch = db.session.get(app_module.GenerationBatch, batch_id)
+        ledger = app_module.TokenLedger.query.filter_by(reference=batch_id).all()
+        return (generation_batch.status, json.loads(generation_batch.items),
+                app_module.current_token_balance(user_id), sorted(entry.status for entry in ledger))
+
+
+def test_duplicate_cases_are_generated_once_and_debited_per_item(app_module, groq_server, request):
+    groq_server()
+    status, items, balance, ledger = run_batch(app_module, request, duplicated_cases(), tokens=5)
+
+    assert status == 'done'
+    assert [item["status"] for item in items] == ['done', 'done', 'done']
+    assert FakeProviderHandler.requests_served == 2
+    assert len({item["petition_id"] for item in items}) == 3 # Uma petição por item, mesmo com o texto reaproveitado
+    assert balance == 2
+    assert ledger == ['committed'] * 3
+
+
+def test_items_without_tokens_fail_without_reaching_the_provider(app_module, groq_server, request):
+    groq_server()
+    status, items, balance, ledger = run_batch(app_module, request, duplicated_cases(), tokens=2)
+
+    assert status == 'done'
+    assert [item["status"] for item in items] == ['done', 'error', 'done']
+    assert items[1]["error"] == "Tokens insuficientes para este item."
+    assert FakeProviderHandler.requests_served == 1
+    assert balance == 0
+    assert ledger == ['committed'] * 2
+
+
+def test_failed_items_are_refunded(app_module, groq_server, request):
+    groq_server(error_rate=1.0)
+    status, items, balance, ledger = run_batch(app_module, request, duplicated_cases(), tokens=5)
+
+    assert status == 'done'
+    assert [item["status"] for item in items] == ['error', 'error', 'error']
+    assert items[0]["error"].startswith("Falha Groq: Erro HTTP da API Groq: 503")
+    assert FakeProviderHandler.requests_served == 2
+    assert balance == 5
+    assert ledger == ['refunded'] * 3
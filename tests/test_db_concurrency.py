@@ -0,0 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
+
+THREADS = 8
+ITERATIONS = 10
+AGENTS = ('simulated', 'groq_general', 'chatvolt_single', 'gemini_flow')
+
+
+def test_concurrent_writes_keep_token_balance(app_module):
+    """Cadastro, seleção de agente e débito de tokens a partir de várias threads, no SQLite com WAL."""
+    app, db, User, TokenLedger = app_module.app, app_module.db, app_module.User, app_module.TokenLedger
+    initial_tokens = THREADS * ITERATIONS
+    with app.app_context():
+        assert db.session.execute(db.text("PRAGMA journal_mode")).scalar() == "wal"
+        shared_user = User(name="Conta Compartilhada", email="compartilhada@exemplo.com", password_hash="-",
+                           tokens=initial_tokens, plan="premium")
+        db.session.add(shared_user)
+        db.session.commit()
+        shared_user_id = shared_user.id
+
+    errors, committed = [], [] # list.append é atômico entre threads
+
+    def hammer(thread_index):
+        client = app.test_client()
+        email = f"concorrencia-{thread_index}@exemplo.com"
+        try:
+            response = client.post('/register', data={'name': f"Usuário {thread_index}", 'email': email,
+                                                       'password': 'senha123', 'confirm_password': 'senha123'})
+            assert response.status_code == 302
+            response = client.post('/login', data={'email': email, 'password': 'senha123'})
+            assert response.headers["Location"].endswith("/gerar-peticao")
+            for iteration in range(ITERATIONS):
+                response = client.post('/selecionar-agentes', data={'agent': AGENTS[iteration % len(AGENTS)]})
+                assert response.status_code == 302
+                with app.app_context():
+                    reservation_id, _ = app_module.reserve_generation_token(db.session.get(User, shared_user_id), reference="teste-concorrencia")
+                    assert reservation_id
+                    success = iteration % 3 != 0 # Um terço das gerações "falha" e é estornado
+                    app_module.settle_token_reservation(reservation_id, success)
+                    if success: committed.append(reservation_id)
+        except Exception as e:
+            errors.append(repr(e))
+
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        list(executor.map(hammer, range(THREADS)))
+
+    assert not [error for error in errors if "database is locked" in error]
+    assert errors == []
+    with app.app_context():
+        assert app_module.current_token_balance(shared_user_id) == initial_tokens - len(committed)
+        assert TokenLedger.query.filter_by(reference="teste-concorrencia", status='committed').count() == len(committed)
+        assert TokenLedger.query.filter_by(reference="teste-concorrencia", status='reserved').count() == 0
+        registered = User.query.filter(User.email.like("concorrencia-%")).all()
+        assert len(registered) == THREADS
+        assert {user.selected_agent for user in registered} == {AGENTS[(ITERATIONS - 1) % len(AGENTS)]}
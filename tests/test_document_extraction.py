@@ -0,0 +1,33 @@
+import os
+import uuid
+
+import utils
+from upload_storage import StoredFile
+
+
+def stored_text_file(directory, name, content=None):
+    path = os.path.join(directory, name)
+    if content is None:
+        os.mkfifo(path) # Abrir para leitura trava até alguém escrever: simula um arquivo que não termina de extrair
+    else:
+        with open(path, "w") as text_file: text_file.write(content)
+    return StoredFile(uuid.uuid4().hex, 0, path, name)
+
+
+def test_stuck_extraction_times_out_and_the_pool_is_rebuilt(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "EXTRACTION_WORKERS", 1)
+    monkeypatch.setattr(utils, "EXTRACTION_TIMEOUT_SECONDS", 2)
+    utils._extraction_executor = None
+    stuck_executor = utils.get_extraction_executor()
+    stuck, queued = stored_text_file(tmp_path, "travado.txt"), stored_text_file(tmp_path, "fila.txt", "texto na fila")
+
+    documents = utils.extract_texts_from_uploads([stuck, queued])
+    assert documents[0]["content"].startswith("Erro ao extrair o texto do arquivo travado.txt: tempo esgotado")
+    assert documents[1]["content"] == "texto na fila" # Estava atrás do travado no pool de 1 processo
+
+    executor = utils.get_extraction_executor()
+    assert executor is not stuck_executor # O pool com o processo travado foi descartado
+    assert [document["content"] for document in utils.extract_texts_from_uploads([stored_text_file(tmp_path, "novo.txt", "novo")])] == ["novo"]
+    assert utils.get_extraction_executor() is executor
+    executor.shutdown()
+    utils._extraction_executor = None
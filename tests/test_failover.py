@@ -0,0 +1,139 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import utils
+from failover import hedged_generation, GenerationCancelled
+from benchmarks.fake_llm_servers import FakeProviderConfig, start_fake_server
+
+FAILOVER_ERROR_TYPES = {"quota", "http", "timeout"}
+
+
+@pytest.fixture
+def providers(app_module, monkeypatch):
+    """
+    Sobe um servidor falso para a Groq (agente primário) e outro para o Chatvolt (alternativo) e
+    aponta o app para eles. providers(groq=..., chatvolt=...) recebe os FakeProviderConfig.
+    """
+    servers = []
+
+    def start(groq, chatvolt):
+        for config, variable, path in ((groq, "GROQ_API_BASE_URL", "/openai/v1"), (chatvolt, "CHATVOLT_API_BASE_URL", "/agents")):
+            server, base_url = start_fake_server(config=config)
+            servers.append(server)
+            monkeypatch.setattr(utils, variable, base_url + path)
+
+    monkeypatch.setattr(utils, "HTTP_MAX_RETRIES", 0) # O 503 do servidor falso chega direto, sem as esperas do backoff
+    monkeypatch.setattr(utils, "_provider_sessions", {})
+    monkeypatch.setattr(app_module, "GROQ_API_KEY", "chave-falsa")
+    monkeypatch.setattr(app_module, "CHATVOLT_API_KEY", "chave-falsa")
+    monkeypatch.setattr(app_module, "CHATVOLT_AGENT_ID", "agente-falso")
+    monkeypatch.setattr(app_module, "GENERATION_FAILOVER_ENABLED", True)
+    monkeypatch.setattr(app_module, "GENERATION_FAILOVER_AGENTS", ["groq_general", "chatvolt_single"])
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def provider(latency_ms=20, error_rate=0.0):
+    return FakeProviderConfig(latency_ms=latency_ms, jitter_ms=0, error_rate=error_rate, output_words=30)
+
+
+def case_input():
+    # Fatos únicos por teste: uma resposta já em cache responderia sem passar pelo servidor falso
+    return {"tipo_peticao": "Petição Inicial", "assunto_principal": "Atraso de voo", "partes_str": "Autor x Companhia Aérea",
+            "fatos_str": f"Voo atrasado em 10 horas (caso {uuid.uuid4().hex}).", "outras_info_str": "",
+            "documentos_texto": [], "transcricao_audio": ""}
+
+
+@pytest.fixture
+def launched_agents(app_module, monkeypatch):
+    """Agentes na ordem em que o failover os acionou."""
+    launched = []
+    generate_petition_text = app_module.generate_petition_text
+
+    def recording_generate_petition_text(agent, *args, **kwargs):
+        launched.append(agent)
+        return generate_petition_text(agent, *args, **kwargs)
+
+    monkeypatch.setattr(app_module, "generate_petition_text", recording_generate_petition_text)
+    return launched
+
+
+def test_fast_primary_wins_without_hedging(app_module, providers, launched_agents, monkeypatch):
+    providers(groq=provider(), chatvolt=provider())
+    monkeypatch.setattr(app_module, "hedge_delay_for", lambda agent: 5)
+
+    used_agent, text = app_module.generate_petition_text_with_failover("groq_general", case_input())
+
+    assert used_agent == "groq_general"
+    assert text.startswith("o autor requer")
+    assert launched_agents == ["groq_general"]
+
+
+def test_primary_http_error_fails_over_without_waiting_for_the_hedge(app_module, providers, launched_agents, monkeypatch):
+    providers(groq=provider(error_rate=1.0), chatvolt=provider())
+    monkeypatch.setattr(app_module, "hedge_delay_for", lambda agent: 30)
+
+    started_at = time.monotonic()
+    used_agent, text = app_module.generate_petition_text_with_failover("groq_general", case_input())
+
+    assert used_agent == "chatvolt_single"
+    assert text.startswith("o autor requer")
+    assert launched_agents == ["groq_general", "chatvolt_single"]
+    assert time.monotonic() - started_at < 10
+
+
+def test_all_agents_failing_returns_the_first_error(app_module, providers, launched_agents, monkeypatch):
+    providers(groq=provider(error_rate=1.0), chatvolt=provider(latency_ms=100, error_rate=1.0))
+    monkeypatch.setattr(app_module, "hedge_delay_for", lambda agent: 30)
+
+    used_agent, text = app_module.generate_petition_text_with_failover("groq_general", case_input())
+
+    assert used_agent == "groq_general"
+    assert text.startswith("Falha Groq: Erro HTTP da API Groq: 503")
+    assert launched_agents == ["groq_general", "chatvolt_single"]
+
+
+def test_slow_primary_is_hedged_and_the_loser_is_cancelled(app_module, providers):
+    providers(groq=provider(latency_ms=1500), chatvolt=provider())
+    user_input_data = case_input()
+    cancel_events = {}
+    launched = []
+
+    def run_agent(agent, cancel_event):
+        launched.append(agent)
+        cancel_events[agent] = cancel_event
+        text = app_module.generate_petition_text(agent, user_input_data)
+        if cancel_event.is_set(): raise GenerationCancelled() # Como o fluxo Gemini na etapa seguinte
+        return text
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        used_agent, text = hedged_generation(["groq_general", "chatvolt_single"], run_agent, executor,
+                                             lambda agent: 0.2, 30, FAILOVER_ERROR_TYPES)
+        assert used_agent == "chatvolt_single"
+        assert text.startswith("o autor requer")
+        assert launched == ["groq_general", "chatvolt_single"]
+        assert cancel_events["groq_general"].is_set()
+        assert not cancel_events["chatvolt_single"].is_set()
+
+
+def test_latency_budget_cancels_every_attempt(app_module, providers):
+    providers(groq=provider(latency_ms=1500), chatvolt=provider(latency_ms=1500))
+    user_input_data = case_input()
+    cancel_events = {}
+
+    def run_agent(agent, cancel_event):
+        cancel_events[agent] = cancel_event
+        return app_module.generate_petition_text(agent, user_input_data)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        used_agent, text = hedged_generation(["groq_general", "chatvolt_single"], run_agent, executor,
+                                             lambda agent: 0.1, 0.5, FAILOVER_ERROR_TYPES)
+        assert used_agent == "groq_general"
+        assert text.startswith("Erro: A geração não terminou")
+        assert all(cancel_event.is_set() for cancel_event in cancel_events.values())
+        assert sorted(cancel_events) == ["chatvolt_single", "groq_general"]
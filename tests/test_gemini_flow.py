@@ -0,0 +1,51 @@
+import json
+import threading
+
+import pytest
+
+import utils
+
+USER_DATA = {"tipo_peticao": "Petição Inicial", "assunto_principal": "atraso de voo", "partes_str": "A contra B",
+             "fatos_str": "Voo atrasou 10 horas.", "outras_info_str": "", "documentos_texto": []}
+PLAN = json.dumps({"topicos": ["DA RESPONSABILIDADE CIVIL", "DOS DANOS MORAIS"]})
+
+
+@pytest.fixture
+def fake_gemini(monkeypatch):
+    """Substitui as chamadas do GeminiFlowContext: o tópico de responsabilidade civil falha."""
+    calls, closed = [], []
+    lock = threading.Lock()
+
+    def query(self, task_prompt, max_output_tokens, stage, response_schema=None):
+        with lock: calls.append(stage)
+        if stage == "planejamento": return PLAN
+        if stage == "topico" and "RESPONSABILIDADE" in task_prompt: return "Erro: cota excedida"
+        return f"texto de {stage}"
+
+    monkeypatch.setattr(utils.GeminiFlowContext, "query", query)
+    monkeypatch.setattr(utils.GeminiFlowContext, "close", lambda self: closed.append(len(calls)))
+    return calls, closed
+
+
+@pytest.mark.parametrize("concurrent", [True, False])
+def test_failed_topic_is_marked_inline_and_not_checkpointed(fake_gemini, concurrent):
+    calls, closed = fake_gemini
+    saved = {}
+    checkpoint = utils.GeminiFlowCheckpoint(save_callback=saved.__setitem__)
+    text = utils.generate_petition_gemini_flow("chave", USER_DATA, concurrent=concurrent, checkpoint=checkpoint)
+
+    assert not text.startswith("Erro")
+    assert "--- ERRO AO GERAR TÓPICO: 2.1 DA RESPONSABILIDADE CIVIL ---" in text
+    assert "texto de enderecamento_fatos" in text and "texto de pedidos_encerramento" in text
+    assert text.count("texto de topico") == 1
+    assert set(saved) == {"planejamento", "enderecamento_fatos", "topico:2.2 DOS DANOS MORAIS", "pedidos_encerramento"}
+    assert closed == [len(calls)] # Fechado uma vez, depois da última etapa
+
+
+def test_checkpointed_steps_are_not_called_again(fake_gemini):
+    calls, closed = fake_gemini
+    completed = {"planejamento": PLAN, "enderecamento_fatos": "fatos salvos", "topico:2.2 DOS DANOS MORAIS": "tópico salvo"}
+    text = utils.generate_petition_gemini_flow("chave", USER_DATA, checkpoint=utils.GeminiFlowCheckpoint(completed))
+
+    assert sorted(calls) == ["pedidos_encerramento", "topico"]
+    assert "fatos salvos" in text and "tópico salvo" in text
@@ -0,0 +1,28 @@
+import pytest
+
+from jurisprudence import JurisprudenceStore
+
+RULINGS = [
+    {"id": "1", "tribunal": "STJ", "processo": "REsp 1", "ementa": "ATRASO DE VOO. DANO MORAL IN RE IPSA. INDENIZAÇÃO DEVIDA."},
+    {"id": "2", "tribunal": "TJSP", "processo": "AC 2", "ementa": "Contrato bancário. Revisão de juros. Ausência de dano."},
+    {"id": "3", "tribunal": "TJSP", "processo": "AC 3", "ementa": "Extravio de bagagem em voo internacional. Danos materiais comprovados."},
+]
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = JurisprudenceStore(str(tmp_path / "jurisprudencia.db"))
+    store.import_records(RULINGS)
+    return store
+
+
+def test_search_tribunal_with_quotes_is_escaped(store):
+    assert store.search("dano moral voo", tribunal='S"TJ') == []
+    assert [ruling["fonte_id"] for ruling in store.search("dano moral voo", tribunal="stj")] == ["1"]
+
+
+def test_search_matches_singular_and_plural(store):
+    results = store.search("DOS DANOS MORAIS", limit=1)
+    assert [ruling["fonte_id"] for ruling in results] == ["1"]
+    assert "\x02DANO\x03 \x02MORAL\x03" in results[0]["trecho"]
+    assert [ruling["fonte_id"] for ruling in store.search("dano material bagagens", limit=1)] == ["3"]
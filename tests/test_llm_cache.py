@@ -0,0 +1,56 @@
+import sqlite3
+
+import pytest
+
+from llm_cache import ResponseCache, cached_call, cached_stream
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResponseCache(str(tmp_path / "llm_cache.db"))
+
+
+def stored_rows(cache):
+    with sqlite3.connect(cache.db_path) as conn:
+        return conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+
+
+@pytest.mark.parametrize("response", [
+    "Erro: Cota da API Gemini excedida.",
+    "",
+    None,
+    {"error": "agente indisponível"},
+    {"response": ""},
+    {"response": None, "conversationId": "abc"},
+])
+def test_errors_and_empty_responses_are_never_cached(cache, response):
+    calls = []
+
+    def call():
+        calls.append(1)
+        return response
+
+    assert cached_call(("chatvolt", "agente", "prompt"), call, cache) == response
+    assert cached_call(("chatvolt", "agente", "prompt"), call, cache) == response
+    assert len(calls) == 2
+    assert stored_rows(cache) == 0
+
+
+@pytest.mark.parametrize("response", ["petição gerada", {"response": "petição gerada", "conversationId": "abc"}])
+def test_successful_responses_are_cached_across_processes(cache, response):
+    calls = []
+
+    def call():
+        calls.append(1)
+        return response
+
+    assert cached_call(("groq", "modelo", "prompt"), call, cache) == response
+    assert cached_call(("groq", "modelo", "prompt"), call, ResponseCache(cache.db_path)) == response # Outro worker: camada SQLite
+    assert len(calls) == 1
+
+
+def test_stream_with_an_error_piece_is_not_cached(cache):
+    assert list(cached_stream(("groq", "stream"), lambda: iter(["início ", "Erro: conexão perdida"]), cache)) == ["início ", "Erro: conexão perdida"]
+    assert stored_rows(cache) == 0
+    assert list(cached_stream(("groq", "stream"), lambda: iter(["início ", "fim"]), cache)) == ["início ", "fim"]
+    assert list(cached_stream(("groq", "stream"), lambda: iter(["não chamado"]), cache)) == ["início fim"]
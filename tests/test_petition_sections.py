@@ -0,0 +1,88 @@
+import json
+
+import pytest
+
+import utils
+
+PIECES = [
+    utils.render_section("enderecamento_fatos", "EXCELENTÍSSIMO... DOS FATOS"),
+    utils.LAW_SECTION_HEADER,
+    utils.render_section("topico", "2.1 DA RESPONSABILIDADE CIVIL\ntexto original", "2.1 DA RESPONSABILIDADE CIVIL"),
+    utils.render_section("topico", "2.2 DOS DANOS MORAIS\ntexto original", "2.2 DOS DANOS MORAIS"),
+    utils.render_section("pedidos_encerramento", "3. DOS PEDIDOS"),
+]
+
+
+def test_petition_sections_round_trip():
+    text = utils.PetitionText(PIECES)
+    sections = utils.petition_sections([text, "\nNestes termos,", " pede deferimento."])
+
+    assert "".join(section["text"] for section in sections) == text + "\nNestes termos, pede deferimento."
+    assert [section["kind"] for section in sections] == ["enderecamento_fatos", "texto", "topico", "topico", "pedidos_encerramento", "texto"]
+    assert [section["title"] for section in sections if section["kind"] == "topico"] == ["2.1 DA RESPONSABILIDADE CIVIL", "2.2 DOS DANOS MORAIS"]
+    assert json.loads(json.dumps(sections)) == sections # Gravadas como JSON em Petition.sections
+
+
+@pytest.fixture
+def petition(app_module, request):
+    app, db, User = app_module.app, app_module.db, app_module.User
+    with app.app_context():
+        user = User(name="Seções", email=f"secoes-{request.node.name}@exemplo.com", password_hash="-", tokens=5)
+        db.session.add(user)
+        db.session.commit()
+        petition = app_module.save_petition(user.id, "gemini_flow", {"assunto_principal": "atraso de voo"}, [utils.PetitionText(PIECES)])
+        db.session.commit()
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user.id
+        return client, user.id, petition.id
+
+
+def stored_sections(app_module, petition_id):
+    with app_module.app.app_context():
+        return app_module.db.session.get(app_module.Petition, petition_id).section_list
+
+
+def token_balance(app_module, user_id):
+    with app_module.app.app_context():
+        return app_module.current_token_balance(user_id)
+
+
+def test_regenerate_section_replaces_only_that_section(app_module, petition, monkeypatch):
+    client, user_id, petition_id = petition
+    before = stored_sections(app_module, petition_id)
+    monkeypatch.setattr(utils, "generate_petition_section",
+                        lambda api_key, user_data, sections, kind, title=None, current_text=None, instructions="":
+                        utils.render_section(kind, f"{title}\ntexto novo ({instructions})", title))
+
+    response = client.post(f"/api/petitions/{petition_id}/sections/3/regenerate", json={"instrucoes": "mais curto"})
+
+    assert response.status_code == 200
+    after = stored_sections(app_module, petition_id)
+    assert after[3]["text"] == "\n2.2 DOS DANOS MORAIS\ntexto novo (mais curto)\n"
+    assert after[:3] + after[4:] == before[:3] + before[4:]
+    assert response.get_json()["generated_petition"] == "".join(section["text"] for section in after)
+    assert token_balance(app_module, user_id) == 4
+
+
+def test_regenerate_section_conflicting_update_is_rejected(app_module, petition, monkeypatch):
+    client, user_id, petition_id = petition
+
+    def generate_while_another_request_saves(api_key, user_data, sections, kind, title=None, current_text=None, instructions=""):
+        # Outra regeneração da mesma petição termina enquanto esta ainda está gerando
+        with app_module.app.app_context():
+            concurrent = app_module.db.session.get(app_module.Petition, petition_id)
+            concurrent_sections = concurrent.section_list
+            concurrent_sections[2]["text"] = "\n2.1 DA RESPONSABILIDADE CIVIL\nversão concorrente\n"
+            concurrent.sections = json.dumps(concurrent_sections, ensure_ascii=False)
+            app_module.db.session.commit()
+        return utils.render_section(kind, f"{title}\ntexto novo", title)
+
+    monkeypatch.setattr(utils, "generate_petition_section", generate_while_another_request_saves)
+    response = client.post(f"/api/petitions/{petition_id}/sections/3/regenerate", json={})
+
+    assert response.status_code == 409
+    after = stored_sections(app_module, petition_id)
+    assert after[2]["text"].endswith("versão concorrente\n") # A gravação concorrente não é sobrescrita
+    assert after[3]["text"] == "\n2.2 DOS DANOS MORAIS\ntexto original\n"
+    assert token_balance(app_module, user_id) == 5 # Reserva estornada
@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+import utils
+
+FALLBACK = [f"2.{number} {title}" for number, title in enumerate(utils.GEMINI_FALLBACK_LAW_TOPICS, start=1)]
+
+
+def plan(*titles):
+    return json.dumps({"topicos": list(titles)}, ensure_ascii=False)
+
+
+@pytest.mark.parametrize("plan_text, max_topics, expected", [
+    # JSON pedido pelo gemini_prompt_plan
+    (plan("DA RESPONSABILIDADE CIVIL", "DOS DANOS MORAIS"), 4, ["2.1 DA RESPONSABILIDADE CIVIL", "2.2 DOS DANOS MORAIS"]),
+    ("```json\n" + plan("Dos danos morais") + "\n```", 4, ["2.1 DOS DANOS MORAIS"]),
+    (plan("2.3. Dos danos morais:", "b) do dano material", "- \"Da tutela de urgência\""), 4,
+     ["2.1 DOS DANOS MORAIS", "2.2 DO DANO MATERIAL", "2.3 DA TUTELA DE URGÊNCIA"]),
+    # Temas repetidos: mesmo radical, ou título que só detalha outro; danos morais e materiais são temas diferentes
+    (plan("DOS DANOS MORAIS", "DO DANO MORAL", "DA RESPONSABILIDADE CIVIL", "DA RESPONSABILIDADE CIVIL OBJETIVA", "DOS DANOS MATERIAIS"), 6,
+     ["2.1 DOS DANOS MORAIS", "2.2 DA RESPONSABILIDADE CIVIL", "2.3 DOS DANOS MATERIAIS"]),
+    # Limite de tópicos do plano do usuário
+    (plan("DA RESPONSABILIDADE CIVIL", "DOS DANOS MORAIS", "DOS DANOS MATERIAIS", "DA TUTELA DE URGÊNCIA"), 2,
+     ["2.1 DA RESPONSABILIDADE CIVIL", "2.2 DOS DANOS MORAIS"]),
+    # Resposta em texto: só as linhas "2.x TÍTULO"
+    ("Segue o plano:\n2.1 DA RESPONSABILIDADE CIVIL\n- observação sobre o caso\n2.2 DOS DANOS MORAIS\n3. DOS PEDIDOS", 4,
+     ["2.1 DA RESPONSABILIDADE CIVIL", "2.2 DOS DANOS MORAIS"]),
+    # Entradas inválidas no meio de títulos válidos
+    (json.dumps({"topicos": [1, None, "DO DA", "A" * 300 + " TEXTO", "DOS DANOS MORAIS"]}), 4, ["2.1 DOS DANOS MORAIS"]),
+    # Nada aproveitável: tópicos padrão, também limitados
+    ("", 4, FALLBACK),
+    (plan(), 4, FALLBACK),
+    (json.dumps({"topicos": "DOS DANOS MORAIS"}), 4, FALLBACK),
+    ('{"topicos": ["DOS DANOS', 4, FALLBACK),
+    ("Não consegui identificar os tópicos.", 2, FALLBACK[:2]),
+])
+def test_plan_law_topics(plan_text, max_topics, expected):
+    assert utils.plan_law_topics(plan_text, max_topics) == expected
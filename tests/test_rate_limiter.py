@@ -0,0 +1,14 @@
+import sqlite3
+
+import utils
+
+
+class LockedLease:
+    def release(self, actual_tokens=None):
+        raise sqlite3.OperationalError("database is locked")
+
+
+def test_release_error_does_not_replace_the_provider_result(monkeypatch):
+    monkeypatch.setattr(utils, "acquire_provider_slot", lambda provider, model, tokens: LockedLease())
+    assert utils.measured_call("groq", "modelo", "completa", "prompt", lambda: "petição gerada") == "petição gerada"
+    assert list(utils.measured_stream("groq", "modelo", "completa", "prompt", lambda: iter(["peti", "ção"]))) == ["peti", "ção"]
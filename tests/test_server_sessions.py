@@ -0,0 +1,66 @@
+from flask import Flask, session
+
+from server_sessions import ServerSideSessionInterface, SessionStore
+
+
+class DictSessionStore(SessionStore):
+    def __init__(self):
+        self.sessions = {}
+
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+
+    def set(self, session_id, data, expires_at):
+        self.sessions[session_id] = (data, expires_at)
+
+    def delete(self, session_id):
+        self.sessions.pop(session_id, None)
+
+
+def make_app(store):
+    app = Flask(__name__)
+    app.secret_key = "chave-dos-testes"
+    app.session_interface = ServerSideSessionInterface(store)
+
+    @app.route("/visita")
+    def visit():
+        session["carrinho"] = "antes do login"
+        return ""
+
+    @app.route("/login")
+    def login():
+        session.clear()
+        app.session_interface.regenerate(session)
+        session["user_id"] = 1
+        return ""
+
+    @app.route("/logout")
+    def logout():
+        session.clear()
+        app.session_interface.regenerate(session)
+        session["_flashes"] = [("info", "Você foi desconectado.")]
+        return ""
+
+    return app
+
+
+def session_cookie(client):
+    return client.get_cookie("session").value
+
+
+def test_login_and_logout_issue_a_new_session_id():
+    store = DictSessionStore()
+    client = make_app(store).test_client()
+    client.get("/visita")
+    fixated_id = session_cookie(client)
+    assert fixated_id in store.sessions
+
+    client.get("/login")
+    logged_in_id = session_cookie(client)
+    assert logged_in_id != fixated_id
+    assert list(store.sessions) == [logged_in_id] # A sessão de antes do login não existe mais
+
+    client.get("/logout")
+    assert session_cookie(client) != logged_in_id
+    assert logged_in_id not in store.sessions
+    assert len(store.sessions) == 1
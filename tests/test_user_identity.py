@@ -0,0 +1,19 @@
+import time
+
+
+def test_select_agents_page_reads_agent_from_database(app_module):
+    """O cache de identidade de outro worker não é invalidado por esta escrita; a página mostra o valor do banco."""
+    app, db, User = app_module.app, app_module.db, app_module.User
+    with app.app_context():
+        user = User(name="Outro Worker", email="outro-worker@exemplo.com", password_hash="-", selected_agent="gemini_flow")
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+    # Como se o cache deste processo tivesse sido preenchido antes de outro worker gravar "gemini_flow"
+    app_module._user_identity_cache[user_id] = (time.time() + 60, {"is_active": True, "plan": "free", "selected_agent": "simulated"})
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+    page = client.get('/selecionar-agentes').get_data(as_text=True)
+    assert '<option value="gemini_flow" selected>' in page
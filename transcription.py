@@ -0,0 +1,184 @@
+import os
+import re
+import json
+import wave
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# --- Transcrição de Áudio em Trechos ---
+# O áudio é dividido em trechos de duração fixa com uma pequena sobreposição, os trechos são
+# transcritos em paralelo por um backend plugável e os textos são costurados na ordem,
+# removendo as palavras repetidas na sobreposição.
+TRANSCRIPTION_CHUNK_SECONDS = int(os.getenv("TRANSCRIPTION_CHUNK_SECONDS", "120"))
+TRANSCRIPTION_OVERLAP_SECONDS = int(os.getenv("TRANSCRIPTION_OVERLAP_SECONDS", "3"))
+TRANSCRIPTION_WORKERS = int(os.getenv("TRANSCRIPTION_WORKERS", "8"))
+TRANSCRIPTION_LANGUAGE = os.getenv("TRANSCRIPTION_LANGUAGE", "pt")
+MAX_STITCH_OVERLAP_WORDS = 40
+
+
+class TranscriptionBackend:
+    """Interface dos backends: transcreve um arquivo de áudio curto e devolve o texto (ou "Erro...")."""
+    name = "base"
+
+    def transcribe(self, audio_path, language=TRANSCRIPTION_LANGUAGE):
+        raise NotImplementedError
+
+
+class LocalStandInBackend(TranscriptionBackend):
+    """Backend local, sem rede, para desenvolvimento e testes: devolve um texto determinístico por trecho."""
+    name = "local"
+
+    def transcribe(self, audio_path, language=TRANSCRIPTION_LANGUAGE):
+        duration = audio_duration_seconds(audio_path)
+        size = os.path.getsize(audio_path)
+        duration_text = f"{duration:.1f}s" if duration is not None else "duração desconhecida"
+        return f"[Transcrição simulada de {os.path.basename(audio_path)}: {duration_text}, {size} bytes]"
+
+
+class GroqWhisperBackend(TranscriptionBackend):
+    """Transcrição pela API de áudio da Groq (Whisper), compatível com a da OpenAI."""
+    name = "groq_whisper"
+
+    def __init__(self, api_key, base_url, http_session, model="whisper-large-v3", timeout=(5, 300)):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.http_session = http_session
+        self.model = model
+        self.timeout = timeout
+
+    def transcribe(self, audio_path, language=TRANSCRIPTION_LANGUAGE):
+        if not self.api_key: return "Erro: Chave API Groq não configurada para transcrição."
+        try:
+            with open(audio_path, "rb") as audio_file:
+                response = self.http_session.post(
+                    f"{self.base_url}/audio/transcriptions",
+                    headers={"Authorization": f"Bearer {self.api_key}"},
+                    files={"file": (os.path.basename(audio_path), audio_file)},
+                    data={"model": self.model, "language": language, "response_format": "json"},
+                    timeout=self.timeout
+                )
+            response.raise_for_status()
+            return (response.json().get("text") or "").strip()
+        except Exception as e:
+            return f"Erro na transcrição (Groq): {e}"
+
+
+def audio_duration_seconds(audio_path):
+    """Duração do áudio em segundos (wav pela biblioteca padrão, demais formatos pelo ffprobe) ou None."""
+    if audio_path.lower().endswith(".wav"):
+        try:
+            with wave.open(audio_path, "rb") as wav_file:
+                return wav_file.getnframes() / float(wav_file.getframerate())
+        except (wave.Error, EOFError):
+            pass
+    if shutil.which("ffprobe"):
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "json", audio_path],
+            capture_output=True, text=True
+        )
+        try:
+            return float(json.loads(result.stdout)["format"]["duration"])
+        except (ValueError, KeyError):
+            return None
+    return None
+
+
+def chunk_boundaries(duration, chunk_seconds=TRANSCRIPTION_CHUNK_SECONDS, overlap_seconds=TRANSCRIPTION_OVERLAP_SECONDS):
+    """Lista de (início, duração) dos trechos; cada trecho começa overlap_seconds antes do fim do anterior."""
+    boundaries, start = [], 0.0
+    step = max(1, chunk_seconds - overlap_seconds)
+    while start < duration:
+        boundaries.append((start, min(chunk_seconds, duration - start)))
+        if start + chunk_seconds >= duration: break
+        start += step
+    return boundaries
+
+
+def _split_wav(audio_path, boundaries, output_dir):
+    paths = []
+    with wave.open(audio_path, "rb") as source:
+        params = source.getparams()
+        for index, (start, length) in enumerate(boundaries):
+            source.setpos(int(start * params.framerate))
+            frames = source.readframes(int(length * params.framerate))
+            chunk_path = os.path.join(output_dir, f"trecho_{index:03d}.wav")
+            with wave.open(chunk_path, "wb") as chunk_file:
+                chunk_file.setparams(params)
+                chunk_file.writeframes(frames)
+            paths.append(chunk_path)
+    return paths
+
+
+def _split_with_ffmpeg(audio_path, boundaries, output_dir):
+    paths = []
+    for index, (start, length) in enumerate(boundaries):
+        chunk_path = os.path.join(output_dir, f"trecho_{index:03d}.mp3")
+        subprocess.run(
+            ["ffmpeg", "-v", "error", "-y", "-ss", str(start), "-t", str(length), "-i", audio_path,
+             "-ac", "1", "-ar", "16000", chunk_path],
+            check=True
+        )
+        paths.append(chunk_path)
+    return paths
+
+
+def split_audio(audio_path, output_dir, chunk_seconds=TRANSCRIPTION_CHUNK_SECONDS, overlap_seconds=TRANSCRIPTION_OVERLAP_SECONDS):
+    """
+    Divide o áudio em trechos sobrepostos dentro de output_dir e devolve os caminhos, em ordem.
+    Sem como medir ou cortar o arquivo (formato comprimido sem ffmpeg), devolve o arquivo inteiro.
+    """
+    duration = audio_duration_seconds(audio_path)
+    if duration is None or duration <= chunk_seconds:
+        return [audio_path]
+    boundaries = chunk_boundaries(duration, chunk_seconds, overlap_seconds)
+    if audio_path.lower().endswith(".wav"):
+        return _split_wav(audio_path, boundaries, output_dir)
+    if shutil.which("ffmpeg"):
+        return _split_with_ffmpeg(audio_path, boundaries, output_dir)
+    return [audio_path]
+
+
+def _words(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def stitch_transcripts(texts, max_overlap_words=MAX_STITCH_OVERLAP_WORDS):
+    """Junta as transcrições dos trechos removendo, no início de cada uma, as palavras já presentes no fim da anterior."""
+    stitched = ""
+    for text in texts:
+        text = text.strip()
+        if not text: continue
+        if not stitched:
+            stitched = text
+            continue
+        tail = _words(stitched)[-max_overlap_words:]
+        head_tokens = text.split()
+        head_words = [_words(token) for token in head_tokens[:max_overlap_words]]
+        overlap = 0
+        for size in range(min(len(tail), len(head_words)), 0, -1):
+            candidate = [word for token_words in head_words[:size] for word in token_words]
+            if candidate and tail[-len(candidate):] == candidate:
+                overlap = size
+                break
+        remainder = " ".join(head_tokens[overlap:])
+        if remainder:
+            stitched = f"{stitched} {remainder}"
+    return stitched
+
+
+def transcribe_audio_file(audio_path, backend, max_workers=TRANSCRIPTION_WORKERS, language=TRANSCRIPTION_LANGUAGE):
+    """
+    Divide, transcreve os trechos em paralelo e devolve (texto costurado, número de trechos com erro).
+    Trechos com erro ficam marcados no texto; se todos falharem, o texto é a mensagem "Erro..." do backend.
+    """
+    with tempfile.TemporaryDirectory(prefix="transcricao_") as output_dir:
+        chunk_paths = split_audio(audio_path, output_dir)
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="transcription") as executor:
+            texts = list(executor.map(lambda path: backend.transcribe(path, language), chunk_paths))
+    failed = [index for index, text in enumerate(texts) if text.startswith("Erro")]
+    if len(failed) == len(texts):
+        return texts[0], len(failed)
+    texts = [f"[Trecho {index + 1} não transcrito: {text}]" if index in failed else text for index, text in enumerate(texts)]
+    return stitch_transcripts(texts), len(failed)
@@ -0,0 +1,143 @@
+import io
+import os
+import time
+import hashlib
+import tempfile
+
+from flask import Request
+
+# --- Armazenamento dos Uploads ---
+# Os arquivos enviados são gravados em disco enquanto o multipart é lido (UploadRequest) e o
+# SHA-256 é calculado no caminho. Depois cada arquivo é movido, sem cópia, para
+# UPLOAD_FOLDER/objects/ab/<sha256>, então arquivos idênticos ocupam um blob só e são extraídos uma vez só.
+# As referências de cada usuário ficam no banco (StoredUpload, em app.py); `flask gc-uploads`
+# remove os blobs sem referência.
+UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", "uploads")
+UPLOAD_SPOOL_MAX_MEMORY = int(os.getenv("UPLOAD_SPOOL_MAX_MEMORY", str(64 * 1024))) # Acima disso, o upload vai para o disco
+UPLOAD_GC_GRACE_SECONDS = 60 * 60 # Blobs recém-gravados cuja referência ainda não foi salva
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+class HashingSpooledFile:
+    """
+    Destino de um arquivo do multipart: fica em memória até max_size bytes e depois num arquivo
+    nomeado em staging_dir (que UploadStore.save move para o lugar do blob). Calcula o SHA-256 a cada write.
+    """
+
+    def __init__(self, staging_dir, max_size=UPLOAD_SPOOL_MAX_MEMORY):
+        self.staging_dir = staging_dir
+        self.max_size = max_size
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self._file = io.BytesIO()
+        self.name = None # Caminho em staging_dir, depois de ir para o disco
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        if self.name is None and self.size > self.max_size:
+            staged = tempfile.NamedTemporaryFile(dir=self.staging_dir, prefix="upload_", delete=False)
+            staged.write(self._file.getvalue())
+            self._file, self.name = staged, staged.name
+        return self._file.write(data)
+
+    def close(self):
+        self._file.close()
+        if self.name and os.path.exists(self.name): os.remove(self.name) # Não foi para o armazenamento
+
+    def __getattr__(self, attribute): # read, readline, seek, tell, flush... do arquivo atual
+        return getattr(self._file, attribute)
+
+    def __iter__(self):
+        return iter(self._file)
+
+
+class StoredFile:
+    def __init__(self, sha256, size, path, filename):
+        self.sha256 = sha256
+        self.size = size
+        self.path = path
+        self.filename = filename
+
+    @property
+    def extension(self):
+        return self.filename.rsplit('.', 1)[-1].lower() if '.' in self.filename else ""
+
+
+class UploadStore:
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.staging_dir = os.path.join(root, "staging")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256[:2], sha256)
+
+    def save(self, file_storage):
+        """
+        Guarda um upload (FileStorage) no armazenamento endereçado pelo conteúdo e devolve o StoredFile.
+        Se o blob já existe, o upload é descartado; senão o arquivo em staging é movido para o lugar.
+        """
+        stream = file_storage.stream
+        if isinstance(stream, HashingSpooledFile): # Já lido e com hash calculado (ver UploadRequest)
+            sha256, size = stream.sha256.hexdigest(), stream.size
+            if stream.name is None: # Pequeno, ainda em memória
+                staged_path = self._stage_chunks([stream.getvalue()])[0]
+            else:
+                stream.flush()
+                staged_path = stream.name
+        else: # Outros streams (ex.: FileStorage criado fora de uma requisição): copia em blocos
+            stream.seek(0)
+            staged_path, sha256, size = self._stage_chunks(iter(lambda: stream.read(FILE_CHUNK_SIZE), b""))
+        path = self.blob_path(sha256)
+        if os.path.exists(path):
+            if staged_path != getattr(stream, "name", None): os.remove(staged_path) # O do stream é removido no close()
+            os.utime(path) # Renova a data do blob para a carência do gc
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(staged_path, path) # Atômico no mesmo sistema de arquivos
+        return StoredFile(sha256, size, path, file_storage.filename)
+
+    def _stage_chunks(self, chunks):
+        sha256, size = hashlib.sha256(), 0
+        with tempfile.NamedTemporaryFile(dir=self.staging_dir, prefix="upload_", delete=False) as staged:
+            for chunk in chunks:
+                sha256.update(chunk)
+                size += len(chunk)
+                staged.write(chunk)
+        return staged.name, sha256.hexdigest(), size
+
+    def iter_blobs(self):
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            for sha256 in os.listdir(prefix_dir):
+                yield sha256, os.path.join(prefix_dir, sha256)
+
+    def collect_garbage(self, referenced, grace_seconds=UPLOAD_GC_GRACE_SECONDS):
+        """Remove os blobs fora de referenced (conjunto de SHA-256) e os restos de staging mais antigos que a carência. Devolve (removidos, bytes)."""
+        removed, freed = 0, 0
+        cutoff = time.time() - grace_seconds
+        candidates = [path for sha256, path in self.iter_blobs() if sha256 not in referenced]
+        candidates += [os.path.join(self.staging_dir, name) for name in os.listdir(self.staging_dir)]
+        for path in candidates:
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime > cutoff: continue
+                os.remove(path)
+            except FileNotFoundError: # Removido por outro processo
+                continue
+            removed += 1
+            freed += stat.st_size
+        return removed, freed
+
+
+upload_store = UploadStore(UPLOAD_FOLDER)
+
+
+class UploadRequest(Request):
+    """Request do Flask que grava os arquivos do multipart direto no staging de upload_store, com o hash calculado na leitura."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingSpooledFile(upload_store.staging_dir)
@@ -1,16 +1,39 @@
 import os
+import re
+import json
+import logging
+import tempfile
+import threading
+import unicodedata
+import multiprocessing
+from datetime import timedelta
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, CancelledError, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
 from docx import Document as DocxDocument
 import google.generativeai as genai # Para Gemini
+from llm_cache import cached_call, cached_stream, make_cache_key, ResponseCache, LLM_CACHE_PATH
+from prompt_budget import BudgetedPrompt, estimate_tokens, STOPWORDS
+from metrics import provider_call, provider_retries
+from rate_limiter import acquire_provider_slot, release_provider_slot, report_provider_throttle, rate_limit_error
+from jurisprudence import jurisprudence_for_topic
+from structured_logging import stage_var, in_current_context
+from transcription import GroqWhisperBackend, LocalStandInBackend, transcribe_audio_file, TRANSCRIPTION_LANGUAGE
+
+logger = logging.getLogger(__name__) # Logs da geração: INFO sujeito a LOG_GENERATION_INFO_SAMPLE_RATE
 
 # --- Constantes e Configurações ---
-GROQ_API_BASE_URL = "https://api.groq.com/openai/v1"
-CHATVOLT_API_BASE_URL = "https://api.chatvolt.ai/agents" # Verifique se é o endpoint correto
+GROQ_API_BASE_URL = os.getenv("GROQ_API_BASE_URL", "https://api.groq.com/openai/v1")
+CHATVOLT_API_BASE_URL = os.getenv("CHATVOLT_API_BASE_URL", "https://api.chatvolt.ai/agents") # Verifique se é o endpoint correto
 
 ALLOWED_TEXT_EXTENSIONS = ["txt", "pdf", "docx"]
 ALLOWED_AUDIO_EXTENSIONS = ["mp3", "wav", "m4a", "ogg"]
 
+CHATVOLT_MAX_OUTPUT_TOKENS = int(os.getenv("CHATVOLT_MAX_OUTPUT_TOKENS", "4000")) # Reservado para a resposta do agente
+
 # Template do prompt completo para Chatvolt (você forneceu)
 CHATVOLT_FULL_PROMPT_TEMPLATE = """### INÍCIO DO PROMPT
 
@@ -143,6 +166,137 @@ def create_docx_from_text(text_content, title="Petição Gerada"):
     bio.seek(0)
     return bio
 
+# --- Extração de Texto de Documentos ---
+# Os arquivos já estão no armazenamento de uploads (ver upload_storage.py) e são extraídos de lá em
+# paralelo num pool de processos (o parsing de PDF é CPU-bound); o texto fica em cache pelo SHA-256 do arquivo.
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", "2"))
+EXTRACTION_TIMEOUT_SECONDS = int(os.getenv("EXTRACTION_TIMEOUT_SECONDS", "120"))
+
+document_text_cache = ResponseCache(LLM_CACHE_PATH, max_entries=64, ttl_seconds=30 * 24 * 60 * 60)
+_extraction_executor = None
+_extraction_executor_lock = threading.Lock()
+
+def extraction_mp_context():
+    # Sem fork: o worker do gunicorn já tem threads rodando (fila de logs, pools, sessões HTTP) e um
+    # fork no meio de um lock travaria o filho. O forkserver (ou spawn) parte de um processo limpo.
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    context = multiprocessing.get_context(method)
+    if method == "forkserver": context.set_forkserver_preload([__name__]) # Importado uma vez só, no servidor
+    return context
+
+def get_extraction_executor():
+    # Criado sob demanda, para que cada worker do gunicorn tenha o seu pool
+    global _extraction_executor
+    with _extraction_executor_lock:
+        if _extraction_executor is None:
+            _extraction_executor = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, mp_context=extraction_mp_context())
+        return _extraction_executor
+
+def discard_extraction_executor(executor):
+    """Descarta o pool depois de um timeout: os processos (inclusive o travado) são terminados e o próximo uso cria outro pool."""
+    global _extraction_executor
+    with _extraction_executor_lock:
+        if _extraction_executor is executor: _extraction_executor = None
+    processes = list((executor._processes or {}).values()) # O shutdown limpa a referência
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        if process.is_alive(): process.terminate()
+
+def submit_extraction(stored_file):
+    executor = get_extraction_executor()
+    return executor, executor.submit(extract_text_from_path, stored_file.path, stored_file.extension)
+
+def extract_text_from_path(path, extension):
+    """Extrai o texto de um arquivo txt/pdf/docx, página a página ou parágrafo a parágrafo."""
+    extension = extension.lower()
+    text_parts = []
+    if extension == "txt":
+        with open(path, "r", encoding="utf-8", errors="replace") as text_file:
+            for line in text_file:
+                text_parts.append(line)
+        return "".join(text_parts).strip()
+    if extension == "pdf":
+        from pypdf import PdfReader
+        reader = PdfReader(path) # Lê o arquivo sob demanda, uma página por vez
+        for page in reader.pages:
+            page_text = page.extract_text() or ""
+            if page_text.strip(): text_parts.append(page_text.strip())
+        return "\n\n".join(text_parts)
+    if extension == "docx":
+        document = DocxDocument(path)
+        for paragraph in document.paragraphs:
+            if paragraph.text.strip(): text_parts.append(paragraph.text.strip())
+        return "\n".join(text_parts)
+    raise ValueError(f"Extensão não suportada: {extension}")
+
+def extract_texts_from_uploads(stored_files):
+    """
+    Extrai o texto de uma lista de uploads já armazenados (upload_storage.StoredFile) e devolve
+    [{"filename", "content"}] na mesma ordem. Arquivos já vistos (mesmo SHA-256) saem do cache sem
+    nova extração; os demais são extraídos em paralelo, uma vez só por conteúdo.
+    Se a extração de um arquivo falhar, o conteúdo dele é uma mensagem "Erro...".
+    """
+    documents = []
+    pending = {} # SHA-256 -> ((pool, future), chave de cache, índices dos documentos com esse conteúdo, arquivo)
+    for stored_file in stored_files:
+        cache_key = make_cache_key("document_text", stored_file.sha256)
+        cached_text = document_text_cache.get(cache_key) if stored_file.sha256 not in pending else None
+        documents.append({"filename": stored_file.filename, "content": cached_text or ""})
+        if cached_text is not None: continue
+        if stored_file.sha256 not in pending:
+            pending[stored_file.sha256] = (submit_extraction(stored_file), cache_key, [], stored_file)
+        pending[stored_file.sha256][2].append(len(documents) - 1)
+
+    for (executor, future), cache_key, indexes, stored_file in pending.values():
+        text, error = "", None
+        try:
+            try:
+                text = future.result(timeout=EXTRACTION_TIMEOUT_SECONDS)
+            except (BrokenProcessPool, CancelledError): # Pool descartado pelo timeout de outra extração: tenta de novo num pool novo
+                executor, future = submit_extraction(stored_file)
+                text = future.result(timeout=EXTRACTION_TIMEOUT_SECONDS)
+            if text: document_text_cache.set(cache_key, text)
+        except FutureTimeoutError:
+            error = f"tempo esgotado ({EXTRACTION_TIMEOUT_SECONDS}s)"
+            discard_extraction_executor(executor) # Senão o processo travado ocupa a vaga no pool para sempre
+        except Exception as e:
+            error = e
+        for index in indexes:
+            filename = documents[index]["filename"]
+            if error is not None:
+                documents[index]["content"] = f"Erro ao extrair o texto do arquivo {filename}: {error}"
+            else:
+                documents[index]["content"] = text or f"[Nenhum texto extraído do arquivo {filename}]"
+    return documents
+
+# --- Transcrição de Áudio ---
+TRANSCRIPTION_BACKEND = os.getenv("TRANSCRIPTION_BACKEND", "groq") # 'groq' (Whisper) ou 'local' (simulado, para testes)
+
+def get_transcription_backend(groq_api_key):
+    if TRANSCRIPTION_BACKEND == "local":
+        return LocalStandInBackend()
+    return GroqWhisperBackend(groq_api_key, GROQ_API_BASE_URL, get_provider_session("groq"))
+
+def transcribe_audio_upload(stored_file, groq_api_key):
+    """
+    Transcreve um upload de áudio já armazenado (upload_storage.StoredFile) em trechos paralelos
+    (ver transcription.py). O resultado fica em cache pelo SHA-256 do arquivo; transcrições com
+    trechos falhos não vão para o cache.
+    """
+    backend = get_transcription_backend(groq_api_key)
+    cache_key = make_cache_key("audio_transcript", stored_file.sha256, backend.name, TRANSCRIPTION_LANGUAGE)
+    cached_text = document_text_cache.get(cache_key)
+    if cached_text is not None:
+        return cached_text
+    with tempfile.TemporaryDirectory(prefix="audio_") as link_dir:
+        # O blob não tem extensão, e o corte dos trechos e a API de transcrição dependem dela
+        audio_path = os.path.join(link_dir, f"audio.{stored_file.extension}")
+        os.symlink(os.path.abspath(stored_file.path), audio_path)
+        text, failed_chunks = transcribe_audio_file(audio_path, backend)
+    if not failed_chunks and text:
+        document_text_cache.set(cache_key, text)
+    return text
+
 def simulated_petition_generation(tipo_peticao, assunto_principal, partes, fatos, outras_info, doc_files_info=None, audio_file_info=None):
     # (Sua lógica de simulação existente, pode ser simplificada ou mantida)
     from datetime import datetime
@@ -171,8 +325,121 @@ OAB/UF [XXXXX]
 
 # --- Funções de API ---
 
+# Clientes HTTP por provedor: sessões de longa duração (keep-alive, pool de conexões)
+# com novas tentativas e backoff exponencial com jitter em 429/5xx.
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", "1"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "10"))
+GROQ_TIMEOUT = (HTTP_CONNECT_TIMEOUT, float(os.getenv("GROQ_READ_TIMEOUT", "120"))) # (conexão, leitura)
+CHATVOLT_TIMEOUT = (HTTP_CONNECT_TIMEOUT, float(os.getenv("CHATVOLT_READ_TIMEOUT", "180")))
+
+_provider_sessions = {}
+_provider_sessions_lock = threading.Lock()
+
+class CountingRetry(Retry):
+    """Retry do urllib3 que conta cada nova tentativa (por provedor e motivo) nas métricas."""
+    provider = "desconhecido"
+
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.provider = self.provider
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        reason = f"http_{response.status}" if response is not None and response.status else (type(error).__name__ if error else "outro")
+        provider_retries.inc(provider=self.provider, reason=reason)
+        if response is not None and (response.status == 429 or response.headers.get("Retry-After")):
+            # Vale para todos os workers: as próximas chamadas a este provedor esperam na fila do rate_limiter
+            report_provider_throttle(self.provider, self.get_retry_after(response))
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+def measured_call(provider, model, stage, prompt_text, call, max_output_tokens=0):
+    """
+    Executa call() medindo a chamada ao provedor (ver metrics.provider_call), depois de obter vaga
+    nos limites de uso do provedor (ver rate_limiter); max_output_tokens entra na reserva de tokens.
+    """
+    lease = acquire_provider_slot(provider, model, estimate_tokens(prompt_text, model) + max_output_tokens)
+    if lease is None: return rate_limit_error(provider)
+    output_text = ""
+    try:
+        with provider_call(provider, model, stage) as measurement:
+            result = call()
+            output_text = result.get("response") if isinstance(result, dict) else result
+            output_text = output_text if isinstance(output_text, str) else ""
+            measurement.finish(prompt_text, output_text)
+        return result
+    finally:
+        release_provider_slot(provider, lease, estimate_tokens(prompt_text, model) + estimate_tokens(output_text, model))
+
+def measured_stream(provider, model, stage, prompt_text, stream_call, max_output_tokens=0):
+    """Versão de measured_call para geradores de texto: a medição e a vaga terminam no último pedaço."""
+    lease = acquire_provider_slot(provider, model, estimate_tokens(prompt_text, model) + max_output_tokens)
+    if lease is None:
+        yield rate_limit_error(provider)
+        return
+    pieces = []
+    try:
+        with provider_call(provider, model, stage) as measurement:
+            error_piece = None
+            try:
+                for piece in stream_call():
+                    if piece.startswith("Erro"): error_piece = piece
+                    pieces.append(piece)
+                    yield piece
+            except GeneratorExit: # Cliente desconectou antes do fim
+                measurement.outcome = "cancelled"
+                raise
+            measurement.finish(prompt_text, error_piece or "".join(pieces))
+    finally:
+        release_provider_slot(provider, lease, estimate_tokens(prompt_text, model) + estimate_tokens("".join(pieces), model))
+
+def messages_text(messages_history):
+    return "".join(message.get("content", "") for message in messages_history)
+
+def get_provider_session(provider):
+    """Devolve a requests.Session compartilhada do provedor ('groq', 'chatvolt'), criando-a na primeira chamada."""
+    with _provider_sessions_lock:
+        http_session = _provider_sessions.get(provider)
+        if http_session is None:
+            retry = CountingRetry(
+                total=HTTP_MAX_RETRIES,
+                read=0, # Timeout de leitura não se repete: o POST pode já estar gerando a petição no provedor
+                backoff_factor=HTTP_BACKOFF_FACTOR,
+                backoff_jitter=HTTP_BACKOFF_FACTOR / 2,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(["POST"]), # As chamadas de geração são todas POST
+                respect_retry_after_header=True,
+                raise_on_status=False # Esgotadas as tentativas, raise_for_status() gera o HTTPError de sempre
+            )
+            retry.provider = provider
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+            http_session = requests.Session()
+            http_session.mount("https://", adapter)
+            http_session.mount("http://", adapter)
+            _provider_sessions[provider] = http_session
+        return http_session
+
+def case_documents(user_data):
+    # Documentos anexos mais a transcrição do áudio, que passa pelo mesmo orçamento de tokens
+    documents = list(user_data['documentos_texto'])
+    if user_data.get('transcricao_audio'):
+        documents.append({"filename": "Transcrição do áudio enviado", "content": user_data['transcricao_audio']})
+    return documents
+
+def document_relevance_query(user_data, *extra_terms):
+    # Texto usado para escolher os trechos mais relevantes dos documentos quando eles não cabem no prompt
+    return " ".join([user_data['assunto_principal'], user_data['fatos_str'], *extra_terms])
+
+def log_prompt_report(label, budgeted_prompt):
+    report = budgeted_prompt.report()
+    logger.info(f"Orçamento do prompt {label} ({report['model']}): {report['input_tokens']} tokens de entrada, seções {report['sections']}"
+                + (f", documentos {report['documents']}" if 'documents' in report else ""),
+                extra={"prompt": label, "input_tokens": report['input_tokens']})
+    return budgeted_prompt.render()
+
 # Groq
-def build_groq_prompt(user_data):
+def build_groq_prompt(user_data, model_id="llama3-8b-8192", max_tokens=3500):
     # Constrói um prompt mais detalhado para Groq baseado nos dados do usuário
     # (Similar ao que você já tinha, pode refinar mais)
     prompt = f"Você é um assistente jurídico especializado em criar rascunhos de petições no Brasil.\n"
@@ -181,21 +448,26 @@ def build_groq_prompt(user_data):
     prompt += f"Descrição detalhada dos fatos: {user_data['fatos_str']}.\n"
     if user_data['outras_info_str']:
         prompt += f"Diretrizes adicionais ou pedidos específicos: {user_data['outras_info_str']}.\n"
-    if user_data['documentos_texto']:
-        prompt += "Conteúdo de documentos anexos (simulado):\n"
-        for doc in user_data['documentos_texto']:
-            prompt += f"- {doc['filename']}: {doc['content']}\n"
-    prompt += "\nPor favor, gere o rascunho da petição solicitado, estruturando-o adequadamente com seções como 'DOS FATOS', 'DOS FUNDAMENTOS JURÍDICOS', 'DOS PEDIDOS', etc. Adapte o tom e a formalidade ao tipo de peça jurídica. Use linguagem forense formal e cite dispositivos legais brasileiros."
-    return prompt
+    budgeted_prompt = BudgetedPrompt(model_id, max_tokens).add("dados_do_caso", prompt)
+    budgeted_prompt.add_documents("documentos", case_documents(user_data), document_relevance_query(user_data), "Conteúdo de documentos anexos e transcrições:\n")
+    budgeted_prompt.add("tarefa", "\nPor favor, gere o rascunho da petição solicitado, estruturando-o adequadamente com seções como 'DOS FATOS', 'DOS FUNDAMENTOS JURÍDICOS', 'DOS PEDIDOS', etc. Adapte o tom e a formalidade ao tipo de peça jurídica. Use linguagem forense formal e cite dispositivos legais brasileiros.")
+    return log_prompt_report("groq", budgeted_prompt)
 
 def query_groq_api(api_key, model_id, messages_history, temperature=0.7, max_tokens=3500):
-    # (Sua função query_groq_api existente)
+    # Respostas idênticas (mesmo modelo, mensagens e parâmetros) vêm do cache
+    return cached_call(
+        ("groq", model_id, messages_history, temperature, max_tokens),
+        lambda: measured_call("groq", model_id, "completa", messages_text(messages_history),
+                              lambda: _query_groq_api_uncached(api_key, model_id, messages_history, temperature, max_tokens), max_tokens)
+    )
+
+def _query_groq_api_uncached(api_key, model_id, messages_history, temperature=0.7, max_tokens=3500):
     if not api_key or not model_id: return "Erro: Chave API Groq ou modelo não configurado."
     url = f"{GROQ_API_BASE_URL}/chat/completions"
     headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
     payload = {"model": model_id, "messages": messages_history, "temperature": temperature, "max_tokens": max_tokens}
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=120)
+        response = get_provider_session("groq").post(url, headers=headers, json=payload, timeout=GROQ_TIMEOUT)
         response.raise_for_status()
         json_response = response.json()
         if json_response.get("choices") and len(json_response["choices"]) > 0:
@@ -206,8 +478,62 @@ def query_groq_api(api_key, model_id, messages_history, temperature=0.7, max_tok
         return f"Erro HTTP da API Groq: {http_err} - {response.text if 'response' in locals() else ''}"
     except Exception as e: return f"Erro na API Groq: {e}"
 
+def stream_groq_api(api_key, model_id, messages_history, temperature=0.7, max_tokens=3500):
+    """
+    Versão em streaming de query_groq_api: gera os pedaços de texto conforme a Groq
+    os envia (formato SSE compatível com a API da OpenAI). Erros são gerados como um
+    último pedaço começando com "Erro", no mesmo formato das mensagens de query_groq_api.
+    """
+    # Mesma chave de cache de query_groq_api: o texto completo é o mesmo
+    return cached_stream(
+        ("groq", model_id, messages_history, temperature, max_tokens),
+        lambda: measured_stream("groq", model_id, "completa", messages_text(messages_history),
+                                lambda: _stream_groq_api_uncached(api_key, model_id, messages_history, temperature, max_tokens), max_tokens)
+    )
+
+def _stream_groq_api_uncached(api_key, model_id, messages_history, temperature=0.7, max_tokens=3500):
+    if not api_key or not model_id:
+        yield "Erro: Chave API Groq ou modelo não configurado."
+        return
+    url = f"{GROQ_API_BASE_URL}/chat/completions"
+    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+    payload = {"model": model_id, "messages": messages_history, "temperature": temperature, "max_tokens": max_tokens, "stream": True}
+    try:
+        with get_provider_session("groq").post(url, headers=headers, json=payload, timeout=GROQ_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            for event, data in iter_sse_events(response):
+                if data == "[DONE]": break
+                choices = json.loads(data).get("choices") or [{}]
+                content = choices[0].get("delta", {}).get("content")
+                if content: yield content
+    except requests.exceptions.HTTPError as http_err:
+        yield f"Erro HTTP da API Groq: {http_err} - {response.text if 'response' in locals() else ''}"
+    except Exception as e:
+        yield f"Erro na API Groq: {e}"
+
 # Chatvolt
+def build_chatvolt_input(user_data):
+    # O prompt do Chatvolt é o que você forneceu, ele espera os dados brutos.
+    # Construa o input_text para o Chatvolt concatenando os dados do usuário.
+    input_text_for_chatvolt = (
+        f"Tipo de Peça: {user_data['tipo_peticao']}\nAssunto Principal: {user_data['assunto_principal']}\n"
+        f"Partes: {user_data['partes_str']}\nFatos: {user_data['fatos_str']}\nOutras Informações: {user_data['outras_info_str']}"
+    )
+    # O prompt extenso fica configurado no agente, mas também ocupa a janela de contexto
+    budgeted_prompt = BudgetedPrompt("chatvolt", CHATVOLT_MAX_OUTPUT_TOKENS)
+    budgeted_prompt.reserve("prompt_do_agente", CHATVOLT_FULL_PROMPT_TEMPLATE).add("dados_do_caso", input_text_for_chatvolt)
+    budgeted_prompt.add_documents("documentos", case_documents(user_data), document_relevance_query(user_data), "\n\nDocumentos Anexos:\n")
+    return log_prompt_report("chatvolt", budgeted_prompt)
+
 def query_chatvolt_agent_with_template(api_key, agent_id, user_query_data, prompt_template):
+    """Consulta o agente Chatvolt (ver _query_chatvolt_agent_uncached), com cache das respostas."""
+    return cached_call(
+        ("chatvolt", agent_id, user_query_data),
+        lambda: measured_call("chatvolt", "agente", "completa", user_query_data,
+                              lambda: _query_chatvolt_agent_uncached(api_key, agent_id, user_query_data, prompt_template), CHATVOLT_MAX_OUTPUT_TOKENS)
+    )
+
+def _query_chatvolt_agent_uncached(api_key, agent_id, user_query_data, prompt_template):
     """
     Envia uma consulta para um agente Chatvolt usando um template de prompt.
     A API do Chatvolt pode ter uma maneira específica de lidar com templates.
@@ -276,7 +602,7 @@ def query_chatvolt_agent_with_template(api_key, agent_id, user_query_data, promp
     }
 
     try:
-        response = requests.post(url, headers=headers, json=data_chatvolt, timeout=180)
+        response = get_provider_session("chatvolt").post(url, headers=headers, json=data_chatvolt, timeout=CHATVOLT_TIMEOUT)
         response.raise_for_status()
         # A resposta do Chatvolt pode variar. Ajuste conforme a documentação.
         # Exemplo: response.json() pode ser {"response": "texto da petição", "conversationId": "..."}
@@ -286,47 +612,194 @@ def query_chatvolt_agent_with_template(api_key, agent_id, user_query_data, promp
     except Exception as e:
         return f"Erro na API Chatvolt: {str(e)}"
 
+def stream_chatvolt_agent_with_template(api_key, agent_id, user_query_data, prompt_template):
+    """
+    Versão em streaming de query_chatvolt_agent_with_template ("streaming": True).
+    Gera os pedaços da resposta do agente conforme chegam; o evento final do Chatvolt
+    com o JSON completo da resposta é ignorado. Erros são gerados como um pedaço "Erro...".
+    """
+    return cached_stream(
+        ("chatvolt_stream", agent_id, user_query_data),
+        lambda: measured_stream("chatvolt", "agente", "completa", user_query_data,
+                                lambda: _stream_chatvolt_agent_uncached(api_key, agent_id, user_query_data, prompt_template), CHATVOLT_MAX_OUTPUT_TOKENS)
+    )
+
+def _stream_chatvolt_agent_uncached(api_key, agent_id, user_query_data, prompt_template):
+    if not api_key or not agent_id:
+        yield "Erro: Chave API Chatvolt ou ID do Agente não configurados."
+        return
+
+    url = f"{CHATVOLT_API_BASE_URL}/{agent_id}/query"
+    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json", "Accept": "text/event-stream"}
+    data_chatvolt = {"query": user_query_data, "streaming": True} # prompt_template fica configurado no agente, como na versão sem streaming
 
-# Gemini
-def query_gemini_api(api_key, model_name, prompt_text, max_output_tokens=8000):
-    if not api_key: return "Erro: Chave da API Gemini não fornecida."
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(
-            model_name,
-            generation_config=genai.types.GenerationConfig(
-                max_output_tokens=max_output_tokens,
-                temperature=0.7 # Ajuste conforme necessário
-            ),
-            # safety_settings ajustados para serem menos restritivos, CUIDADO em produção.
-            safety_settings=[
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-            ]
+        with get_provider_session("chatvolt").post(url, headers=headers, json=data_chatvolt, timeout=CHATVOLT_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            for event, data in iter_sse_events(response):
+                if data == "[DONE]": break
+                if event == "endpoint_response": continue # Resposta completa repetida no final
+                if data: yield data
+    except requests.exceptions.HTTPError as http_err:
+        yield f"Erro HTTP da API Chatvolt: {http_err} - {response.text if 'response' in locals() else ''}"
+    except Exception as e:
+        yield f"Erro na API Chatvolt: {str(e)}"
+
+def iter_sse_events(response):
+    """Lê uma resposta HTTP em server-sent events e gera tuplas (evento, dados)."""
+    event, data_lines = None, []
+    for line in response.iter_lines(decode_unicode=True):
+        if line is None: continue
+        if not line: # Linha em branco fecha o evento
+            if data_lines: yield event, "\n".join(data_lines)
+            event, data_lines = None, []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[len("data:"):].removeprefix(" "))
+    if data_lines: yield event, "\n".join(data_lines)
+
+
+# Gemini
+# Todas as chamadas passam pelo GeminiFlowContext (abaixo). genai.configure é global, então só é
+# chamado de novo quando a chave muda.
+_gemini_configured_api_key = None
+_gemini_configure_lock = threading.Lock()
+
+# safety_settings ajustados para serem menos restritivos, CUIDADO em produção.
+GEMINI_SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+def configure_gemini(api_key):
+    global _gemini_configured_api_key
+    with _gemini_configure_lock:
+        if api_key != _gemini_configured_api_key:
+            genai.configure(api_key=api_key)
+            _gemini_configured_api_key = api_key
+
+def gemini_error_message(e):
+    error_message = f"Erro ao contatar a API Gemini: {str(e)}"
+    if "API key not valid" in str(e):
+        error_message = "Erro: Chave da API Gemini inválida ou não configurada corretamente."
+    elif "quota" in str(e).lower():
+        error_message = "Erro: Cota da API Gemini excedida. Tente novamente mais tarde."
+    elif "resource_exhausted" in str(e).lower():
+         error_message = "Erro: Recursos da API Gemini esgotados (provavelmente cota). Tente novamente mais tarde."
+    if "quota" in str(e).lower() or "resource_exhausted" in str(e).lower() or "429" in str(e):
+        # 429 do Gemini: pausa as próximas chamadas pelo retry_delay informado (ou pela pausa padrão)
+        retry_delay = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", str(e))
+        report_provider_throttle("gemini", float(retry_delay.group(1)) if retry_delay else None)
+    logger.warning(error_message)
+    return error_message
+
+def gemini_response_text(response):
+    if response.parts:
+        return response.text
+    else:
+        # Se não há 'parts', pode ser um bloqueio ou outro problema.
+        # Imprime o motivo do bloqueio, se houver.
+        logger.warning(f"Resposta Gemini sem 'parts'. Bloqueio? {response.prompt_feedback}")
+        if response.prompt_feedback and response.prompt_feedback.block_reason:
+            return f"Erro: Conteúdo bloqueado pela API Gemini. Motivo: {response.prompt_feedback.block_reason_message or response.prompt_feedback.block_reason}"
+        return "Erro: Resposta da API Gemini vazia ou em formato inesperado."
+
+# Contexto compartilhado do fluxo Gemini: as instruções, os dados do caso e os documentos vão
+# uma única vez como system instruction (ou num cache explícito da API, quando grandes o
+# suficiente) e cada etapa envia só a sua tarefa. O prefixo idêntico entre as etapas também
+# aproveita o cache implícito de prefixos do Gemini.
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "4096"))
+GEMINI_CONTEXT_CACHE_TTL_MINUTES = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_MINUTES", "15"))
+
+class GeminiFlowContext:
+    def __init__(self, api_key, user_data, model_name):
+        self.api_key = api_key
+        self.model_name = model_name
+        self.system_instruction, self.context_tokens = gemini_case_context(user_data, model_name)
+        self.case_terms = user_data['assunto_principal'] # Entram na busca de jurisprudência dos tópicos
+        self.cached_content = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_model(self):
+        with self._lock:
+            if self._model is not None: return self._model
+            configure_gemini(self.api_key)
+            if self.context_tokens >= GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+                try:
+                    from google.generativeai import caching
+                    self.cached_content = caching.CachedContent.create(
+                        model=f"models/{self.model_name}",
+                        system_instruction=self.system_instruction,
+                        ttl=timedelta(minutes=GEMINI_CONTEXT_CACHE_TTL_MINUTES)
+                    )
+                    self._model = genai.GenerativeModel.from_cached_content(self.cached_content, safety_settings=GEMINI_SAFETY_SETTINGS)
+                except Exception as e:
+                    # Modelo sem suporte a cache explícito ou contexto pequeno demais: segue só com a system instruction
+                    logger.info(f"Cache de contexto Gemini indisponível, usando system instruction: {e}")
+                    self.cached_content = None
+            if self._model is None:
+                self._model = genai.GenerativeModel(self.model_name, safety_settings=GEMINI_SAFETY_SETTINGS, system_instruction=self.system_instruction)
+            return self._model
+
+    def query(self, task_prompt, max_output_tokens=8000, stage="completa", response_schema=None):
+        """
+        Executa uma etapa do fluxo: envia só task_prompt, sobre o contexto compartilhado. stage rotula as métricas.
+        Com response_schema a resposta vem em JSON (response_mime_type="application/json") nesse formato.
+        """
+        return cached_call(
+            ("gemini", self.model_name, self.system_instruction, task_prompt, max_output_tokens, 0.7, repr(response_schema) if response_schema else None),
+            lambda: self._query_uncached(task_prompt, max_output_tokens, stage, response_schema)
         )
-        response = model.generate_content(prompt_text)
-        if response.parts:
-            return response.text
-        else:
-            # Se não há 'parts', pode ser um bloqueio ou outro problema.
-            # Imprime o motivo do bloqueio, se houver.
-            print(f"Resposta Gemini sem 'parts'. Bloqueio? {response.prompt_feedback}")
-            if response.prompt_feedback and response.prompt_feedback.block_reason:
-                return f"Erro: Conteúdo bloqueado pela API Gemini. Motivo: {response.prompt_feedback.block_reason_message or response.prompt_feedback.block_reason}"
-            return "Erro: Resposta da API Gemini vazia ou em formato inesperado."
 
-    except Exception as e:
-        error_message = f"Erro ao contatar a API Gemini: {str(e)}"
-        if "API key not valid" in str(e):
-            error_message = "Erro: Chave da API Gemini inválida ou não configurada corretamente."
-        elif "quota" in str(e).lower():
-            error_message = "Erro: Cota da API Gemini excedida. Tente novamente mais tarde."
-        elif "resource_exhausted" in str(e).lower():
-             error_message = "Erro: Recursos da API Gemini esgotados (provavelmente cota). Tente novamente mais tarde."
-        print(error_message) # Log do erro
-        return error_message
+    def _query_uncached(self, task_prompt, max_output_tokens, stage="completa", response_schema=None):
+        if not self.api_key: return "Erro: Chave da API Gemini não fornecida."
+        # O contexto compartilhado também conta nos tokens por minuto (o cache de contexto não isenta a cota)
+        prompt_tokens = self.context_tokens + estimate_tokens(task_prompt, self.model_name)
+        lease = acquire_provider_slot("gemini", self.model_name, prompt_tokens + max_output_tokens)
+        if lease is None: return rate_limit_error("gemini")
+        usage, result = None, ""
+        stage_token = stage_var.set(stage) # Os logs desta chamada saem com a etapa
+        try:
+            with provider_call("gemini", self.model_name, stage) as measurement:
+                try:
+                    json_output = {"response_mime_type": "application/json", "response_schema": response_schema} if response_schema else {}
+                    response = self._get_model().generate_content(
+                        task_prompt,
+                        generation_config=genai.types.GenerationConfig(max_output_tokens=max_output_tokens, temperature=0.7, **json_output)
+                    )
+                    usage = getattr(response, "usage_metadata", None)
+                    if usage:
+                        logger.info(f"Uso Gemini: {usage.prompt_token_count} tokens de entrada ({getattr(usage, 'cached_content_token_count', 0)} do cache), {usage.candidates_token_count} de saída",
+                                    extra={"model": self.model_name, "prompt_tokens": usage.prompt_token_count, "output_tokens": usage.candidates_token_count})
+                    result = gemini_response_text(response)
+                except Exception as e:
+                    result = gemini_error_message(e)
+                measurement.finish(task_prompt, result,
+                                   prompt_tokens=usage.prompt_token_count if usage else None,
+                                   output_tokens=usage.candidates_token_count if usage else None)
+                return result
+        finally:
+            stage_var.reset(stage_token)
+            release_provider_slot("gemini", lease, usage.prompt_token_count + usage.candidates_token_count if usage
+                                  else prompt_tokens + estimate_tokens(result, self.model_name))
+
+    def close(self):
+        if self.cached_content is not None:
+            try:
+                self.cached_content.delete()
+            except Exception as e:
+                logger.warning(f"Não foi possível remover o cache de contexto Gemini: {e}")
+            self.cached_content = None
 
 # --- Prompts para o Fluxo Gemini ---
 
@@ -349,36 +822,64 @@ Após a citação, salte uma linha e coloque, na mesma formatação, a informaç
 Não escreva "Fonte:" ou "Jurisprudência Citada:". Apenas a citação e os dados do julgado.
 """
 
-def gemini_prompt_plan(user_data):
-    return f"""{GEMINI_BASE_INSTRUCTION}
-Considerando os seguintes dados fornecidos pelo usuário para uma petição inicial:
+GEMINI_DEFAULT_MODEL = "gemini-2.0-flash"
+
+# Tópicos de "2. DO DIREITO": cada um é uma chamada de até 7500 tokens, então o plano vem em JSON
+# (GEMINI_PLAN_SCHEMA), os títulos são validados e deduplicados e a quantidade é limitada pelo plano
+# do usuário. Sem nenhum título aproveitável, o fluxo segue com GEMINI_FALLBACK_LAW_TOPICS.
+GEMINI_MAX_LAW_TOPICS_BY_PLAN = json.loads(os.getenv("GEMINI_MAX_LAW_TOPICS_BY_PLAN", '{"free": 3, "premium": 6}'))
+GEMINI_DEFAULT_MAX_LAW_TOPICS = int(os.getenv("GEMINI_DEFAULT_MAX_LAW_TOPICS", "4")) # Planos fora da tabela acima
+GEMINI_FALLBACK_LAW_TOPICS = ["DA RESPONSABILIDADE CIVIL", "DOS DANOS MATERIAIS", "DOS DANOS MORAIS"]
+GEMINI_PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {"topicos": {"type": "array", "items": {"type": "string"}}},
+    "required": ["topicos"],
+}
+LAW_TOPIC_MAX_CHARS = 150
+LAW_TOPIC_LINE = re.compile(r"^\s*2\.\d+\.?\s+\S") # "2.1 DOS DANOS MORAIS" no plano em texto
+LAW_TOPIC_NUMBERING = re.compile(r"^[\s\-*•\"']*(?:2\.\d+\.?|\d+[.)\-]|[a-z][.)])?\s*", re.IGNORECASE)
+GEMINI_DOCUMENTS_HEADER = "- Documentos Anexos:\n"
+GEMINI_DOCUMENT_LINE_FORMAT = "  - {filename}: {content}\n"
+
+def gemini_case_context(user_data, model_name=GEMINI_DEFAULT_MODEL, max_output_tokens=7500):
+    """
+    Prefixo compartilhado por todas as etapas do fluxo Gemini (persona, regras, dados do caso e
+    documentos anexos). Devolve (texto, tokens estimados).
+    """
+    prompt = BudgetedPrompt(model_name, max_output_tokens)
+    prompt.add("instrucoes", f"""{GEMINI_BASE_INSTRUCTION}
+{GEMINI_JURISPRUDENCE_INSTRUCTION}
+""")
+    prompt.add("dados_do_caso", f"""
+Dados do caso, fornecidos pelo usuário para uma petição inicial (valem para todas as partes da petição):
 - Tipo de Peça Jurídica: {user_data['tipo_peticao']}
 - Assunto Principal: {user_data['assunto_principal']}
-- Partes Envolvidas: {user_data['partes_str']}
-- Descrição dos Fatos: {user_data['fatos_str']}
+- Partes Envolvidas (Autor, Réu, etc.): {user_data['partes_str']}
+- Descrição Detalhada dos Fatos: {user_data['fatos_str']}
 - Outras Informações/Diretrizes: {user_data['outras_info_str']}
-
-Tarefa: Crie um plano para a seção "2. DO DIREITO" da petição.
-O plano deve consistir em uma lista numerada de TÍTULOS DESCRITIVOS (em CAIXA ALTA) para os subtópicos dos fundamentos jurídicos.
-Cada título deve ser conciso e indicar o tema do respectivo subtópico.
+""")
+    prompt.add_documents("documentos", case_documents(user_data), document_relevance_query(user_data), GEMINI_DOCUMENTS_HEADER, GEMINI_DOCUMENT_LINE_FORMAT)
+    prompt.add("orientacao", """
+Cada mensagem a seguir pede uma parte específica da petição. Redija somente a parte pedida na mensagem.
+""")
+    context_text = log_prompt_report("gemini/contexto", prompt)
+    return context_text, prompt.report()["input_tokens"]
+
+# Tarefas de cada etapa: vão junto com o contexto compartilhado (gemini_case_context)
+def gemini_prompt_plan(max_topics=GEMINI_DEFAULT_MAX_LAW_TOPICS):
+    return f"""Tarefa: Crie um plano para a seção "2. DO DIREITO" da petição.
+O plano deve consistir em uma lista de no máximo {max_topics} TÍTULOS DESCRITIVOS (em CAIXA ALTA) para os subtópicos dos fundamentos jurídicos, do mais importante para o menos importante.
+Cada título deve ser conciso, indicar o tema do respectivo subtópico e não repetir o tema de outro título.
 Por exemplo:
 2.1 DA RESPONSABILIDADE CIVIL OBJETIVA
 2.2 DOS DANOS MORAIS
 2.3 DA TUTELA DE URGÊNCIA
 
-Não escreva o conteúdo dos tópicos, apenas a lista de títulos planejados para a seção "2. DO DIREITO".
+Responda somente com um objeto JSON no formato {{"topicos": ["2.1 TÍTULO", "2.2 TÍTULO"]}}, sem o conteúdo dos tópicos, comentários ou outras observações.
 """
 
-def gemini_prompt_addressing_facts(user_data):
-    return f"""{GEMINI_BASE_INSTRUCTION}
-Dados para a petição:
-- Tipo de Peça Jurídica: {user_data['tipo_peticao']}
-- Assunto Principal: {user_data['assunto_principal']}
-- Partes Envolvidas (Autor, Réu, etc.): {user_data['partes_str']} (Use esta informação para a qualificação)
-- Descrição Detalhada dos Fatos: {user_data['fatos_str']}
-- Outras Informações/Diretrizes: {user_data['outras_info_str']}
-
-Tarefa: Redija as seguintes seções da petição inicial:
+def gemini_prompt_addressing_facts():
+    return """Tarefa: Redija as seguintes seções da petição inicial:
 1. ENDEREÇAMENTO (Ex: AO JUIZADO ESPECIAL CÍVEL DA COMARCA DE [CIDADE/ESTADO])
 2. QUALIFICAÇÃO DAS PARTES (Apresente a qualificação completa da parte autora e da parte ré, com base nas informações fornecidas em "Partes Envolvidas". Se os detalhes não forem completos, use placeholders como [Nacionalidade], [Profissão], [CPF], [Endereço Completo], [CNPJ se aplicável], etc.)
 3. NOME DA AÇÃO (EM CAIXA ALTA. Ex: AÇÃO DE INDENIZAÇÃO POR DANOS MORAIS E MATERIAIS)
@@ -387,37 +888,23 @@ Tarefa: Redija as seguintes seções da petição inicial:
 Siga rigorosamente a estrutura e formatação indicadas.
 """
 
-def gemini_prompt_law_topic(user_data, topic_title):
-    return f"""{GEMINI_BASE_INSTRUCTION}
-{GEMINI_JURISPRUDENCE_INSTRUCTION}
-
-Dados do caso:
-- Tipo de Peça Jurídica: {user_data['tipo_peticao']}
-- Assunto Principal: {user_data['assunto_principal']}
-- Partes Envolvidas: {user_data['partes_str']}
-- Descrição dos Fatos: {user_data['fatos_str']}
-- Outras Informações/Diretrizes: {user_data['outras_info_str']}
-
-Tarefa: Desenvolva o conteúdo argumentativo para o seguinte tópico da seção "2. DO DIREITO":
+def gemini_prompt_law_topic(topic_title, case_terms=""):
+    # Ementas reais da base local (ver jurisprudence.py); com a base vazia, vale GEMINI_JURISPRUDENCE_INSTRUCTION
+    precedents = jurisprudence_for_topic(topic_title, case_terms)
+    precedents_block = f"\n{precedents}\n" if precedents else ""
+    return f"""Tarefa: Desenvolva o conteúdo argumentativo para o seguinte tópico da seção "2. DO DIREITO":
 Título do Tópico: {topic_title}
-
+{precedents_block}
 Instruções para este tópico:
 - Apresente argumentação jurídica robusta, baseada em doutrina relevante e dispositivos legais vigentes (ex: Código Civil, CDC, CPC, CF, Resoluções de agências, etc.).
-- Se este tópico permitir e for relevante (ex: dano moral, responsabilidade civil, etc.), inclua UMA citação de jurisprudência conforme as regras de formatação especificadas acima.
+- Se este tópico permitir e for relevante (ex: dano moral, responsabilidade civil, etc.), inclua UMA citação de jurisprudência conforme as regras para jurisprudência.
 - Se o título do tópico for, por exemplo, "2.3 DOS DANOS MATERIAIS", foque em comprovar os gastos, citar artigos como o 927 do CC, etc.
 - Se for "2.4 DOS DANOS MORAIS", aborde o abalo psicológico, frustração, etc.
 - Adapte a argumentação especificamente para o "{topic_title}".
 """
 
-def gemini_prompt_requests_closing(user_data, developed_law_topics_summary):
-    return f"""{GEMINI_BASE_INSTRUCTION}
-Dados do caso:
-- Tipo de Peça Jurídica: {user_data['tipo_peticao']}
-- Assunto Principal: {user_data['assunto_principal']}
-- Partes Envolvidas: {user_data['partes_str']}
-- Descrição dos Fatos: {user_data['fatos_str']}
-- Outras Informações/Diretrizes: {user_data['outras_info_str']}
-- Resumo dos tópicos de direito já desenvolvidos: {developed_law_topics_summary}
+def gemini_prompt_requests_closing(developed_law_topics_summary):
+    return f"""Resumo dos tópicos de direito já desenvolvidos: {developed_law_topics_summary}
 
 Tarefa: Redija as seguintes seções finais da petição inicial:
 1. Seção "3. DOS PEDIDOS" (Enumere com clareza os pedidos formulados ao juízo. Ex: citação, condenação em danos materiais R$ XXX,XX, danos morais R$ XX.XXX,XX, produção de provas, procedência total, condenação em sucumbência).
@@ -428,52 +915,344 @@ Tarefa: Redija as seguintes seções finais da petição inicial:
 """
 
 # --- Fluxo de Geração com Gemini ---
-def generate_petition_gemini_flow(api_key, user_data, model_name="gemini-2.0-flash"):
+# Número máximo de chamadas simultâneas à API Gemini dentro de um mesmo fluxo
+GEMINI_FLOW_MAX_WORKERS = int(os.getenv("GEMINI_FLOW_MAX_WORKERS", "4"))
+
+def extract_law_topics_from_plan(plan_text):
+    """
+    Títulos dos tópicos de direito no plano: do JSON pedido em gemini_prompt_plan ou, se a resposta
+    não for JSON (plano antigo no cache, por exemplo), das linhas numeradas "2.x TÍTULO".
+    """
+    try:
+        plan = json.loads(plan_text.strip().removeprefix("```json").strip("`"))
+        titles = plan.get("topicos", []) if isinstance(plan, dict) else plan
+        return [title for title in titles if isinstance(title, str)] if isinstance(titles, list) else []
+    except ValueError:
+        return [line.strip() for line in plan_text.split('\n') if LAW_TOPIC_LINE.match(line)]
+
+def max_law_topics_for_plan(plan):
+    return GEMINI_MAX_LAW_TOPICS_BY_PLAN.get(plan, GEMINI_DEFAULT_MAX_LAW_TOPICS)
+
+def law_topic_key(title):
+    # Radicais (4 primeiras letras, sem acentos) das palavras relevantes: "DO DANO MORAL" ~ "DOS DANOS MORAIS"
+    words = unicodedata.normalize("NFKD", title.lower()).encode("ascii", "ignore").decode().split()
+    return frozenset(word[:4] for word in (re.sub(r"\W", "", word) for word in words) if len(word) > 2 and word not in STOPWORDS)
+
+def is_duplicate_law_topic(key, other_key):
+    # Mesmo tema, ou um título que só detalha outro ("DA RESPONSABILIDADE CIVIL" / "... CIVIL OBJETIVA")
+    smaller, larger = sorted((key, other_key), key=len)
+    return key == other_key or (len(smaller) >= 2 and smaller <= larger)
+
+def plan_law_topics(plan_text, max_topics=GEMINI_DEFAULT_MAX_LAW_TOPICS):
+    """
+    Títulos numerados ("2.1 ...") dos tópicos de direito a desenvolver: os do plano, validados, sem
+    temas repetidos e no máximo max_topics; sem nenhum título válido, GEMINI_FALLBACK_LAW_TOPICS.
+    """
+    titles, keys = [], []
+    for raw_title in extract_law_topics_from_plan(plan_text):
+        title = " ".join(LAW_TOPIC_NUMBERING.sub("", raw_title).split()).strip(" .:;\"'").upper()
+        key = law_topic_key(title)
+        if not key or len(title) > LAW_TOPIC_MAX_CHARS: continue # Observação, comentário ou parágrafo no lugar do título
+        if any(is_duplicate_law_topic(key, other_key) for other_key in keys): continue
+        titles.append(title)
+        keys.append(key)
+        if len(titles) >= max_topics: break
+    if not titles:
+        logger.warning(f"Plano sem tópicos aproveitáveis, usando os tópicos padrão. Plano recebido: {plan_text[:500]}")
+        titles = GEMINI_FALLBACK_LAW_TOPICS[:max_topics]
+    return [f"2.{number} {title}" for number, title in enumerate(titles, start=1)]
+
+def format_law_topic_section(topic_title, law_topic_text):
+    if law_topic_text.startswith("Erro"):
+        # Mantém a marcação do erro no lugar do tópico e segue com os demais
+        return f"\n--- ERRO AO GERAR TÓPICO: {topic_title} ---\n{law_topic_text}\n--- FIM DO ERRO ---\n"
+    return f"\n{law_topic_text}\n" # Adiciona o título e o conteúdo do tópico
+
+# --- Seções da Petição ---
+# O fluxo Gemini gera a petição em seções (endereçamento/fatos, cada tópico 2.x, pedidos/encerramento)
+# que são guardadas separadas, para que uma delas possa ser refeita ou acrescentada com uma chamada só.
+LAW_SECTION_HEADER = "\n\n" + "\n\n2. DO DIREITO\n"
+
+class PetitionSection(str):
+    """Pedaço do texto que é uma seção regenerável: kind ('enderecamento_fatos', 'topico', 'pedidos_encerramento') e title (tópicos)."""
+    def __new__(cls, text, kind, title=None):
+        section = super().__new__(cls, text)
+        section.kind = kind
+        section.title = title
+        return section
+
+class PetitionText(str):
+    """Texto completo da petição que guarda também os pedaços em que foi gerado (ver petition_sections)."""
+    def __new__(cls, pieces):
+        text = super().__new__(cls, "".join(pieces))
+        text.pieces = list(pieces)
+        return text
+
+def render_section(kind, content, title=None):
+    # Mesma formatação do texto montado pelo fluxo completo
+    if kind == "topico": return PetitionSection(format_law_topic_section(title, content), kind, title)
+    if kind == "pedidos_encerramento": return PetitionSection("\n\n" + f"\n{content}", kind)
+    return PetitionSection(content, kind)
+
+def petition_sections(pieces):
+    """Seções ({"kind", "title", "text"}) a partir dos pedaços gerados; texto que não é seção regenerável vira kind "texto"."""
+    sections = []
+    for piece in pieces:
+        if isinstance(piece, PetitionText):
+            sections.extend(petition_sections(piece.pieces))
+        elif isinstance(piece, PetitionSection):
+            sections.append({"kind": piece.kind, "title": piece.title, "text": str(piece)})
+        elif sections and sections[-1]["kind"] == "texto":
+            sections[-1]["text"] += piece
+        else:
+            sections.append({"kind": "texto", "title": None, "text": str(piece)})
+    return sections
+
+def numbered_law_topic_title(sections, title):
+    # "Lucros cessantes" -> "2.4 LUCROS CESSANTES" (próximo número depois dos tópicos existentes)
+    title = title.strip()
+    if title[:1].isdigit(): return title
+    topic_count = sum(1 for section in sections if section["kind"] == "topico")
+    return f"2.{topic_count + 1} {title.upper()}"
+
+def gemini_prompt_revision(current_text, instructions):
+    prompt = ""
+    if current_text:
+        prompt += f"\nVersão atual desta parte, que será substituída pela nova:\n{current_text.strip()}\n"
+    if instructions:
+        prompt += f"\nOrientações do advogado para esta parte: {instructions}\n"
+    if current_text:
+        prompt += "\nRedija a nova versão completa desta parte, e não apenas as alterações.\n"
+    return prompt
+
+def generate_petition_section(api_key, user_data, sections, kind, title=None, current_text=None, instructions="", model_name=GEMINI_DEFAULT_MODEL):
+    """
+    Gera uma única seção sobre o mesmo contexto do fluxo Gemini (uma chamada à API): refaz a seção
+    atual (current_text) ou escreve um tópico novo. sections são as seções atuais da petição, usadas
+    no resumo dos tópicos dos pedidos. Devolve a PetitionSection ou a mensagem "Erro...".
+    """
+    if kind not in ("topico", "enderecamento_fatos", "pedidos_encerramento"):
+        return "Erro: Esta parte da petição não pode ser gerada novamente."
+    with GeminiFlowContext(api_key, user_data, model_name) as flow_context:
+        if kind == "topico":
+            task_prompt = gemini_prompt_law_topic(title, flow_context.case_terms)
+        elif kind == "enderecamento_fatos":
+            task_prompt = gemini_prompt_addressing_facts()
+        else:
+            task_prompt = gemini_prompt_requests_closing("; ".join(section["title"] for section in sections if section["kind"] == "topico"))
+        task_prompt += gemini_prompt_revision(current_text, instructions)
+        section_text = flow_context.query(task_prompt, max_output_tokens=7500, stage="regeneracao")
+    if section_text.startswith("Erro"): return section_text
+    return render_section(kind, section_text, title)
+
+# --- Checkpoints do Fluxo Gemini ---
+# Cada etapa concluída (plano, endereçamento/fatos, cada tópico, pedidos/encerramento) é gravada
+# assim que termina. Se uma etapa falhar (ex.: cota excedida nos pedidos), a nova tentativa da mesma
+# execução refaz só as etapas que faltam, em vez de pagar de novo pelas que já deram certo.
+class GeminiFlowCheckpoint:
+    """Etapas já concluídas de uma execução do fluxo (completed: etapa -> texto); save_callback(etapa, texto) grava cada etapa nova."""
+    def __init__(self, completed=None, save_callback=None):
+        self.completed = dict(completed or {})
+        self.save_callback = save_callback
+        self._lock = threading.Lock()
+
+    def get(self, step):
+        with self._lock:
+            return self.completed.get(step)
+
+    def save(self, step, text):
+        if text.startswith("Erro"): return # Etapa com erro é refeita na próxima tentativa
+        with self._lock:
+            if step in self.completed: return
+            self.completed[step] = text
+        if self.save_callback:
+            try:
+                self.save_callback(step, text)
+            except Exception as e: # Sem o checkpoint, a etapa só seria refeita numa nova tentativa
+                logger.error(f"Erro ao gravar o checkpoint da etapa {step}: {e}")
+
+def law_topic_step(topic_title):
+    return f"topico:{topic_title}"
+
+def submit_flow_step(executor, checkpoint, step, flow_context, build_prompt, max_output_tokens, stage, response_schema=None):
+    """Future com o texto da etapa: o do checkpoint, se já concluída, ou o da chamada à API (gravado no checkpoint ao terminar)."""
+    done_text = checkpoint.get(step)
+    if done_text is not None:
+        future = Future()
+        future.set_result(done_text)
+        return future
+    # A etapa grava o próprio checkpoint ao terminar, mesmo que o fluxo seja interrompido antes de ler o resultado
+    return executor.submit(in_current_context(run_flow_step), checkpoint, step, flow_context, build_prompt, max_output_tokens, stage, response_schema)
+
+def run_flow_step(checkpoint, step, flow_context, build_prompt, max_output_tokens, stage, response_schema=None):
+    """Versão sequencial de submit_flow_step: devolve o texto da etapa."""
+    done_text = checkpoint.get(step)
+    if done_text is not None: return done_text
+    text = flow_context.query(build_prompt(), max_output_tokens=max_output_tokens, stage=stage, response_schema=response_schema)
+    checkpoint.save(step, text)
+    return text
+
+def generate_petition_gemini_flow(api_key, user_data, model_name="gemini-2.0-flash", concurrent=True, max_workers=None, progress_callback=None, max_topics=None, checkpoint=None):
     """
     Orquestra o fluxo de múltiplas chamadas à API Gemini para gerar a petição.
+
+    Com concurrent=True as chamadas independentes rodam em paralelo num pool limitado
+    (ver iter_petition_gemini_flow). A ordem das seções no texto final é a mesma do modo sequencial;
+    o texto devolvido é um PetitionText, que guarda as seções (ver petition_sections).
+    progress_callback(etapa, etapas_concluidas, total_etapas), se informado, é chamado a cada etapa concluída.
+    max_topics limita os tópicos de direito (ver max_law_topics_for_plan); padrão GEMINI_DEFAULT_MAX_LAW_TOPICS.
+    checkpoint (GeminiFlowCheckpoint) reaproveita as etapas já concluídas da execução e grava as novas.
     """
-    full_petition_parts = []
+    if not concurrent:
+        return _generate_petition_gemini_flow_sequential(api_key, user_data, model_name, progress_callback, max_topics, checkpoint)
+
+    petition_pieces = []
+    for piece in iter_petition_gemini_flow(api_key, user_data, model_name, max_workers, progress_callback, max_topics, checkpoint):
+        if piece.startswith("Erro"): return piece
+        petition_pieces.append(piece)
+    return PetitionText(petition_pieces)
+
+def iter_petition_gemini_flow(api_key, user_data, model_name="gemini-2.0-flash", max_workers=None, progress_callback=None, max_topics=None, checkpoint=None):
+    """
+    Gera a petição do fluxo Gemini em pedaços, na ordem do documento, assim que cada seção
+    fica pronta (usado pelo endpoint de streaming). A concatenação dos pedaços é o texto final.
+
+    As chamadas rodam num pool limitado (max_workers, padrão GEMINI_FLOW_MAX_WORKERS): o
+    endereçamento/fatos roda junto com o planejamento e, depois do plano, todos os tópicos de
+    direito e os pedidos/encerramento rodam ao mesmo tempo. Um erro de etapa é gerado como um
+    pedaço começando com "Erro" e encerra o fluxo; erros de tópico ficam marcados no próprio tópico
+    (format_law_topic_section), que pode ser refeito depois como seção. Etapas que já estão em
+    checkpoint (GeminiFlowCheckpoint) não chamam a API.
+    Ao encerrar, as etapas ainda na fila são canceladas e o contexto só é fechado depois que as que
+    já estão rodando terminarem (e gravarem o próprio checkpoint).
+    """
+    max_tokens_per_step = 7500 # Ajuste conforme necessário e limites do modelo flash
+    max_workers = max_workers or GEMINI_FLOW_MAX_WORKERS
+    max_topics = max_topics or GEMINI_DEFAULT_MAX_LAW_TOPICS
+    checkpoint = checkpoint or GeminiFlowCheckpoint()
+
+    # Dados do caso e documentos vão uma vez só, no contexto compartilhado por todas as etapas
+    flow_context = GeminiFlowContext(api_key, user_data, model_name)
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gemini-flow")
+    step_futures = []
+    try:
+        # Etapas 1 e 2 em paralelo: o endereçamento/fatos não depende do plano
+        future_plan = submit_flow_step(executor, checkpoint, "planejamento", flow_context, lambda: gemini_prompt_plan(max_topics),
+                                       1000, "planejamento", GEMINI_PLAN_SCHEMA)
+        future_address_facts = submit_flow_step(executor, checkpoint, "enderecamento_fatos", flow_context, gemini_prompt_addressing_facts,
+                                                max_tokens_per_step, "enderecamento_fatos")
+        step_futures += [future_plan, future_address_facts]
+
+        plan_text = future_plan.result()
+        if plan_text.startswith("Erro"):
+            yield f"Erro no planejamento: {plan_text}"
+            return
+
+        law_topics_titles = plan_law_topics(plan_text, max_topics)
+        logger.info(f"Plano de Tópicos do Direito (Gemini): {law_topics_titles}", extra={"topics": len(law_topics_titles)})
+        total_steps = len(law_topics_titles) + 3 # plano, endereçamento/fatos, tópicos, pedidos/encerramento
+        report_flow_progress(progress_callback, "planejamento", 1, total_steps)
+
+        # Etapas 3 e 4 em paralelo: os tópicos não dependem uns dos outros e os pedidos
+        # só precisam dos títulos planejados, não do texto de cada tópico
+        future_topics = [
+            submit_flow_step(executor, checkpoint, law_topic_step(topic_title), flow_context,
+                             lambda topic_title=topic_title: gemini_prompt_law_topic(topic_title, flow_context.case_terms),
+                             max_tokens_per_step, "topico")
+            for topic_title in law_topics_titles
+        ]
+        developed_law_topics_summary = "; ".join(law_topics_titles)
+        future_requests_closing = submit_flow_step(executor, checkpoint, "pedidos_encerramento", flow_context,
+                                                   lambda: gemini_prompt_requests_closing(developed_law_topics_summary),
+                                                   max_tokens_per_step, "pedidos_encerramento")
+        step_futures += future_topics + [future_requests_closing]
+
+        address_facts_text = future_address_facts.result()
+        if address_facts_text.startswith("Erro"):
+            yield f"Erro no endereçamento/fatos: {address_facts_text}"
+            return
+        report_flow_progress(progress_callback, "enderecamento_fatos", 2, total_steps)
+        yield render_section("enderecamento_fatos", address_facts_text)
+
+        # Os resultados são lidos na ordem do plano, independente da ordem de conclusão
+        yield LAW_SECTION_HEADER
+        for index, (topic_title, future) in enumerate(zip(law_topics_titles, future_topics)):
+            law_topic_text = future.result()
+            report_flow_progress(progress_callback, f"topico: {topic_title}", 3 + index, total_steps)
+            yield render_section("topico", law_topic_text, topic_title)
+
+        requests_closing_text = future_requests_closing.result()
+        if requests_closing_text.startswith("Erro"):
+            yield f"Erro nos pedidos/encerramento: {requests_closing_text}"
+            return
+        report_flow_progress(progress_callback, "pedidos_encerramento", total_steps, total_steps)
+        yield render_section("pedidos_encerramento", requests_closing_text)
+    finally:
+        # Em caso de erro (ou cliente desconectado) não espera pelas chamadas que ainda estão na fila;
+        # as que já estão rodando ainda usam o cache do contexto, que é removido quando a última terminar
+        executor.shutdown(wait=False, cancel_futures=True)
+        close_flow_context_when_done(flow_context, step_futures)
+
+def close_flow_context_when_done(flow_context, futures):
+    """Fecha o flow_context quando todas as futures tiverem terminado (ou sido canceladas); já, se todas terminaram."""
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def step_done(_future):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]: return
+        flow_context.close()
+
+    if not futures: flow_context.close()
+    for future in futures:
+        future.add_done_callback(step_done)
+
+def report_flow_progress(progress_callback, stage, completed_steps, total_steps):
+    if progress_callback:
+        progress_callback(stage, completed_steps, total_steps)
+
+def _generate_petition_gemini_flow_sequential(api_key, user_data, model_name, progress_callback=None, max_topics=None, checkpoint=None):
+    with GeminiFlowContext(api_key, user_data, model_name) as flow_context:
+        return _run_gemini_flow_sequential(flow_context, progress_callback, max_topics, checkpoint)
+
+def _run_gemini_flow_sequential(flow_context, progress_callback=None, max_topics=None, checkpoint=None):
+    full_petition_parts = [] # Mesmos pedaços do modo concorrente (iter_petition_gemini_flow)
     max_tokens_per_step = 7500 # Ajuste conforme necessário e limites do modelo flash
+    max_topics = max_topics or GEMINI_DEFAULT_MAX_LAW_TOPICS
+    checkpoint = checkpoint or GeminiFlowCheckpoint()
 
     # Etapa 1: Planejamento dos tópicos de Direito
-    prompt_plan = gemini_prompt_plan(user_data)
-    plan_text = query_gemini_api(api_key, model_name, prompt_plan, max_output_tokens=1000)
+    plan_text = run_flow_step(checkpoint, "planejamento", flow_context, lambda: gemini_prompt_plan(max_topics), 1000, "planejamento", GEMINI_PLAN_SCHEMA)
     if plan_text.startswith("Erro"): return f"Erro no planejamento: {plan_text}"
-    
-    # Extrair os títulos do plano (isso pode precisar de um parseamento mais robusto)
-    law_topics_titles = [line.strip() for line in plan_text.split('\n') if line.strip() and (line.strip().startswith("2.") or line.strip()[0].isdigit() and '.' in line)]
-    if not law_topics_titles:
-        # Fallback se o plano não veio como esperado, ou se a IA não listou tópicos
-        # Poderia usar uma lista padrão ou pedir ao usuário, mas por ora, erro.
-         return f"Erro: Não foi possível extrair os tópicos de direito do plano gerado pela IA. Plano recebido:\n{plan_text}"
-    print(f"Plano de Tópicos do Direito (Gemini): {law_topics_titles}") # Log
+
+    # Títulos validados, sem repetição e limitados; plano inaproveitável cai nos tópicos padrão
+    law_topics_titles = plan_law_topics(plan_text, max_topics)
+    logger.info(f"Plano de Tópicos do Direito (Gemini): {law_topics_titles}", extra={"topics": len(law_topics_titles)})
+    total_steps = len(law_topics_titles) + 3
+    report_flow_progress(progress_callback, "planejamento", 1, total_steps)
 
     # Etapa 2: Endereçamento e Fatos
-    prompt_address_facts = gemini_prompt_addressing_facts(user_data)
-    address_facts_text = query_gemini_api(api_key, model_name, prompt_address_facts, max_output_tokens=max_tokens_per_step)
+    address_facts_text = run_flow_step(checkpoint, "enderecamento_fatos", flow_context, gemini_prompt_addressing_facts, max_tokens_per_step, "enderecamento_fatos")
     if address_facts_text.startswith("Erro"): return f"Erro no endereçamento/fatos: {address_facts_text}"
-    full_petition_parts.append(address_facts_text)
+    full_petition_parts.append(render_section("enderecamento_fatos", address_facts_text))
+    report_flow_progress(progress_callback, "enderecamento_fatos", 2, total_steps)
 
     # Etapa 3: Desenvolvimento de cada Tópico do Direito
-    developed_law_sections_text = ["\n\n2. DO DIREITO\n"]
-    for topic_title in law_topics_titles:
-        if not topic_title: continue # Pular linhas vazias se houver
-        prompt_law_topic = gemini_prompt_law_topic(user_data, topic_title)
-        law_topic_text = query_gemini_api(api_key, model_name, prompt_law_topic, max_output_tokens=max_tokens_per_step)
-        if law_topic_text.startswith("Erro"):
-            developed_law_sections_text.append(f"\n--- ERRO AO GERAR TÓPICO: {topic_title} ---\n{law_topic_text}\n--- FIM DO ERRO ---\n")
-            # Decide se continua ou para. Por ora, continua com a marcação do erro.
-        else:
-            developed_law_sections_text.append(f"\n{law_topic_text}\n") # Adiciona o título e o conteúdo do tópico
-    
-    full_petition_parts.append("".join(developed_law_sections_text))
+    full_petition_parts.append(LAW_SECTION_HEADER)
+    for index, topic_title in enumerate(law_topics_titles):
+        law_topic_text = run_flow_step(checkpoint, law_topic_step(topic_title), flow_context,
+                                       lambda: gemini_prompt_law_topic(topic_title, flow_context.case_terms), max_tokens_per_step, "topico")
+        full_petition_parts.append(render_section("topico", law_topic_text, topic_title))
+        report_flow_progress(progress_callback, f"topico: {topic_title}", 3 + index, total_steps)
 
     # Etapa 4: Pedidos e Encerramento
     # Criar um resumo dos tópicos de direito para o contexto dos pedidos
     developed_law_topics_summary = "; ".join(law_topics_titles)
-    prompt_requests_closing = gemini_prompt_requests_closing(user_data, developed_law_topics_summary)
-    requests_closing_text = query_gemini_api(api_key, model_name, prompt_requests_closing, max_output_tokens=max_tokens_per_step)
+    requests_closing_text = run_flow_step(checkpoint, "pedidos_encerramento", flow_context,
+                                          lambda: gemini_prompt_requests_closing(developed_law_topics_summary), max_tokens_per_step, "pedidos_encerramento")
     if requests_closing_text.startswith("Erro"): return f"Erro nos pedidos/encerramento: {requests_closing_text}" # Ou anexa o erro
-    full_petition_parts.append(f"\n{requests_closing_text}")
+    full_petition_parts.append(render_section("pedidos_encerramento", requests_closing_text))
+    report_flow_progress(progress_callback, "pedidos_encerramento", total_steps, total_steps)
 
-    return "\n\n".join(full_petition_parts)
\ No newline at end of file
+    return PetitionText(full_petition_parts)